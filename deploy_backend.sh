@@ -56,7 +56,7 @@ export STRICT_ORIGIN_CHECK=1
 # 若启用 API Key，请先 export API_KEY=你的密钥
 export API_KEY="${API_KEY:-}"
 export REQUIRE_SESSION_FOR_API=1
-export SERIALIZE_REMOTE_REQUESTS=1
+export REMOTE_CONCURRENCY="${REMOTE_CONCURRENCY:-1}"
 export MAX_REQUESTS_PER_MINUTE="${MAX_REQUESTS_PER_MINUTE:-20}"
 export MAX_REQUESTS_PER_MINUTE_PER_IP="${MAX_REQUESTS_PER_MINUTE_PER_IP:-60}"
 
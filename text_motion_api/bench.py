@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the Text-to-Motion API Gateway.
+
+Runs in-process against `main.py` (no remote generation server needed).
+
+Example:
+  python3 bench.py serialize --frames 450 --iterations 200
+  python3 bench.py offload --conversions 200 --concurrency 4
+  python3 bench.py ratelimit --ips 1000000 --checks 1000000
+  python3 bench.py sessions --sessions 2000 --rounds 5
+  python3 bench.py prompts --prompts 50000 --queries 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import main
+
+
+def make_npz(frames: int, seed: int = 0) -> bytes:
+    """Build a 38D-format NPZ payload like the remote generator returns"""
+    rng = np.random.default_rng(seed)
+    quat = rng.normal(size=(frames, 4)).astype(np.float32)
+    quat /= np.linalg.norm(quat, axis=1, keepdims=True)
+    buf = io.BytesIO()
+    np.savez_compressed(
+        buf,
+        fps=np.array([50], dtype=np.int32),
+        joint_pos=rng.normal(size=(frames, 29)).astype(np.float32),
+        root_pos=rng.normal(size=(frames, 3)).astype(np.float32),
+        root_rot=quat,
+    )
+    return buf.getvalue()
+
+
+def time_call(fn: Callable[[], object], iterations: int) -> List[float]:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return samples
+
+
+def report(label: str, samples: List[float], extra: str = "") -> None:
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"  {label:<28} mean {statistics.mean(samples):8.3f} ms   "
+          f"p50 {statistics.median(samples):8.3f} ms   p99 {p99:8.3f} ms  {extra}")
+
+
+# ==================== serialize ====================
+
+def bench_serialize(args) -> None:
+    """Per-request serialization of the /api/generate response body"""
+    motion = main.convert_npz_to_motion_data(make_npz(args.frames), "[AI] bench")
+    motion['motion_id'] = "gen_bench"
+
+    def before() -> bytes:
+        # Pydantic validation of nested lists + jsonable_encoder + stdlib json
+        lists = {k: (v.tolist() if isinstance(v, np.ndarray) else v) for k, v in motion.items()}
+        resp = main.GenerationResponse(
+            success=True,
+            motion_id=motion['motion_id'],
+            motion=main.MotionData(**{k: lists[k] for k in main.MotionData.model_fields}),
+            message="Motion generated successfully",
+        )
+        return JSONResponse(content=jsonable_encoder(resp)).body
+
+    def after() -> bytes:
+        return main.MotionJSONResponse({
+            "success": True,
+            "motion_id": motion['motion_id'],
+            "motion": {k: motion[k] for k in main.MotionData.model_fields},
+            "message": "Motion generated successfully",
+        }).body
+
+    def binary() -> bytes:
+        return main.encode_motion_binary(motion)
+
+    def preview_json() -> bytes:
+        return main.render_motion_json(main.decimate_motion(motion, main.Config.MOTION_PREVIEW_FPS))
+
+    def preview_binary() -> bytes:
+        return main.encode_motion_binary(main.decimate_motion(motion, main.Config.MOTION_PREVIEW_FPS))
+
+    encoder = "orjson" if main.orjson is not None else "stdlib json"
+    print(f"serialize: {args.frames} frames, {args.iterations} iterations, encoder={encoder}")
+    for label, fn in (("pydantic + JSONResponse", before),
+                      ("MotionJSONResponse", after),
+                      ("binary (MOTN)", binary),
+                      (f"preview JSON ({main.Config.MOTION_PREVIEW_FPS:g} fps)", preview_json),
+                      (f"preview binary ({main.Config.MOTION_PREVIEW_FPS:g} fps)", preview_binary)):
+        report(label, time_call(fn, args.iterations), f"{len(fn()) / 1024:8.1f} KiB")
+
+
+# ==================== offload ====================
+
+async def _offload_run(npz: bytes, conversions: int, concurrency: int, probe_interval: float) -> List[float]:
+    """Probe /health latency while large generations are being converted"""
+    done = asyncio.Event()
+    latencies: List[float] = []
+
+    async def probe() -> None:
+        # Open-loop arrivals: latency counts from when a request was due, so time
+        # spent waiting for a blocked event loop is included.
+        due = time.perf_counter()
+        while not done.is_set():
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            await main.health_check()
+            latencies.append((time.perf_counter() - due) * 1000.0)
+            due += probe_interval
+
+    async def convert_and_render() -> None:
+        motion = await main.conversion_pool.run(main.convert_npz_to_motion_data, npz, "[AI] bench")
+        motion['motion_id'] = "gen_bench"
+        await main.conversion_pool.run(main.render_motion_json, {
+            "success": True,
+            "motion_id": motion['motion_id'],
+            "motion": {k: motion[k] for k in main.MotionData.model_fields},
+            "message": "Motion generated successfully",
+        })
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker() -> None:
+        async with semaphore:
+            await convert_and_render()
+            await asyncio.sleep(0)
+
+    probe_task = asyncio.create_task(probe())
+    await asyncio.gather(*(worker() for _ in range(conversions)))
+    done.set()
+    await probe_task
+    return latencies
+
+
+def bench_offload(args) -> None:
+    """Latency of a lightweight endpoint while large clips are converted inline vs in a pool"""
+    npz = make_npz(args.frames)
+    print(f"offload: {args.conversions} conversions of {args.frames} frames, "
+          f"{args.concurrency} concurrent, /health probed every {args.probe_interval * 1000:.0f} ms")
+    for kind, workers in (("inline", 0), ("thread", args.workers), ("process", args.workers)):
+        main.conversion_pool.shutdown()
+        main.conversion_pool = main.ConversionPool(kind=kind, workers=workers)
+        if workers:
+            # Warm up the executor so pool start-up is not measured
+            asyncio.run(_offload_run(npz, workers, workers, args.probe_interval))
+        start = time.perf_counter()
+        latencies = asyncio.run(_offload_run(npz, args.conversions, args.concurrency, args.probe_interval))
+        elapsed = time.perf_counter() - start
+        report(f"{kind} ({workers} workers)" if workers else kind, latencies,
+               f"total {elapsed:6.2f} s")
+    main.conversion_pool.shutdown()
+
+
+# ==================== ratelimit ====================
+
+class FixedWindowIPLimiter:
+    """The previous per-IP limiter: one unbounded dict behind a global asyncio lock"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.lock = asyncio.Lock()
+        self.ip_rate: Dict[str, dict] = {}
+
+    async def check(self, client_ip: str) -> bool:
+        now = datetime.now()
+        async with self.lock:
+            bucket = self.ip_rate.get(client_ip)
+            if not bucket:
+                self.ip_rate[client_ip] = {"count": 1, "start": now}
+                return True
+            if now - bucket["start"] > timedelta(minutes=1):
+                bucket["count"] = 1
+                bucket["start"] = now
+                return True
+            if bucket["count"] >= self.per_minute:
+                return False
+            bucket["count"] += 1
+            return True
+
+
+async def _ratelimit_run(check, ips: List[str], concurrency: int) -> float:
+    """Run one check per entry of `ips` from `concurrency` tasks; returns elapsed seconds"""
+    chunk = (len(ips) + concurrency - 1) // concurrency
+
+    async def worker(part: List[str]) -> None:
+        for i, ip in enumerate(part):
+            await check(ip)
+            if i % 64 == 0:
+                await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(ips[i:i + chunk]) for i in range(0, len(ips), chunk)))
+    return time.perf_counter() - start
+
+
+def bench_ratelimit(args) -> None:
+    """Per-IP rate-limit checks per second with many distinct client IPs"""
+    rng = random.Random(0)
+    ips = [f"ip-{rng.randrange(args.ips)}" for _ in range(args.checks)]
+    print(f"ratelimit: {args.checks} checks over up to {args.ips} distinct IPs, "
+          f"{args.concurrency} concurrent tasks, max keys {args.max_keys}")
+
+    legacy = FixedWindowIPLimiter(per_minute=60)
+    elapsed = asyncio.run(_ratelimit_run(legacy.check, ips, args.concurrency))
+    print(f"  {'fixed window + global lock':<28} {args.checks / elapsed:12,.0f} checks/s   "
+          f"keys held {len(legacy.ip_rate):>9,}")
+
+    limiter = main.TokenBucketLimiter(per_minute=60, capacity=60, max_keys=args.max_keys)
+
+    async def check(ip: str) -> bool:
+        return limiter.allow(ip)
+
+    elapsed = asyncio.run(_ratelimit_run(check, ips, args.concurrency))
+    stats = limiter.stats()
+    print(f"  {'token bucket (LRU-bounded)':<28} {args.checks / elapsed:12,.0f} checks/s   "
+          f"keys held {stats['keys']:>9,}   evictions {stats['evictions']:,}")
+
+
+# ==================== sessions ====================
+
+async def _sessions_run(store, motion: dict, sessions: int, rounds: int, global_lock) -> List[float]:
+    """Every session runs `rounds` of lookup/add/list/get/delete concurrently; returns per-op latencies"""
+    latencies: List[float] = []
+
+    async def op(coro):
+        start = time.perf_counter()
+        if global_lock is None:
+            result = await coro
+        else:
+            async with global_lock:
+                result = await coro
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        return result
+
+    async def tab(index: int) -> None:
+        session = await store.get_or_create_session(None, f"client-{index}")
+        for r in range(rounds):
+            motion_id = f"m{index}_{r}"
+            await op(store.get_or_create_session(session.session_id, f"client-{index}"))
+            await op(store.add_motion(session, motion_id, {**motion, 'motion_id': motion_id}))
+            await op(store.list_motions(session))
+            await op(store.get_motion(session, motion_id))
+            if r % 2:
+                await op(store.delete_motion(session, motion_id))
+
+    await asyncio.gather(*(tab(i) for i in range(sessions)))
+    return latencies
+
+
+def bench_sessions(args) -> None:
+    """Session/motion store operations from many concurrent sessions: one global lock vs per-session locks"""
+    motion = main.convert_npz_to_motion_data(make_npz(args.frames), "[AI] bench")
+    print(f"sessions: {args.sessions} concurrent sessions x {args.rounds} rounds, "
+          f"{args.frames}-frame motions, conversion={main.conversion_pool.kind}")
+    for label, locked in (("single global lock", True), ("per-session locks", False)):
+        store = main.MemorySessionStore()
+
+        async def run() -> List[float]:
+            return await _sessions_run(store, motion, args.sessions, args.rounds,
+                                       asyncio.Lock() if locked else None)
+
+        start = time.perf_counter()
+        latencies = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        report(label, latencies, f"{len(latencies) / elapsed:10,.0f} ops/s")
+
+    # Same-tab consistency: concurrent adds/deletes on one session keep the accounting exact
+    store = main.MemorySessionStore()
+
+    async def same_tab() -> bool:
+        session = await store.get_or_create_session(None, "tab")
+        ids = [f"t{i}" for i in range(args.rounds * 10)]
+        await asyncio.gather(*(store.add_motion(session, i, {**motion, 'motion_id': i}) for i in ids))
+        await asyncio.gather(*(store.delete_motion(session, i) for i in ids[::2]))
+        return (session.motion_bytes == sum(e.nbytes for e in session.motions.values())
+                and store.motion_bytes + store.disk_bytes == session.motion_bytes)
+
+    print(f"  same-session consistency check: {'ok' if asyncio.run(same_tab()) else 'MISMATCH'}")
+    main.conversion_pool.shutdown()
+
+
+# ==================== prompts ====================
+
+SUBJECTS = ["a person", "a man", "a woman", "someone", "the character", "a dancer", "an old man", "a child"]
+ACTIONS = ["walks", "runs", "jumps", "kicks", "waves", "dances", "crawls", "spins", "punches", "stretches",
+           "bows", "sits down", "stands up", "throws a ball", "climbs stairs", "skips", "limps", "hops"]
+MANNERS = ["slowly", "quickly", "happily", "angrily", "carefully", "in a circle", "backwards", "forward",
+           "to the left", "to the right", "while looking around", "with both arms raised", "on one leg"]
+
+
+def make_prompt(rng: random.Random) -> str:
+    parts = [rng.choice(SUBJECTS), rng.choice(ACTIONS), rng.choice(MANNERS)]
+    if rng.random() < 0.5:
+        parts += ["then", rng.choice(ACTIONS), rng.choice(MANNERS)]
+    return " ".join(parts) + f" {rng.randrange(1000)}"
+
+
+def bench_prompts(args) -> None:
+    """Nearest-prompt lookups in the prompt index: build time and lookup latency"""
+    rng = random.Random(0)
+    prompts = [make_prompt(rng) for _ in range(args.prompts)]
+    index = main.PromptIndex(max_prompts=args.prompts)
+    start = time.perf_counter()
+    for i, text in enumerate(prompts):
+        index.add(text, f"key{i}", 4.0, 10)
+    elapsed = time.perf_counter() - start
+    print(f"prompts: {index.alive:,} distinct prompts, {len(index._postings):,} terms, "
+          f"built in {elapsed:.2f} s ({elapsed / len(prompts) * 1e6:.1f} us/prompt)")
+
+    # Seen prompts with typos / reworded tails, and unseen combinations
+    queries = []
+    for _ in range(args.queries):
+        text = rng.choice(prompts)
+        if rng.random() < 0.5:
+            i = rng.randrange(len(text))
+            text = text[:i] + text[i + 1:]
+        queries.append(text)
+    samples = time_call(lambda: index.search(queries.pop()), len(queries))
+    report("search (seen, perturbed)", samples)
+    fresh = [make_prompt(rng) for _ in range(args.queries)]
+    report("search (unseen)", time_call(lambda: index.search(fresh.pop()), len(fresh)))
+
+    exact = sum(index.search(text, k=1)[0][0] == index._doc_of[index.normalize(text)]
+                for text in prompts[:args.queries])
+    print(f"  exact prompt found first: {exact}/{min(args.queries, len(prompts))}")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("serialize", help=bench_serialize.__doc__)
+    p.add_argument("--frames", type=int, default=450)
+    p.add_argument("--iterations", type=int, default=200)
+    p.set_defaults(func=bench_serialize)
+
+    p = sub.add_parser("offload", help=bench_offload.__doc__)
+    p.add_argument("--frames", type=int, default=450)
+    p.add_argument("--conversions", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--probe-interval", type=float, default=0.002)
+    p.set_defaults(func=bench_offload)
+
+    p = sub.add_parser("ratelimit", help=bench_ratelimit.__doc__)
+    p.add_argument("--ips", type=int, default=1_000_000)
+    p.add_argument("--checks", type=int, default=1_000_000)
+    p.add_argument("--concurrency", type=int, default=64)
+    p.add_argument("--max-keys", type=int, default=100_000)
+    p.set_defaults(func=bench_ratelimit)
+
+    p = sub.add_parser("sessions", help=bench_sessions.__doc__)
+    p.add_argument("--sessions", type=int, default=2000)
+    p.add_argument("--rounds", type=int, default=5)
+    p.add_argument("--frames", type=int, default=300)
+    p.set_defaults(func=bench_sessions)
+
+    p = sub.add_parser("prompts", help=bench_prompts.__doc__)
+    p.add_argument("--prompts", type=int, default=50000)
+    p.add_argument("--queries", type=int, default=2000)
+    p.set_defaults(func=bench_prompts)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
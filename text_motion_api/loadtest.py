@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Load test for the Text-to-Motion API Gateway.
+
+Many concurrent virtual users each create a session (`POST /api/session`),
+then repeatedly generate a motion (`POST /api/generate`), list their motions
+(`GET /api/motions`) and fetch the new one (`GET /api/motions/{id}`). Reports
+throughput, p50/p95/p99 latency per endpoint and the gateway's RSS.
+
+With --spawn the gateway and `mock_generator.py` are started locally on free
+ports, so the whole run works on a laptop without the GPU server:
+
+Example:
+  python3 loadtest.py --spawn --users 50 --duration 30
+  python3 loadtest.py --spawn --users 200 --duration 60 --mock-args "--latency lognormal:0.5,0.3 --gpu-slots 4" \\
+      --gateway-env REMOTE_CONCURRENCY=4
+  python3 loadtest.py --url http://127.0.0.1:8080 --gateway-pid 12345 --users 20 --requests 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROMPTS = [
+    "a person walks forward",
+    "a person waves with the right hand",
+    "a person jumps in place",
+    "a person turns around and sits down",
+    "a person kicks with the left leg",
+    "a person runs in a circle",
+    "a person bows politely",
+    "a person dances happily",
+]
+
+
+# ==================== HTTP client ====================
+
+class HTTPConnection:
+    """
+    Minimal asyncio HTTP/1.1 keep-alive client (stdlib only)
+
+    One per virtual user, like a browser tab reusing its connection. Handles
+    Content-Length and chunked bodies; reconnects once if a kept-alive
+    connection was closed by the server.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self._reader = self._writer = None
+
+    async def request(self, method: str, path: str, body: Optional[bytes] = None,
+                      headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        for attempt in range(2):
+            reused = self._writer is not None
+            if not reused:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+            try:
+                return await asyncio.wait_for(self._exchange(method, path, body, headers or {}), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                if not reused or attempt:
+                    raise
+            except BaseException:
+                await self.close()
+                raise
+        raise ConnectionError("unreachable")
+
+    async def _exchange(self, method, path, body, headers) -> Tuple[int, Dict[str, str], bytes]:
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int((await self._reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self._reader.readline()
+                    break
+                parts.append(await self._reader.readexactly(size))
+                await self._reader.readline()
+            data = b"".join(parts)
+        elif status in (204, 304) or method == "HEAD":
+            data = b""
+        else:
+            data = await self._reader.readexactly(int(response_headers.get("content-length", "0")))
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, response_headers, data
+
+
+# ==================== Measurements ====================
+
+class Stats:
+    """Latency samples and status counts per endpoint"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[str, int]] = {}
+        self.bytes: Dict[str, int] = {}
+
+    def record(self, endpoint: str, seconds: float, status: str, nbytes: int = 0) -> None:
+        self.samples.setdefault(endpoint, []).append(seconds * 1000.0)
+        counts = self.statuses.setdefault(endpoint, {})
+        counts[status] = counts.get(status, 0) + 1
+        self.bytes[endpoint] = self.bytes.get(endpoint, 0) + nbytes
+
+    @staticmethod
+    def percentile(samples: List[float], q: float) -> float:
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def summary(self, elapsed: float) -> dict:
+        out = {}
+        for endpoint, samples in self.samples.items():
+            samples = sorted(samples)
+            counts = self.statuses[endpoint]
+            ok = sum(n for status, n in counts.items() if status.startswith("2") or status == "304")
+            out[endpoint] = {
+                "requests": len(samples),
+                "ok": ok,
+                "statuses": dict(sorted(counts.items())),
+                "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+                "mean_ms": statistics.mean(samples),
+                "p50_ms": statistics.median(samples),
+                "p95_ms": self.percentile(samples, 0.95),
+                "p99_ms": self.percentile(samples, 0.99),
+                "max_ms": samples[-1],
+                "mib": self.bytes.get(endpoint, 0) / (1024 * 1024),
+            }
+        return out
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """Resident set size of `pid` in bytes (/proc on Linux, `ps` elsewhere)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        out = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True, timeout=5)
+        return int(out.stdout.strip()) * 1024
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+
+async def sample_rss(pid: int, interval: float, samples: List[int], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        rss = await asyncio.to_thread(read_rss, pid)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+# ==================== Virtual users ====================
+
+async def virtual_user(user: int, args, host: str, port: int, stats: Stats, deadline: float) -> None:
+    rng = random.Random(args.seed * 100003 + user if args.seed is not None else None)
+    conn = HTTPConnection(host, port, args.timeout)
+    headers = {"Content-Type": "application/json", "Origin": args.origin}
+    if args.api_key:
+        headers["Authorization"] = f"Bearer {args.api_key}"
+
+    async def call(endpoint: str, method: str, path: str, body=None, extra=None):
+        start = time.perf_counter()
+        try:
+            status, response_headers, data = await conn.request(
+                method, path, json.dumps(body).encode() if body is not None else None, {**headers, **(extra or {})})
+        except asyncio.TimeoutError:
+            stats.record(endpoint, time.perf_counter() - start, "timeout")
+            return None, None, None
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError):
+            stats.record(endpoint, time.perf_counter() - start, "conn_error")
+            return None, None, None
+        stats.record(endpoint, time.perf_counter() - start, str(status), len(data))
+        return status, response_headers, data
+
+    try:
+        if args.ramp_up:
+            await asyncio.sleep(args.ramp_up * user / args.users)
+        status, _, data = await call("POST /api/session", "POST", "/api/session", {})
+        if status != 200:
+            return
+        headers["X-Session-ID"] = json.loads(data)["session_id"]
+
+        done = 0
+        while (args.requests == 0 or done < args.requests) and time.monotonic() < deadline:
+            done += 1
+            request = {
+                "text": rng.choice(PROMPTS),
+                "motion_length": round(rng.uniform(args.min_length, args.max_length), 1),
+                "num_inference_steps": args.steps,
+            }
+            if rng.random() < args.repeat_ratio:
+                request["seed"] = rng.randrange(args.seed_pool)  # cacheable repeat
+            elif args.seeded:
+                request["seed"] = rng.randrange(1 << 30)
+            query = "?format=binary" if args.binary else ""
+            status, response_headers, data = await call(
+                "POST /api/generate", "POST", f"/api/generate{query}", request)
+            if status != 200:
+                if status == 429:
+                    await asyncio.sleep(1.0)
+                continue
+            motion_id = (response_headers.get("x-motion-id")
+                         or json.loads(data).get("motion_id"))
+
+            await call("GET /api/motions", "GET", "/api/motions")
+            if motion_id:
+                status, response_headers, _ = await call(
+                    "GET /api/motions/{id}", "GET", f"/api/motions/{motion_id}{query}",
+                    extra={"Accept-Encoding": "gzip"})
+                etag = (response_headers or {}).get("etag")
+                if etag and args.revalidate:
+                    await call("GET /api/motions/{id} (304)", "GET", f"/api/motions/{motion_id}{query}",
+                               extra={"Accept-Encoding": "gzip", "If-None-Match": etag})
+            if args.think:
+                await asyncio.sleep(rng.expovariate(1.0 / args.think))
+    finally:
+        await conn.close()
+
+
+# ==================== Local gateway + mock ====================
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_http(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                resp.read()
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+            time.sleep(0.2)
+
+
+def spawn(args) -> Tuple[str, int, List[subprocess.Popen]]:
+    """Start mock_generator.py and the gateway on free ports; returns (url, gateway pid, processes)"""
+    mock_port, gateway_port = free_port(), free_port()
+    log = open(args.log, "w") if args.log else subprocess.DEVNULL
+    procs = [subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mock_generator.py"), "--port", str(mock_port),
+         "--report-interval", "0", *shlex.split(args.mock_args)],
+        stdout=log, stderr=subprocess.STDOUT,
+    )]
+    env = {
+        **os.environ,
+        "REMOTE_WS_HOST": "127.0.0.1",
+        "REMOTE_WS_PORT": str(mock_port),
+        "STRICT_ORIGIN_CHECK": "0",
+        "MAX_REQUESTS_PER_MINUTE": "100000",
+        "MAX_REQUESTS_PER_MINUTE_PER_IP": "1000000",
+    }
+    for item in args.gateway_env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    procs.append(subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(gateway_port),
+         "--log-level", "warning", *shlex.split(args.uvicorn_args)],
+        cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT,
+    ))
+    url = f"http://127.0.0.1:{gateway_port}"
+    try:
+        wait_http(f"http://127.0.0.1:{mock_port}/", 15)
+        wait_http(f"{url}/health", 30)
+    except Exception:
+        stop(procs)
+        raise
+    return url, procs[1].pid, procs
+
+
+def stop(procs: List[subprocess.Popen]) -> None:
+    for proc in reversed(procs):
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+# ==================== Main ====================
+
+async def run(args, url: str, gateway_pid: Optional[int]) -> dict:
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    stats = Stats()
+    rss: List[int] = []
+    stop_sampling = asyncio.Event()
+    sampler = None
+    if gateway_pid:
+        sampler = asyncio.ensure_future(sample_rss(gateway_pid, args.rss_interval, rss, stop_sampling))
+
+    start = time.monotonic()
+    deadline = start + args.duration if args.duration else float("inf")
+    await asyncio.gather(*(virtual_user(i, args, host, port, stats, deadline) for i in range(args.users)))
+    elapsed = time.monotonic() - start
+
+    stop_sampling.set()
+    if sampler is not None:
+        await sampler
+    result = {
+        "users": args.users,
+        "elapsed_seconds": elapsed,
+        "endpoints": stats.summary(elapsed),
+    }
+    generate = result["endpoints"].get("POST /api/generate")
+    result["generations_per_second"] = generate["ok"] / elapsed if generate else 0.0
+    if rss:
+        result["gateway_rss_mib"] = {
+            "start": rss[0] / 2**20,
+            "peak": max(rss) / 2**20,
+            "end": rss[-1] / 2**20,
+        }
+    return result
+
+
+def print_report(result: dict) -> None:
+    print(f"loadtest: {result['users']} users, {result['elapsed_seconds']:.1f} s, "
+          f"{result['generations_per_second']:.2f} generations/s")
+    for endpoint, s in result["endpoints"].items():
+        errors = {k: v for k, v in s["statuses"].items() if not (k.startswith("2") or k == "304")}
+        print(f"  {endpoint:<30} {s['requests']:6d} req {s['throughput_rps']:8.2f}/s   "
+              f"p50 {s['p50_ms']:8.1f} ms   p95 {s['p95_ms']:8.1f} ms   p99 {s['p99_ms']:8.1f} ms   "
+              f"max {s['max_ms']:8.1f} ms  {s['mib']:7.1f} MiB" + (f"   errors {errors}" if errors else ""))
+    if "gateway_rss_mib" in result:
+        r = result["gateway_rss_mib"]
+        print(f"  gateway RSS: start {r['start']:.1f} MiB, peak {r['peak']:.1f} MiB, end {r['end']:.1f} MiB")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_argument_group("target")
+    target.add_argument("--url", default="http://127.0.0.1:8080", help="Gateway URL (ignored with --spawn)")
+    target.add_argument("--gateway-pid", type=int, default=None, help="Gateway process to sample RSS from")
+    target.add_argument("--spawn", action="store_true", help="Start mock_generator.py and the gateway locally")
+    target.add_argument("--mock-args", default="--latency lognormal:0.5,0.25 --gpu-slots 1",
+                        help="Extra mock_generator.py arguments (with --spawn)")
+    target.add_argument("--gateway-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Gateway environment variable (with --spawn, repeatable)")
+    target.add_argument("--uvicorn-args", default="", help="Extra uvicorn arguments (with --spawn)")
+    target.add_argument("--log", default="", help="File for the spawned processes' output")
+    target.add_argument("--api-key", default=os.getenv("API_KEY", ""))
+    target.add_argument("--origin", default="http://localhost:5173")
+
+    load = parser.add_argument_group("load")
+    load.add_argument("--users", type=int, default=20, help="Concurrent virtual users (sessions)")
+    load.add_argument("--duration", type=float, default=30.0, help="Seconds to run (0 = until --requests are done)")
+    load.add_argument("--requests", type=int, default=0, help="Generations per user (0 = until --duration)")
+    load.add_argument("--ramp-up", type=float, default=0.0, help="Seconds over which users start")
+    load.add_argument("--think", type=float, default=0.0, help="Mean think time between generations (seconds)")
+    load.add_argument("--min-length", type=float, default=2.0)
+    load.add_argument("--max-length", type=float, default=6.0)
+    load.add_argument("--steps", type=int, default=10)
+    load.add_argument("--repeat-ratio", type=float, default=0.0,
+                      help="Fraction of requests reusing a small seed pool (exercises the generation cache)")
+    load.add_argument("--seed-pool", type=int, default=4)
+    load.add_argument("--seeded", action="store_true", help="Send a random seed with every request")
+    load.add_argument("--binary", action="store_true", help="Request the binary motion format")
+    load.add_argument("--revalidate", action="store_true", help="Re-fetch each motion with If-None-Match")
+    load.add_argument("--timeout", type=float, default=120.0)
+    load.add_argument("--seed", type=int, default=None, help="Seed of the request mix")
+
+    out = parser.add_argument_group("output")
+    out.add_argument("--rss-interval", type=float, default=0.5)
+    out.add_argument("--json", default="", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    if args.duration == 0 and args.requests == 0:
+        parser.error("set --duration or --requests")
+
+    procs: List[subprocess.Popen] = []
+    url, gateway_pid = args.url, args.gateway_pid
+    if args.spawn:
+        url, gateway_pid, procs = spawn(args)
+    try:
+        result = asyncio.run(run(args, url, gateway_pid))
+    finally:
+        stop(procs)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
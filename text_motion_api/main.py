@@ -10,25 +10,60 @@ WebSocket motion generation server. It handles:
 """
 
 import asyncio
+import base64
 import io
 import json
 import os
 import time
 import uuid
 import hashlib
-from contextlib import asynccontextmanager
+import heapq
+import random
+import bisect
+import math
+import gzip
+import mmap
+import shutil
+import sqlite3
+import struct
+import threading
+import multiprocessing
+import urllib.request
+import zlib
+from array import array
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Any
+from typing import Dict, List, Optional, Any, Deque, Tuple
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
 import numpy as np
 import websockets
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from websockets.protocol import State
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from pydantic import BaseModel, Field
 import logging
 
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # optional: MOTION_STORE_COMPRESSION=zstd falls back to deflate
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # optional: stored motions are then served gzip-compressed only
+    brotli = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -44,19 +79,76 @@ class Config:
     REMOTE_WS_HOST = os.getenv("REMOTE_WS_HOST", "127.0.0.1")
     REMOTE_WS_PORT = int(os.getenv("REMOTE_WS_PORT", "8000"))
     REMOTE_WS_PATH = os.getenv("REMOTE_WS_PATH", "/ws")
+    # Several generator servers: comma-separated "host:port" or "ws://host:port/path"
+    # entries. Defaults to the single REMOTE_WS_HOST:REMOTE_WS_PORT server.
+    REMOTE_BACKENDS = [b.strip() for b in os.getenv("REMOTE_BACKENDS", "").split(",") if b.strip()]
+    REMOTE_LB_STRATEGY = os.getenv("REMOTE_LB_STRATEGY", "least_outstanding")  # or "ewma"
+    REMOTE_HEALTH_INTERVAL = float(os.getenv("REMOTE_HEALTH_INTERVAL", "10"))  # 0 = no active probes
+    REMOTE_HEALTH_TIMEOUT = float(os.getenv("REMOTE_HEALTH_TIMEOUT", "3"))
+    # Circuit breaker: eject a backend after this many consecutive failures...
+    REMOTE_CB_FAILURES = int(os.getenv("REMOTE_CB_FAILURES", "3"))
+    # ...and allow a trial request / probe again after this many seconds
+    REMOTE_CB_COOLDOWN = float(os.getenv("REMOTE_CB_COOLDOWN", "30"))
+
+    # Micro-batching: group compatible requests (same num_inference_steps and
+    # motion_length bucket) into one batched request for generators that
+    # advertise "max_batch_size" on their health endpoint
+    REMOTE_BATCHING = os.getenv("REMOTE_BATCHING", "0") == "1"
+    BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+    BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+    BATCH_LENGTH_BUCKET = float(os.getenv("BATCH_LENGTH_BUCKET", "1.0"))  # seconds
     
     # Connection settings
     WS_MAX_SIZE = 50 * 1024 * 1024  # 50MB for large motion data
     WS_TIMEOUT = 60.0  # 60 seconds timeout for generation
+    WS_OPEN_TIMEOUT = 10.0  # Handshake timeout for new remote connections
+
+    # Remote connection pool (idle connections kept open and reused across requests)
+    REMOTE_WS_POOL_SIZE = int(os.getenv("REMOTE_WS_POOL_SIZE", "4"))
+    REMOTE_WS_PING_INTERVAL = float(os.getenv("REMOTE_WS_PING_INTERVAL", "20"))
+    REMOTE_WS_PING_TIMEOUT = float(os.getenv("REMOTE_WS_PING_TIMEOUT", "20"))
+    REMOTE_WS_IDLE_TIMEOUT = float(os.getenv("REMOTE_WS_IDLE_TIMEOUT", "300"))
     
     # Data storage settings
     DATA_RETENTION_MINUTES = int(os.getenv("DATA_RETENTION_MINUTES", "30"))
     CLEANUP_INTERVAL_MINUTES = int(os.getenv("CLEANUP_INTERVAL_MINUTES", "5"))
     MAX_STORED_MOTIONS_PER_USER = int(os.getenv("MAX_STORED_MOTIONS_PER_USER", "10"))
+    SESSION_MAX_AGE_HOURS = 2
+    # Session/motion store: "memory" (single worker process) or "sqlite" (survives
+    # restarts; can be shared by several uvicorn workers on one host, but the job
+    # and batch APIs still need WEB_CONCURRENCY=1)
+    SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+    SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.db")
+
+    # Stored motions are kept as packed float32 payloads, optionally compressed
+    # ("none", "deflate" or "zstd"), and evicted least recently used first once the
+    # global or per-session byte budget is exceeded (0 = no budget)
+    MOTION_STORE_COMPRESSION = os.getenv("MOTION_STORE_COMPRESSION", "none")
+    MOTION_STORE_MAX_BYTES = int(os.getenv("MOTION_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+    MOTION_STORE_SESSION_MAX_BYTES = int(os.getenv("MOTION_STORE_SESSION_MAX_BYTES", str(16 * 1024 * 1024)))
+    # Optional disk tier of the memory store: motions are written to this directory
+    # (uncompressed, memory-mapped on read) and only their metadata stays in RAM
+    MOTION_SPILL_DIR = os.getenv("MOTION_SPILL_DIR", "").strip()
+    MOTION_SPILL_MAX_BYTES = int(os.getenv("MOTION_SPILL_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+
+    # Encoded (and gzip/brotli compressed) GET /api/motions/{id} bodies kept for reuse
+    MOTION_RESPONSE_CACHE_MAX_BYTES = int(os.getenv("MOTION_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    # Frame rate of `resolution=preview` motion payloads (temporally decimated)
+    MOTION_PREVIEW_FPS = float(os.getenv("MOTION_PREVIEW_FPS", "10"))
+
+    # CPU-bound motion conversion (NPZ decode, JSON/binary encoding) runs in a
+    # "thread" or "process" pool so the event loop stays responsive. 0 workers = inline.
+    CONVERSION_EXECUTOR = os.getenv("CONVERSION_EXECUTOR", "thread")
+    CONVERSION_WORKERS = int(os.getenv("CONVERSION_WORKERS", "2"))
     
-    # Rate limiting
+    # Rate limiting (token buckets refilled at the per-minute rate; the burst defaults
+    # to one minute's worth of requests)
     MAX_REQUESTS_PER_MINUTE = int(os.getenv("MAX_REQUESTS_PER_MINUTE", "10"))
     MAX_REQUESTS_PER_MINUTE_PER_IP = int(os.getenv("MAX_REQUESTS_PER_MINUTE_PER_IP", "60"))
+    RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "0")) or MAX_REQUESTS_PER_MINUTE
+    RATE_LIMIT_BURST_PER_IP = int(os.getenv("RATE_LIMIT_BURST_PER_IP", "0")) or MAX_REQUESTS_PER_MINUTE_PER_IP
+    # Upper bound on tracked rate-limit buckets per limiter (least recently used are dropped)
+    RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
     
     # CORS / origin restriction (set ALLOWED_ORIGINS to your frontend origin only to prevent cross-site abuse)
     ALLOWED_ORIGINS = [origin.strip().rstrip("/") for origin in os.getenv("ALLOWED_ORIGINS", "").split(",") if origin.strip()]
@@ -65,10 +157,63 @@ class Config:
     # Request/session security
     TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "0") == "1"
     REQUIRE_SESSION_FOR_API = os.getenv("REQUIRE_SESSION_FOR_API", "1") == "1"
-    SERIALIZE_REMOTE_REQUESTS = os.getenv("SERIALIZE_REMOTE_REQUESTS", "1") == "1"
+    # Concurrent generations sent to each remote server (0 = unlimited). Defaults to
+    # 1 unless the legacy SERIALIZE_REMOTE_REQUESTS=0 switch is set.
+    REMOTE_CONCURRENCY = int(os.getenv(
+        "REMOTE_CONCURRENCY",
+        "1" if os.getenv("SERIALIZE_REMOTE_REQUESTS", "1") == "1" else "0"
+    ))
+    # Admission control: while the queue wait predicted by the generation cost model
+    # exceeds this many seconds, requests get a fast 503 with Retry-After (0 = off)
+    ADMISSION_MAX_QUEUE_SECONDS = float(os.getenv("ADMISSION_MAX_QUEUE_SECONDS", "30"))
+    # Cost model prior: seconds of a 4 s, 10-step generation until some are observed
+    GENERATION_COST_PRIOR_SECONDS = float(os.getenv("GENERATION_COST_PRIOR_SECONDS", "2.0"))
+    # Per-session quota in predicted generation seconds per minute, bursting up to
+    # GENERATION_SECONDS_BURST (default: one minute's worth; 0 per minute = no quota)
+    GENERATION_SECONDS_PER_MINUTE = float(os.getenv("GENERATION_SECONDS_PER_MINUTE", "30"))
+    GENERATION_SECONDS_BURST = float(os.getenv("GENERATION_SECONDS_BURST", "0")) or GENERATION_SECONDS_PER_MINUTE
+    # Highest scheduling priority a client may request for itself
+    MAX_CLIENT_PRIORITY = int(os.getenv("MAX_CLIENT_PRIORITY", "0"))
+    COALESCE_IDENTICAL_REQUESTS = os.getenv("COALESCE_IDENTICAL_REQUESTS", "1") == "1"
     ALLOW_SESSION_REBIND = os.getenv("ALLOW_SESSION_REBIND", "1") == "1"
     API_KEY = os.getenv("API_KEY", "").strip()
 
+    # Generation cache (keyed on the full remote request; 0 / empty disables a tier)
+    GENERATION_CACHE_MAX_BYTES = int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    GENERATION_CACHE_DIR = os.getenv("GENERATION_CACHE_DIR", "").strip()
+    GENERATION_CACHE_DISK_MAX_BYTES = int(os.getenv("GENERATION_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+    # Seed used when a request omits one. Unset = time-based seed and the request is not cached.
+    GENERATION_DEFAULT_SEED = int(os.environ["GENERATION_DEFAULT_SEED"]) if os.getenv("GENERATION_DEFAULT_SEED", "").strip() else None
+
+    # Prompt index over generated motions (payloads live in the generation cache, or
+    # for uncacheable requests in a small LRU of their own): the closest previous
+    # generation is served when the generator is unavailable (PROMPT_FALLBACK=1,
+    # unless a request opts out) and as an instant job preview.
+    # PROMPT_INDEX_PATH persists the index across restarts (use with GENERATION_CACHE_DIR).
+    PROMPT_INDEX_MAX_PROMPTS = int(os.getenv("PROMPT_INDEX_MAX_PROMPTS", "50000"))
+    PROMPT_INDEX_PAYLOAD_MAX_BYTES = int(os.getenv("PROMPT_INDEX_PAYLOAD_MAX_BYTES", str(32 * 1024 * 1024)))
+    PROMPT_INDEX_PATH = os.getenv("PROMPT_INDEX_PATH", "").strip()
+    PROMPT_FALLBACK = os.getenv("PROMPT_FALLBACK", "1") == "1"
+    PROMPT_FALLBACK_MIN_SIMILARITY = float(os.getenv("PROMPT_FALLBACK_MIN_SIMILARITY", "0.5"))
+
+    # Asynchronous generation jobs (POST /api/jobs): finished jobs stay available for
+    # polling this long; a session may have this many unfinished jobs at once
+    JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "600"))
+    MAX_ACTIVE_JOBS_PER_SESSION = int(os.getenv("MAX_ACTIVE_JOBS_PER_SESSION", "4"))
+    # Comment line sent on idle job event streams so proxies keep them open
+    JOB_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("JOB_EVENTS_KEEPALIVE_SECONDS", "15"))
+    # Worker processes serving the gateway (uvicorn's default for --workers). Jobs
+    # and batches live in the process that runs them, so with more than one worker
+    # their APIs are refused instead of answering 404 from the other workers.
+    WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+    # Batch generation (POST /api/batches): prompts per batch, items generated at
+    # once per batch, and the scheduling priority of batch items (below the
+    # default 0 of interactive requests)
+    BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "200"))
+    BATCH_MAX_PARALLEL = int(os.getenv("BATCH_MAX_PARALLEL", "4"))
+    BATCH_PRIORITY = int(os.getenv("BATCH_PRIORITY", "-1"))
+
 
 # ==================== Data Models ====================
 
@@ -85,6 +230,15 @@ class TextToMotionRequest(BaseModel):
     static_frames: int = Field(default=2, ge=0, description="Number of static frames at start")
     blend_frames: int = Field(default=8, ge=0, description="Number of blend frames")
     transition_steps: int = Field(default=100, ge=0, le=300, description="Transition steps for smooth blending")
+    priority: int = Field(default=0, ge=-10, le=10, description="Scheduling priority (higher runs first; capped by the server)")
+    stream: bool = Field(default=False, description="Jobs only: push frame chunks over /api/jobs/{job_id}/events while generating")
+    preview: bool = Field(default=False, description="Jobs only: push the closest previously generated motion as a preview first")
+    fallback: bool = Field(default=True, description="Serve the closest previously generated motion when the generator is unavailable")
+
+
+class BatchGenerationRequest(BaseModel):
+    """Request model for generating many motions in one call"""
+    items: List[TextToMotionRequest] = Field(..., min_length=1, max_length=Config.BATCH_MAX_ITEMS)
 
 
 class MotionData(BaseModel):
@@ -105,6 +259,8 @@ class GenerationResponse(BaseModel):
     motion_id: str
     motion: MotionData
     message: str
+    fallback: Optional[dict] = None
+    resolution: Optional[dict] = None
 
 
 class ErrorResponse(BaseModel):
@@ -114,491 +270,4002 @@ class ErrorResponse(BaseModel):
     code: str
 
 
+@dataclass
+class StoredMotion:
+    """
+    A motion held by the memory store: metadata plus its arrays packed by
+    `pack_motion`, either in memory (`payload`) or in a spill file (`path`)
+    """
+    meta: dict
+    raw_bytes: int
+    nbytes: int
+    payload: Optional[bytes] = None
+    path: Optional[str] = None
+
+
 @dataclass
 class UserSession:
     """User session data"""
     session_id: str
     created_at: datetime
     last_activity: datetime
-    motions: Dict[str, dict] = field(default_factory=dict)
-    request_count: int = 0
-    request_window_start: datetime = field(default_factory=datetime.now)
+    # Least recently used first (memory store only)
+    motions: Dict[str, StoredMotion] = field(default_factory=OrderedDict)
+    motion_bytes: int = 0
     client_fingerprint: str = ""
+    # Serializes this session's motion mutations (memory store only)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False, compare=False)
 
 
-# ==================== Global State ====================
+# Job states after which nothing changes any more
+JOB_FINAL_STATES = ("succeeded", "failed", "cancelled")
 
-class AppState:
-    """Application state manager"""
-    def __init__(self):
-        self.sessions: Dict[str, UserSession] = {}
-        self.lock = asyncio.Lock()
-        self.cleanup_task: Optional[asyncio.Task] = None
-        self.ip_rate: Dict[str, Dict[str, Any]] = {}
 
-    async def get_or_create_session(self, session_id: Optional[str], client_fingerprint: str) -> UserSession:
-        """Get existing session or create new one"""
-        async with self.lock:
-            if session_id:
-                if session_id in self.sessions:
-                    session = self.sessions[session_id]
-                    if session.client_fingerprint and session.client_fingerprint != client_fingerprint:
-                        if Config.ALLOW_SESSION_REBIND:
-                            session.client_fingerprint = client_fingerprint
-                            session.last_activity = datetime.now()
-                            logger.info(f"Session {session_id} rebound to new client")
-                            return session
-                        raise PermissionError("Session fingerprint mismatch")
-                    session.last_activity = datetime.now()
-                    return session
-            
-            # Create new session
-            new_session_id = str(uuid.uuid4())
-            now = datetime.now()
-            session = UserSession(
-                session_id=new_session_id,
-                created_at=now,
-                last_activity=now,
-                client_fingerprint=client_fingerprint
-            )
-            self.sessions[new_session_id] = session
-            logger.info(f"Created new session: {new_session_id}")
-            return session
-    
-    async def cleanup_expired_sessions(self):
-        """Remove expired sessions and their data"""
-        async with self.lock:
-            now = datetime.now()
-            expired_sessions = []
-            
-            for session_id, session in self.sessions.items():
-                inactive_duration = now - session.last_activity
-                session_age = now - session.created_at
-                
-                # Remove sessions inactive for too long or too old
-                if (inactive_duration > timedelta(minutes=Config.DATA_RETENTION_MINUTES) or
-                    session_age > timedelta(hours=2)):
-                    expired_sessions.append(session_id)
-            
-            for session_id in expired_sessions:
-                del self.sessions[session_id]
-                logger.info(f"Cleaned up expired session: {session_id}")
-    
-    def check_rate_limit(self, session: UserSession) -> bool:
-        """Check if user has exceeded rate limit"""
-        now = datetime.now()
-        window_duration = now - session.request_window_start
-        
-        # Reset window if expired
-        if window_duration > timedelta(minutes=1):
-            session.request_count = 0
-            session.request_window_start = now
-        
-        # Check limit
-        if session.request_count >= Config.MAX_REQUESTS_PER_MINUTE:
-            return False
-        
-        session.request_count += 1
-        return True
+@dataclass
+class GenerationJob:
+    """A generation run in the background (queued -> running -> succeeded / failed / cancelled)"""
+    job_id: str
+    session_id: str
+    text: str
+    created_at: datetime
+    updated_at: datetime
+    status: str = "queued"
+    motion_id: Optional[str] = None
+    error: Optional[dict] = None
+    # Streamed frame chunks (binary motion payloads) not superseded by the result yet
+    chunks: list = field(default_factory=list, repr=False, compare=False)
+    frames_streamed: int = 0
+    first_frame_seconds: Optional[float] = None
+    # Closest previously generated motion (binary motion payload) and its match
+    preview: Optional[bytes] = field(default=None, repr=False, compare=False)
+    preview_match: Optional[dict] = None
+    # Set when the result is a previous motion served because the generator was unavailable
+    fallback: Optional[dict] = None
+    batch_id: Optional[str] = None
+    # Cancelled by DELETE /api/queue: fails with 409 CANCELLED instead of being cancelled
+    cancel_requested: bool = False
+    task: Optional[asyncio.Task] = field(default=None, repr=False, compare=False)
+    # Set (and replaced) on every change, to wake up pushers and long polls
+    changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False, compare=False)
 
-    async def check_ip_rate_limit(self, client_ip: str) -> bool:
-        now = datetime.now()
-        async with self.lock:
-            bucket = self.ip_rate.get(client_ip)
-            if not bucket:
-                self.ip_rate[client_ip] = {"count": 1, "start": now}
-                return True
-
-            window_duration = now - bucket["start"]
-            if window_duration > timedelta(minutes=1):
-                bucket["count"] = 1
-                bucket["start"] = now
-                return True
-
-            if bucket["count"] >= Config.MAX_REQUESTS_PER_MINUTE_PER_IP:
-                return False
+    def update(self, status: str, **fields) -> None:
+        if self.status in JOB_FINAL_STATES:
+            return
+        self.status = status
+        self.updated_at = datetime.now()
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self._notify()
 
-            bucket["count"] += 1
-            return True
+    def add_chunk(self, chunk: bytes, frames: int) -> None:
+        self.chunks.append(chunk)
+        self.frames_streamed += frames
+        self._notify()
 
+    def _notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
 
-app_state = AppState()
-remote_generation_lock = asyncio.Lock()
 
+@dataclass
+class GenerationBatch:
+    """Jobs submitted together by POST /api/batches, in request order"""
+    batch_id: str
+    session_id: str
+    created_at: datetime
+    jobs: list = field(default_factory=list, repr=False, compare=False)
+    # Set (and replaced) whenever one of the jobs finishes
+    changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False, compare=False)
 
-def get_client_ip(http_request: Request) -> str:
-    if Config.TRUST_PROXY_HEADERS:
-        xff = http_request.headers.get("x-forwarded-for", "").strip()
-        if xff:
-            return xff.split(",")[0].strip()
-    return (http_request.client.host if http_request.client else "unknown")
+    @property
+    def done(self) -> bool:
+        return all(job.status in JOB_FINAL_STATES for job in self.jobs)
 
+    def finished_at(self) -> Optional[datetime]:
+        return max(job.updated_at for job in self.jobs) if self.done else None
 
-def get_client_fingerprint(http_request: Request) -> str:
-    client_ip = get_client_ip(http_request)
-    user_agent = http_request.headers.get("user-agent", "")
-    raw = f"{client_ip}|{user_agent}"
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    def _notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
 
 
-def require_allowed_origin(http_request: Request) -> None:
-    if not Config.STRICT_ORIGIN_CHECK:
-        return
-    if not Config.ALLOWED_ORIGINS:
-        raise HTTPException(
-            status_code=500,
-            detail={"error": "Server misconfigured: ALLOWED_ORIGINS is empty", "code": "SERVER_CONFIG_ERROR"}
-        )
-    origin = (http_request.headers.get("origin") or "").strip().rstrip("/")
-    if not origin or origin not in Config.ALLOWED_ORIGINS:
-        raise HTTPException(
-            status_code=403,
-            detail={"error": "Origin not allowed", "code": "ORIGIN_FORBIDDEN"}
-        )
+# ==================== Metrics ====================
 
+class Histogram:
+    """Fixed-bucket histogram (cumulative counts, Prometheus-style)"""
 
-def _is_valid_session_id(s: Optional[str]) -> bool:
-    """Accept only UUID-format session_id."""
-    if not s or not isinstance(s, str) or len(s) > 64:
-        return False
-    try:
-        uuid.UUID(s)
-        return True
-    except (ValueError, TypeError):
-        return False
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
 
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
 
-async def get_bound_session(http_request: Request, allow_create: bool) -> UserSession:
-    session_id_raw = http_request.headers.get("X-Session-ID")
-    session_id = (session_id_raw or "").strip() or None
-    if session_id and not _is_valid_session_id(session_id):
-        raise HTTPException(
-            status_code=400,
-            detail={"error": "Invalid X-Session-ID format", "code": "INVALID_SESSION_ID"}
-        )
-    fingerprint = get_client_fingerprint(http_request)
-    if not session_id and Config.REQUIRE_SESSION_FOR_API and not allow_create:
-        raise HTTPException(
-            status_code=401,
-            detail={"error": "Missing X-Session-ID", "code": "SESSION_REQUIRED"}
-        )
-    try:
-        if allow_create:
-            return await app_state.get_or_create_session(session_id=session_id, client_fingerprint=fingerprint)
-        if not session_id:
-            raise HTTPException(
-                status_code=401,
-                detail={"error": "Missing X-Session-ID", "code": "SESSION_REQUIRED"}
-            )
-        return await app_state.get_or_create_session(session_id=session_id, client_fingerprint=fingerprint)
-    except PermissionError:
-        raise HTTPException(
-            status_code=403,
-            detail={"error": "Session does not belong to this client", "code": "SESSION_FORBIDDEN"}
-        )
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            buckets["+Inf" if bound == math.inf else str(bound)] = cumulative
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
 
 
-# ==================== Background Tasks ====================
+# Latency buckets (seconds) shared by the per-stage histograms
+STAGE_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                         0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
-async def periodic_cleanup():
-    """Periodically clean up expired sessions"""
-    while True:
-        try:
-            await asyncio.sleep(Config.CLEANUP_INTERVAL_MINUTES * 60)
-            await app_state.cleanup_expired_sessions()
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            logger.error(f"Cleanup error: {e}")
 
+class GatewayMetrics:
+    """
+    Per-stage latency histograms and error counters exposed at /metrics
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Application lifespan manager"""
-    # Startup
-    logger.info("Starting Text-to-Motion API Gateway")
-    app_state.cleanup_task = asyncio.create_task(periodic_cleanup())
-    yield
-    # Shutdown
-    logger.info("Shutting down Text-to-Motion API Gateway")
-    if app_state.cleanup_task:
-        app_state.cleanup_task.cancel()
-        try:
-            await app_state.cleanup_task
-        except asyncio.CancelledError:
-            pass
+    Recording is a dict lookup plus a bisect, so it stays on in production.
+    Values are per worker process; with several uvicorn workers each worker
+    reports its own series.
+    """
+    STAGES = (
+        "queue_wait",              # waiting for a generation slot
+        "ws_handshake",            # opening a new remote WebSocket connection
+        "remote_generation",       # request sent -> response frames received
+        "npz_decode",              # NPZ -> motion arrays
+        "json_conversion",         # motion arrays -> JSON body
+        "binary_serialization",    # motion arrays -> binary (MOTN) body
+        "generate_total",          # /api/generate after the rate-limit checks
+        "time_to_first_frame",     # job submitted -> first frames available (streamed chunk or result)
+    )
 
+    def __init__(self):
+        self.stages = {stage: Histogram(STAGE_LATENCY_BUCKETS) for stage in self.STAGES}
+        self.rate_limit_rejections: Dict[str, int] = {}
+        self.remote_errors: Dict[str, int] = {}
+        # Generations abandoned because every client waiting on them went away
+        self.cancellations: Dict[str, int] = {}
+        self.gpu_seconds_saved = 0.0
 
-# ==================== FastAPI App ====================
+    def observe(self, stage: str, seconds: float) -> None:
+        self.stages[stage].observe(seconds)
 
-app = FastAPI(
-    title="Text-to-Motion API Gateway",
-    description="Bridge service between browser frontend and remote motion generation server",
-    version="1.0.0",
-    lifespan=lifespan
-)
+    @asynccontextmanager
+    async def timed(self, stage: str):
+        """Record the duration of the wrapped block (successful or not) under `stage`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage].observe(time.perf_counter() - start)
 
-# API Key middleware: when API_KEY is set, all non-OPTIONS requests must send Authorization: Bearer <API_KEY>
-class APIKeyMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        if not Config.API_KEY:
-            return await call_next(request)
-        if request.method == "OPTIONS":
-            return await call_next(request)
-        auth = request.headers.get("Authorization") or ""
-        if not auth.startswith("Bearer "):
-            return JSONResponse(
-                status_code=401,
-                content={"error": "Missing or invalid Authorization header", "code": "UNAUTHORIZED"},
-            )
-        token = auth[7:].strip()
-        if token != Config.API_KEY:
-            return JSONResponse(
-                status_code=401,
-                content={"error": "Invalid API key", "code": "UNAUTHORIZED"},
-            )
-        return await call_next(request)
+    def count_rate_limit(self, code: str) -> None:
+        self.rate_limit_rejections[code] = self.rate_limit_rejections.get(code, 0) + 1
 
+    def count_remote_error(self, code: str) -> None:
+        self.remote_errors[code] = self.remote_errors.get(code, 0) + 1
 
-app.add_middleware(APIKeyMiddleware)
+    def count_cancellation(self, stage: str, seconds_saved: float) -> None:
+        """`stage` is "queued" or "in_flight"; `seconds_saved` is the estimated generator time not spent"""
+        self.cancellations[stage] = self.cancellations.get(stage, 0) + 1
+        self.gpu_seconds_saved += seconds_saved
 
-# CORS: with allow_credentials=True, allow_origins cannot be "*"; set explicit origins.
-_origins = list(Config.ALLOWED_ORIGINS) if Config.ALLOWED_ORIGINS else []
-if "*" in _origins and len(_origins) == 1:
-    logger.warning("ALLOWED_ORIGINS=* is incompatible with credentials; CORS will allow no origins. Set explicit origins.")
-    _origins = []
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=_origins,
-    allow_credentials=True,
-    allow_methods=["GET", "POST", "DELETE", "OPTIONS"],
-    allow_headers=["Content-Type", "X-Session-ID", "Authorization"],
-)
 
+def _prometheus_labels(labels: Optional[dict]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
 
-# ==================== Helper Functions ====================
 
-def convert_npz_to_motion_data(npz_bytes: bytes, motion_name: str) -> dict:
-    """
-    Convert NPZ binary data to JSON-serializable motion data
-    
-    The input NPZ contains (38D format):
-    - fps: (1,) int32
-    - joint_pos: (T, 29) float32 [Isaac order]
-    - root_pos: (T, 3) float32
-    - root_rot: (T, 4) float32 [w, x, y, z]
-    
-    Output format matches what TrackingHelper expects:
-    - joint_pos: array of arrays (T frames x 29 joints)
-    - root_pos: array of [x, y, z]
-    - root_quat: array of [w, x, y, z]
-    """
-    data = np.load(io.BytesIO(npz_bytes))
-    
-    fps = int(data['fps'][0]) if isinstance(data['fps'], np.ndarray) else int(data['fps'])
-    joint_pos = data['joint_pos'].astype(np.float32)
-    root_pos = data['root_pos'].astype(np.float32)
-    root_rot = data['root_rot'].astype(np.float32)  # [w, x, y, z]
-    
-    frame_count = joint_pos.shape[0]
-    duration = frame_count / fps
-    
-    # Convert to lists for JSON serialization
-    motion_data = {
-        'name': motion_name,
-        'fps': float(fps),
-        'joint_pos': joint_pos.tolist(),
-        'root_pos': root_pos.tolist(),
-        'root_quat': root_rot.tolist(),  # Already in wxyz format
-        'frame_count': frame_count,
-        'duration': duration,
-        'created_at': datetime.now().isoformat()
-    }
-    
-    return motion_data
+def _prometheus_value(value) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
 
 
-async def generate_motion_from_remote(request_data: dict) -> bytes:
-    """
-    Connect to remote WebSocket server and generate motion
-    
-    Returns raw NPZ bytes on success
-    """
-    uri = f"ws://{Config.REMOTE_WS_HOST}:{Config.REMOTE_WS_PORT}{Config.REMOTE_WS_PATH}"
-    
-    async def _request_remote() -> bytes:
-        async with websockets.connect(
-            uri,
-            max_size=Config.WS_MAX_SIZE,
-            open_timeout=10.0
-        ) as ws:
-            # Send request
-            await ws.send(json.dumps(request_data))
-            logger.info("Sent request to remote motion server")
-            
-            # Receive response with timeout
-            response = await asyncio.wait_for(
-                ws.recv(),
-                timeout=Config.WS_TIMEOUT
-            )
-            
-            # Check if error response (JSON string)
-            if isinstance(response, str):
-                try:
-                    error_data = json.loads(response)
-                    error_msg = error_data.get('error', 'Unknown error')
-                    error_code = error_data.get('code', 'SERVER_ERROR')
-                    raise HTTPException(
-                        status_code=500,
-                        detail={"error": error_msg, "code": error_code}
-                    )
-                except json.JSONDecodeError:
-                    raise HTTPException(
-                        status_code=500,
-                        detail={"error": "Invalid response from server", "code": "INVALID_RESPONSE"}
-                    )
-            return response
+class PrometheusWriter:
+    """Minimal Prometheus text exposition format (version 0.0.4) builder"""
 
-    try:
-        if Config.SERIALIZE_REMOTE_REQUESTS:
-            async with remote_generation_lock:
-                return await _request_remote()
-        return await _request_remote()
-            
-    except asyncio.TimeoutError:
-        raise HTTPException(
-            status_code=504,
-            detail={"error": "Request timeout - generation took too long", "code": "TIMEOUT"}
-        )
-    except websockets.exceptions.ConnectionRefused:
-        raise HTTPException(
-            status_code=503,
-            detail={"error": "Motion generation server unavailable", "code": "SERVER_UNAVAILABLE"}
-        )
-    except websockets.exceptions.WebSocketException as e:
-        logger.exception("WebSocket error: %s", e)
-        raise HTTPException(
-            status_code=502,
-            detail={"error": "Backend connection error", "code": "WEBSOCKET_ERROR"}
-        )
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lines: list = []
 
+    def metric(self, name: str, kind: str, help_text: str, samples) -> None:
+        """`samples` is an iterable of (labels, value)"""
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{_prometheus_labels(labels)} {_prometheus_value(value)}")
 
-def enforce_motion_limit(session: UserSession):
-    """Enforce maximum number of stored motions per user"""
-    if len(session.motions) >= Config.MAX_STORED_MOTIONS_PER_USER:
-        # Remove oldest motion
-        oldest_id = min(session.motions.keys(), 
-                       key=lambda k: session.motions[k].get('created_at', ''))
-        del session.motions[oldest_id]
-        logger.info(f"Removed oldest motion {oldest_id} for session {session.session_id}")
+    def histogram(self, name: str, help_text: str, histograms) -> None:
+        """`histograms` is an iterable of (labels, Histogram)"""
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, hist in histograms:
+            cumulative = 0
+            for bound, count in zip(hist.buckets + (math.inf,), hist.counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                self.lines.append(f"{name}_bucket{_prometheus_labels({**labels, 'le': le})} {cumulative}")
+            self.lines.append(f"{name}_sum{_prometheus_labels(labels)} {_prometheus_value(hist.sum)}")
+            self.lines.append(f"{name}_count{_prometheus_labels(labels)} {hist.count}")
 
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
 
-# ==================== API Endpoints ====================
 
-@app.get("/")
-async def root():
-    """Health check endpoint."""
-    return {"status": "running"}
+gateway_metrics = GatewayMetrics()
 
 
-@app.get("/health")
-async def health_check():
-    """Health check"""
-    return {"status": "healthy"}
+# ==================== Global State ====================
 
+def resolve_motion_compression(name: str) -> str:
+    """Validate a MOTION_STORE_COMPRESSION value, falling back when zstd is unavailable"""
+    name = (name or "none").strip().lower()
+    if name not in ("none", "deflate", "zstd"):
+        logger.warning(f"Unknown motion compression {name!r}, storing motions uncompressed")
+        return "none"
+    if name == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, compressing stored motions with deflate")
+        return "deflate"
+    return name
 
-@app.post("/api/generate", response_model=GenerationResponse)
+
+def summarize_motion(motion_id: str, motion: dict) -> dict:
+    """Entry of the /api/motions listing"""
+    return {
+        "motion_id": motion_id,
+        "name": motion.get("name", "Unknown"),
+        "frame_count": motion.get("frame_count", 0),
+        "duration": motion.get("duration", 0),
+        "created_at": motion.get("created_at", ""),
+        "text_prompt": motion.get("text_prompt", "")[:100]
+    }
+
+
+def _session_deadline(created_at: datetime, last_activity: datetime) -> datetime:
+    """Sessions inactive for too long or too old are removed once this has passed"""
+    return min(last_activity + timedelta(minutes=Config.DATA_RETENTION_MINUTES),
+               created_at + timedelta(hours=Config.SESSION_MAX_AGE_HOURS))
+
+
+# Sessions expired per cleanup batch: the memory store yields to the event loop
+# between batches, the SQLite store commits one short transaction per batch
+CLEANUP_BATCH_SIZE = 256
+
+
+def token_bucket_take(
+    tokens: float,
+    updated: float,
+    now: float,
+    rate: float,
+    capacity: float,
+    cost: float = 1.0
+) -> Tuple[bool, float]:
+    """
+    Refill a token bucket for the time elapsed since `updated` and try to take `cost` tokens
+
+    Returns (allowed, remaining tokens)
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return True, tokens - cost
+    return False, tokens
+
+
+class TokenBucketLimiter:
+    """
+    Token-bucket rate limiter keyed by client IP or session ID
+
+    Buckets live in one LRU-ordered map, so a check is O(1). A bucket idle long
+    enough to have refilled is equivalent to a fresh one and is dropped from the
+    LRU end as new checks arrive; the map is also capped at `max_keys`. `allow`
+    never awaits, so on the event loop it is atomic without any lock.
+    """
+
+    def __init__(self, per_minute: float, capacity: float, max_keys: int):
+        self.rate = per_minute / 60.0
+        self.capacity = float(max(1, capacity))
+        self.idle_seconds = self.capacity / self.rate if self.rate > 0 else math.inf
+        self.max_keys = max(1, max_keys)
+        self._buckets: OrderedDict = OrderedDict()
+        self.rejected = 0
+        self.evictions = 0
+
+    def allow(self, key: str, now: Optional[float] = None, cost: float = 1.0) -> bool:
+        """Take `cost` tokens from `key`'s bucket; False when it holds fewer"""
+        now = time.monotonic() if now is None else now
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [self.capacity, now]
+        else:
+            buckets.move_to_end(key)
+        allowed, bucket[0] = token_bucket_take(bucket[0], bucket[1], now, self.rate, self.capacity, cost)
+        bucket[1] = now
+        # Drop buckets that have been idle long enough to be full again, then
+        # enforce the size cap (both from the least recently used end).
+        while len(buckets) > 1:
+            oldest_key = next(iter(buckets))
+            if len(buckets) <= self.max_keys and now - buckets[oldest_key][1] < self.idle_seconds:
+                break
+            del buckets[oldest_key]
+            self.evictions += 1
+        if not allowed:
+            self.rejected += 1
+        return allowed
+
+    def retry_after(self, key: str, cost: float = 1.0) -> float:
+        """Seconds until `key`'s bucket holds `cost` tokens (as of its last check)"""
+        bucket = self._buckets.get(key)
+        if bucket is None or self.rate <= 0:
+            return 0.0 if bucket is None else math.inf
+        return max(0.0, (cost - bucket[0]) / self.rate)
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._buckets),
+            "max_keys": self.max_keys,
+            "rejected": self.rejected,
+            "evictions": self.evictions,
+        }
+
+
+def create_session_rate_limiter() -> TokenBucketLimiter:
+    return TokenBucketLimiter(
+        per_minute=Config.MAX_REQUESTS_PER_MINUTE,
+        capacity=Config.RATE_LIMIT_BURST,
+        max_keys=Config.RATE_LIMIT_MAX_KEYS,
+    )
+
+
+class MemorySessionStore:
+    """
+    Process-local session and motion store (gateway must run as a single worker)
+    
+    Motions are kept packed (`pack_motion`) and materialized only when read. A
+    global LRU list over all sessions' motions, plus each session's own ordered
+    map, make eviction against the byte budgets O(1) per motion.
+    
+    With `MOTION_SPILL_DIR` set, payloads are written to
+    `<dir>/motion-spill/<session_id>/<motion_id>.motn` in the binary motion
+    format instead; reads memory-map the file and binary fetches are served from
+    it directly. The store owns only the `motion-spill` subdirectory.
+    
+    Expiry uses a min-heap of (deadline, session_id). Activity does not touch
+    the heap; a popped entry whose session has been active since is pushed back
+    with its new deadline, so cleanup only visits sessions that were due.
+    
+    Concurrency: session lookups and creation never await, so they run without
+    a lock (each is atomic on the event loop). Motion mutations that await
+    (packing, file I/O) hold the session's own lock, so requests from one tab
+    apply in order while unrelated sessions never wait on each other.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, UserSession] = {}
+        self._expiry: list = []  # heap of (deadline, session_id), possibly stale
+        self.rate_limiter = create_session_rate_limiter()
+        self.compression = resolve_motion_compression(Config.MOTION_STORE_COMPRESSION)
+        self.max_bytes = Config.MOTION_STORE_MAX_BYTES
+        self.session_max_bytes = Config.MOTION_STORE_SESSION_MAX_BYTES
+        # (session_id, motion_id) of every stored motion, least recently used first
+        self._lru: OrderedDict = OrderedDict()
+        self.motion_bytes = 0
+        self.raw_motion_bytes = 0
+        self.evictions = 0
+        self.spill_dir = os.path.join(Config.MOTION_SPILL_DIR, "motion-spill") if Config.MOTION_SPILL_DIR else ""
+        self.spill_max_bytes = Config.MOTION_SPILL_MAX_BYTES
+        self.disk_bytes = 0
+
+    def open(self) -> None:
+        """Prepare the spill directory (at startup, not import: pool workers import this module too)"""
+        if self.spill_dir:
+            # Sessions do not survive a restart, so neither do their files (other
+            # files in MOTION_SPILL_DIR are left alone)
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def close(self) -> None:
+        pass
+
+    async def get_or_create_session(self, session_id: Optional[str], client_fingerprint: str) -> UserSession:
+        """Get existing session or create new one"""
+        if session_id:
+            if session_id in self.sessions:
+                session = self.sessions[session_id]
+                if session.client_fingerprint and session.client_fingerprint != client_fingerprint:
+                    if Config.ALLOW_SESSION_REBIND:
+                        session.client_fingerprint = client_fingerprint
+                        session.last_activity = datetime.now()
+                        logger.info(f"Session {session_id} rebound to new client")
+                        return session
+                    raise PermissionError("Session fingerprint mismatch")
+                session.last_activity = datetime.now()
+                return session
+        
+        # Create new session
+        new_session_id = str(uuid.uuid4())
+        now = datetime.now()
+        session = UserSession(
+            session_id=new_session_id,
+            created_at=now,
+            last_activity=now,
+            client_fingerprint=client_fingerprint
+        )
+        self.sessions[new_session_id] = session
+        heapq.heappush(self._expiry, (_session_deadline(now, now), new_session_id))
+        logger.info(f"Created new session: {new_session_id}")
+        return session
+
+    async def cleanup_expired_sessions(self) -> int:
+        """Remove expired sessions and their data"""
+        now = datetime.now()
+        expired_sessions = []
+        while True:
+            for _ in range(CLEANUP_BATCH_SIZE):
+                if not self._expiry or self._expiry[0][0] >= now:
+                    break
+                _, session_id = heapq.heappop(self._expiry)
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue
+                deadline = _session_deadline(session.created_at, session.last_activity)
+                if deadline >= now:
+                    heapq.heappush(self._expiry, (deadline, session_id))
+                    continue
+                del self.sessions[session_id]
+                for motion_id in list(session.motions):
+                    self._drop(session, motion_id)
+                expired_sessions.append(session_id)
+                logger.info(f"Cleaned up expired session: {session_id}")
+            if not self._expiry or self._expiry[0][0] >= now:
+                break
+            await asyncio.sleep(0)  # let waiting requests run between batches
+        if self.spill_dir and expired_sessions:
+            await asyncio.to_thread(self._remove_spill_dirs, expired_sessions)
+        return len(expired_sessions)
+
+    def _remove_spill_dirs(self, session_ids: list) -> None:
+        for session_id in session_ids:
+            shutil.rmtree(os.path.join(self.spill_dir, session_id), ignore_errors=True)
+
+    def _spill_path(self, session_id: str, motion_id: str) -> str:
+        return os.path.join(self.spill_dir, session_id, f"{motion_id}.motn")
+    
+    async def check_rate_limit(self, session: UserSession) -> bool:
+        """Check if user has exceeded rate limit"""
+        return self.rate_limiter.allow(session.session_id)
+
+    def _drop(self, session: UserSession, motion_id: str) -> Optional[str]:
+        """Forget a motion; returns its spill file (to be removed by the caller), if any"""
+        entry = session.motions.pop(motion_id)
+        del self._lru[(session.session_id, motion_id)]
+        session.motion_bytes -= entry.nbytes
+        self.raw_motion_bytes -= entry.raw_bytes
+        if entry.path is None:
+            self.motion_bytes -= entry.nbytes
+        else:
+            self.disk_bytes -= entry.nbytes
+        return entry.path
+
+    @staticmethod
+    def _remove_files(paths: list) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _over_budget(self) -> bool:
+        return bool(
+            (self.max_bytes and self.motion_bytes > self.max_bytes)
+            or (self.spill_dir and self.spill_max_bytes and self.disk_bytes > self.spill_max_bytes)
+        )
+
+    def _enforce_budgets(self, session: UserSession) -> list:
+        """Evict least recently used motions until the count and byte limits hold"""
+        evicted = []
+        while len(session.motions) > 1 and (
+            len(session.motions) > Config.MAX_STORED_MOTIONS_PER_USER
+            or (self.session_max_bytes and session.motion_bytes > self.session_max_bytes)
+        ):
+            oldest_id = next(iter(session.motions))
+            evicted.append(self._drop(session, oldest_id))
+            self.evictions += 1
+            logger.info(f"Removed least recently used motion {oldest_id} for session {session.session_id}")
+        while len(self._lru) > 1 and self._over_budget():
+            session_id, oldest_id = next(iter(self._lru))
+            evicted.append(self._drop(self.sessions[session_id], oldest_id))
+            self.evictions += 1
+            logger.info(f"Evicted motion {oldest_id} of session {session_id} (store over budget)")
+        return [path for path in evicted if path]
+
+    async def add_motion(self, session: UserSession, motion_id: str, motion: dict) -> None:
+        async with session.lock:
+            stale_files = await self._add_motion(session, motion_id, motion)
+        if self.spill_dir and self.sessions.get(session.session_id) is not session:
+            # Expired while the motion was being written
+            await asyncio.to_thread(self._remove_spill_dirs, [session.session_id])
+        elif stale_files:
+            await asyncio.to_thread(self._remove_files, stale_files)
+
+    async def _add_motion(self, session: UserSession, motion_id: str, motion: dict) -> list:
+        entry = StoredMotion(
+            meta={k: v for k, v in motion.items() if k not in MOTION_ARRAY_FIELDS},
+            raw_bytes=sum(motion[k].nbytes for k in MOTION_ARRAY_FIELDS),
+            nbytes=0,
+        )
+        if self.spill_dir:
+            # Spill files stay uncompressed so that reads can map them
+            entry.path = self._spill_path(session.session_id, motion_id)
+            entry.nbytes = await conversion_pool.run(write_motion_file, entry.path, motion)
+        else:
+            entry.payload = await conversion_pool.run(pack_motion, motion, self.compression)
+            entry.nbytes = len(entry.payload)
+        if self.sessions.get(session.session_id) is not session:
+            return []  # expired while the motion was being packed
+        if motion_id in session.motions:
+            self._drop(session, motion_id)  # same path, already replaced on disk
+        session.motions[motion_id] = entry
+        self._lru[(session.session_id, motion_id)] = None
+        session.motion_bytes += entry.nbytes
+        self.raw_motion_bytes += entry.raw_bytes
+        if entry.path is None:
+            self.motion_bytes += entry.nbytes
+        else:
+            self.disk_bytes += entry.nbytes
+        return self._enforce_budgets(session)
+
+    def _touch(self, session: UserSession, motion_id: str) -> Optional[StoredMotion]:
+        entry = session.motions.get(motion_id)
+        if entry is not None:
+            session.motions.move_to_end(motion_id)
+            self._lru.move_to_end((session.session_id, motion_id))
+        return entry
+
+    async def has_motion(self, session: UserSession, motion_id: str) -> bool:
+        return motion_id in session.motions
+
+    def motion_file(self, session: UserSession, motion_id: str) -> Optional[str]:
+        """Path of a spilled motion's binary payload (None when held in memory)"""
+        entry = self._touch(session, motion_id)
+        return entry.path if entry is not None else None
+
+    async def get_motion(self, session: UserSession, motion_id: str) -> Optional[dict]:
+        entry = self._touch(session, motion_id)
+        if entry is None:
+            return None
+        if entry.path is not None:
+            try:
+                arrays = await asyncio.to_thread(map_motion_file, entry.path)
+            except FileNotFoundError:
+                return None  # evicted meanwhile
+        elif entry.payload[:4] == MOTION_BINARY_MAGIC:
+            arrays = decode_motion_binary(entry.payload)[1]  # zero-copy views
+        else:
+            arrays = (await conversion_pool.run(unpack_motion, entry.payload))[1]
+        return {**entry.meta, **arrays}
+
+    async def list_motions(self, session: UserSession) -> list:
+        return [summarize_motion(mid, entry.meta) for mid, entry in session.motions.items()]
+
+    async def delete_motion(self, session: UserSession, motion_id: str) -> bool:
+        async with session.lock:
+            if motion_id not in session.motions:
+                return False
+            path = self._drop(session, motion_id)
+            if path:
+                await asyncio.to_thread(self._remove_files, [path])
+        return True
+
+    async def clear_motions(self, session: UserSession) -> int:
+        async with session.lock:
+            count = len(session.motions)
+            paths = [self._drop(session, motion_id) for motion_id in list(session.motions)]
+            paths = [path for path in paths if path]
+            if paths:
+                await asyncio.to_thread(self._remove_files, paths)
+        return count
+
+    async def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "sessions": len(self.sessions),
+            "motions": len(self._lru),
+            "motion_bytes": self.motion_bytes,
+            "raw_motion_bytes": self.raw_motion_bytes,
+            "max_bytes": self.max_bytes,
+            "session_max_bytes": self.session_max_bytes,
+            "compression": self.compression,
+            "evictions": self.evictions,
+            "spill_dir": self.spill_dir or None,
+            "disk_bytes": self.disk_bytes,
+            "spill_max_bytes": self.spill_max_bytes,
+        }
+
+
+class SQLiteSessionStore:
+    """
+    Session and motion store in a local SQLite database (WAL mode)
+    
+    Lets several uvicorn workers on one host serve the same sessions (jobs and
+    batches stay per process, so their APIs are refused then). Session
+    metadata and a small per-motion index live in plain columns; motion arrays
+    are stored as a packed payload (`pack_motion`) next to a JSON blob with the
+    remaining metadata. Calls run in a worker thread so the event loop is not
+    blocked on disk I/O; expiry and the per-session motion limit are enforced in
+    SQL and therefore hold across workers. The in-memory byte budgets do not
+    apply here, since motions live on disk.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        created_at REAL NOT NULL,
+        last_activity REAL NOT NULL,
+        client_fingerprint TEXT NOT NULL DEFAULT '',
+        rate_tokens REAL NOT NULL,
+        rate_updated REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS sessions_last_activity ON sessions(last_activity);
+    CREATE INDEX IF NOT EXISTS sessions_created_at ON sessions(created_at);
+    CREATE TABLE IF NOT EXISTS motions (
+        motion_id TEXT PRIMARY KEY,
+        session_id TEXT NOT NULL REFERENCES sessions(session_id) ON DELETE CASCADE,
+        created_at TEXT NOT NULL,
+        name TEXT NOT NULL,
+        frame_count INTEGER NOT NULL,
+        duration REAL NOT NULL,
+        text_prompt TEXT NOT NULL,
+        meta TEXT NOT NULL,
+        payload BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS motions_session ON motions(session_id, created_at);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.compression = resolve_motion_compression(Config.MOTION_STORE_COMPRESSION)
+
+    def open(self) -> None:
+        """Connect and create the schema (at startup, not import: pool workers import this module too)"""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _call(self, fn, *args):
+        return await asyncio.to_thread(self._locked, fn, *args)
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            return fn(*args)
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE takes the write lock up front so workers do not interleave"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _row_to_session(row) -> UserSession:
+        return UserSession(
+            session_id=row[0],
+            created_at=datetime.fromtimestamp(row[1]),
+            last_activity=datetime.fromtimestamp(row[2]),
+            client_fingerprint=row[3],
+        )
+
+    def _get_or_create_session(self, session_id: Optional[str], client_fingerprint: str) -> UserSession:
+        now = time.time()
+        with self._transaction() as conn:
+            if session_id:
+                row = conn.execute(
+                    "SELECT session_id, created_at, last_activity, client_fingerprint "
+                    "FROM sessions WHERE session_id = ?",
+                    (session_id,)
+                ).fetchone()
+                if row is not None:
+                    session = self._row_to_session(row)
+                    if session.client_fingerprint and session.client_fingerprint != client_fingerprint:
+                        if not Config.ALLOW_SESSION_REBIND:
+                            raise PermissionError("Session fingerprint mismatch")
+                        session.client_fingerprint = client_fingerprint
+                        logger.info(f"Session {session_id} rebound to new client")
+                    conn.execute(
+                        "UPDATE sessions SET last_activity = ?, client_fingerprint = ? WHERE session_id = ?",
+                        (now, session.client_fingerprint, session_id)
+                    )
+                    session.last_activity = datetime.fromtimestamp(now)
+                    return session
+
+            # Create new session
+            new_session_id = str(uuid.uuid4())
+            conn.execute(
+                "INSERT INTO sessions (session_id, created_at, last_activity, client_fingerprint, "
+                "rate_tokens, rate_updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (new_session_id, now, now, client_fingerprint, float(Config.RATE_LIMIT_BURST), now)
+            )
+        logger.info(f"Created new session: {new_session_id}")
+        created = datetime.fromtimestamp(now)
+        return UserSession(
+            session_id=new_session_id,
+            created_at=created,
+            last_activity=created,
+            client_fingerprint=client_fingerprint
+        )
+
+    async def get_or_create_session(self, session_id: Optional[str], client_fingerprint: str) -> UserSession:
+        return await self._call(self._get_or_create_session, session_id, client_fingerprint)
+
+    def _cleanup_expired_batch(self, now: float) -> list:
+        # Both conditions are answered from an index, so only expired rows are read
+        with self._transaction() as conn:
+            expired = [row[0] for row in conn.execute(
+                "SELECT session_id FROM sessions WHERE last_activity < ? OR created_at < ? LIMIT ?",
+                (now - Config.DATA_RETENTION_MINUTES * 60, now - Config.SESSION_MAX_AGE_HOURS * 3600,
+                 CLEANUP_BATCH_SIZE)
+            )]
+            conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(sid,) for sid in expired])
+        for session_id in expired:
+            logger.info(f"Cleaned up expired session: {session_id}")
+        return expired
+
+    def _cleanup_expired_sessions(self) -> int:
+        # One short write transaction per batch, so other workers are not blocked for long
+        now = time.time()
+        count = 0
+        while True:
+            expired = self._locked(self._cleanup_expired_batch, now)
+            count += len(expired)
+            if len(expired) < CLEANUP_BATCH_SIZE:
+                return count
+
+    async def cleanup_expired_sessions(self) -> int:
+        """Remove expired sessions and (by cascade) their motions"""
+        return await asyncio.to_thread(self._cleanup_expired_sessions)
+
+    def _check_rate_limit(self, session_id: str) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT rate_tokens, rate_updated FROM sessions WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            allowed, tokens = token_bucket_take(
+                row[0], row[1], now,
+                rate=Config.MAX_REQUESTS_PER_MINUTE / 60.0,
+                capacity=float(Config.RATE_LIMIT_BURST)
+            )
+            conn.execute(
+                "UPDATE sessions SET rate_tokens = ?, rate_updated = ? WHERE session_id = ?",
+                (tokens, now, session_id)
+            )
+            return allowed
+
+    async def check_rate_limit(self, session: UserSession) -> bool:
+        """Check if user has exceeded rate limit (counted across workers)"""
+        return await self._call(self._check_rate_limit, session.session_id)
+
+    def _add_motion(self, session_id: str, motion_id: str, meta: dict, payload: bytes) -> None:
+        with self._transaction() as conn:
+            # Enforce maximum number of stored motions per user (oldest first)
+            stale = conn.execute(
+                "SELECT motion_id FROM motions WHERE session_id = ? ORDER BY created_at DESC LIMIT -1 OFFSET ?",
+                (session_id, max(0, Config.MAX_STORED_MOTIONS_PER_USER - 1))
+            ).fetchall()
+            for (stale_id,) in stale:
+                conn.execute("DELETE FROM motions WHERE motion_id = ?", (stale_id,))
+                logger.info(f"Removed oldest motion {stale_id} for session {session_id}")
+            conn.execute(
+                "INSERT OR REPLACE INTO motions (motion_id, session_id, created_at, name, frame_count, "
+                "duration, text_prompt, meta, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (motion_id, session_id, meta.get("created_at", ""), meta.get("name", "Unknown"),
+                 meta.get("frame_count", 0), meta.get("duration", 0.0), meta.get("text_prompt", ""),
+                 json.dumps(meta), payload)
+            )
+
+    async def add_motion(self, session: UserSession, motion_id: str, motion: dict) -> None:
+        meta = {k: v for k, v in motion.items() if k not in MOTION_ARRAY_FIELDS}
+        payload = await conversion_pool.run(pack_motion, motion, self.compression)
+        await self._call(self._add_motion, session.session_id, motion_id, meta, payload)
+
+    def _get_motion(self, session_id: str, motion_id: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT meta, payload FROM motions WHERE session_id = ? AND motion_id = ?",
+            (session_id, motion_id)
+        ).fetchone()
+        if row is None:
+            return None
+        motion = json.loads(row[0])
+        motion.update(unpack_motion(row[1])[1])
+        return motion
+
+    async def get_motion(self, session: UserSession, motion_id: str) -> Optional[dict]:
+        return await self._call(self._get_motion, session.session_id, motion_id)
+
+    async def has_motion(self, session: UserSession, motion_id: str) -> bool:
+        return await self._call(lambda: self._conn.execute(
+            "SELECT 1 FROM motions WHERE session_id = ? AND motion_id = ?",
+            (session.session_id, motion_id)
+        ).fetchone() is not None)
+
+    def motion_file(self, session: UserSession, motion_id: str) -> Optional[str]:
+        return None
+
+    async def list_motions(self, session: UserSession) -> list:
+        rows = await self._call(lambda: self._conn.execute(
+            "SELECT motion_id, name, frame_count, duration, created_at, text_prompt "
+            "FROM motions WHERE session_id = ?",
+            (session.session_id,)
+        ).fetchall())
+        return [
+            summarize_motion(row[0], {
+                "name": row[1], "frame_count": row[2], "duration": row[3],
+                "created_at": row[4], "text_prompt": row[5]
+            })
+            for row in rows
+        ]
+
+    async def delete_motion(self, session: UserSession, motion_id: str) -> bool:
+        cursor = await self._call(
+            self._conn.execute,
+            "DELETE FROM motions WHERE session_id = ? AND motion_id = ?",
+            (session.session_id, motion_id)
+        )
+        return cursor.rowcount > 0
+
+    async def clear_motions(self, session: UserSession) -> int:
+        cursor = await self._call(
+            self._conn.execute,
+            "DELETE FROM motions WHERE session_id = ?",
+            (session.session_id,)
+        )
+        return cursor.rowcount
+
+    async def stats(self) -> dict:
+        sessions, motions, motion_bytes = await self._call(lambda: (
+            self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            *self._conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM motions").fetchone(),
+        ))
+        return {"backend": "sqlite", "path": self.path, "sessions": sessions,
+                "motions": motions, "motion_bytes": motion_bytes}
+
+
+def create_session_store():
+    if Config.SESSION_STORE == "sqlite":
+        return SQLiteSessionStore(Config.SESSION_STORE_PATH)
+    if Config.SESSION_STORE != "memory":
+        raise ValueError(f"Unknown SESSION_STORE: {Config.SESSION_STORE}")
+    return MemorySessionStore()
+
+
+class AppState:
+    """Application state manager"""
+    def __init__(self):
+        self.store = create_session_store()
+        self.cleanup_task: Optional[asyncio.Task] = None
+        self.ip_rate = TokenBucketLimiter(
+            per_minute=Config.MAX_REQUESTS_PER_MINUTE_PER_IP,
+            capacity=Config.RATE_LIMIT_BURST_PER_IP,
+            max_keys=Config.RATE_LIMIT_MAX_KEYS,
+        )
+        # Generation seconds per session (counted per worker process)
+        self.generation_quota = TokenBucketLimiter(
+            per_minute=Config.GENERATION_SECONDS_PER_MINUTE,
+            capacity=Config.GENERATION_SECONDS_BURST,
+            max_keys=Config.RATE_LIMIT_MAX_KEYS,
+        ) if Config.GENERATION_SECONDS_PER_MINUTE > 0 else None
+
+    async def get_or_create_session(self, session_id: Optional[str], client_fingerprint: str) -> UserSession:
+        """Get existing session or create new one"""
+        return await self.store.get_or_create_session(session_id, client_fingerprint)
+    
+    async def cleanup_expired_sessions(self):
+        """Remove expired sessions and their data"""
+        return await self.store.cleanup_expired_sessions()
+    
+    async def check_rate_limit(self, session: UserSession) -> bool:
+        """Check if user has exceeded rate limit"""
+        return await self.store.check_rate_limit(session)
+
+    async def check_ip_rate_limit(self, client_ip: str) -> bool:
+        """Per-IP limit (counted per worker process)"""
+        return self.ip_rate.allow(client_ip)
+
+    def take_generation_seconds(self, session_id: str, seconds: float) -> float:
+        """
+        Charge predicted generation seconds to a session's quota
+        
+        Returns 0 when granted, else the seconds to wait before retrying. A request
+        costing more than the whole burst is granted once the bucket is full.
+        """
+        quota = self.generation_quota
+        if quota is None:
+            return 0.0
+        seconds = min(seconds, quota.capacity)
+        if quota.allow(session_id, cost=seconds):
+            return 0.0
+        return quota.retry_after(session_id, seconds)
+
+
+class GenerationCostModel:
+    """
+    Online model of remote generation time
+    
+    seconds ~ w0 + w1 * steps / 10 + w2 * steps * motion_length / 40, with the
+    per-item terms summed over the requests of a batch: diffusion time grows with
+    the denoising steps and the number of frames. Micro-batched exchanges are
+    fitted separately (one per-exchange intercept plus their own per-item
+    weights), since batch items share the denoising passes and cost far less
+    than the same requests sent alone. Each fit is an exponentially weighted
+    least-squares fit of observed service times, so it follows backend changes;
+    a ridge term pulls it towards GENERATION_COST_PRIOR_SECONDS (for a 4 s,
+    10-step request) and keeps it stable while all requests look alike.
+    """
+
+    def __init__(self, prior_seconds: float, forgetting: float = 0.99, ridge: float = 1.0):
+        self.prior = np.array([0.0, 0.0, prior_seconds])
+        self.forgetting = forgetting
+        self.ridge = ridge * np.eye(3)
+        # Keyed by whether the exchange is a micro-batch
+        self._xtx = {False: np.zeros((3, 3)), True: np.zeros((3, 3))}
+        self._xty = {False: np.zeros(3), True: np.zeros(3)}
+        self.weights = {False: self.prior.copy(), True: self.prior.copy()}
+        self.observations = {False: 0, True: 0}
+        self.error_ewma: Optional[float] = None
+
+    @staticmethod
+    def features(requests: list) -> np.ndarray:
+        x = np.array([1.0, 0.0, 0.0])
+        for request in requests:
+            steps = float(request.get("num_inference_steps", 10))
+            x[1:] += (steps / 10.0, steps * float(request.get("motion_length", 4.0)) / 40.0)
+        return x
+
+    @staticmethod
+    def requests_of(payload: dict) -> list:
+        return payload["batch"] if "batch" in payload else [payload]
+
+    def predict(self, payload: dict) -> float:
+        """Predicted seconds of a remote request (single or batched)"""
+        batched = "batch" in payload
+        return max(0.01, float(self.features(self.requests_of(payload)) @ self.weights[batched]))
+
+    def observe(self, payload: dict, seconds: float) -> None:
+        batched = "batch" in payload
+        x = self.features(self.requests_of(payload))
+        predicted = max(0.01, float(x @ self.weights[batched]))
+        error = abs(predicted - seconds) / max(seconds, 0.01)
+        self.error_ewma = error if self.error_ewma is None else 0.9 * self.error_ewma + 0.1 * error
+        self._xtx[batched] = self.forgetting * self._xtx[batched] + np.outer(x, x)
+        self._xty[batched] = self.forgetting * self._xty[batched] + x * seconds
+        self.weights[batched] = np.linalg.solve(self._xtx[batched] + self.ridge,
+                                                self._xty[batched] + self.ridge @ self.prior)
+        self.observations[batched] += 1
+
+    def stats(self) -> dict:
+        return {
+            "observations": self.observations[False],
+            "batch_observations": self.observations[True],
+            "weights": [round(float(w), 4) for w in self.weights[False]],
+            "batch_weights": [round(float(w), 4) for w in self.weights[True]],
+            "relative_error_ewma": self.error_ewma,
+            "reference_seconds": round(self.predict({"motion_length": 4.0, "num_inference_steps": 10}), 3),
+        }
+
+
+@dataclass
+class GenerationTicket:
+    """A request waiting for (or holding) a remote generation slot"""
+    session_id: str
+    priority: int
+    future: asyncio.Future
+    enqueued_at: float
+    jobs: tuple = ()
+    cost: float = 0.0  # predicted seconds of generation
+
+
+# Jobs on whose behalf the current task generates (a batch carries several)
+current_jobs: ContextVar[tuple] = ContextVar("current_jobs", default=())
+
+
+class GenerationScheduler:
+    """
+    Fair, session-aware scheduler for remote generation slots
+    
+    At most `concurrency` generations run at once (0 = unlimited). Waiting
+    requests are grouped by priority (higher first); within a priority each
+    session has its own FIFO and sessions are served round-robin, so one
+    session cannot monopolize the generator by submitting many requests.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.active = 0
+        # priority -> session_id -> queued tickets; dict order is the round-robin order
+        self._levels: Dict[int, "OrderedDict[str, Deque[GenerationTicket]]"] = {}
+        self.queued = 0
+        # Predicted generation seconds waiting, and (cost, start) of running generations
+        self.queued_cost = 0.0
+        self._running: Dict[object, Tuple[float, float]] = {}
+        self.service_ewma: Optional[float] = None
+        self.dispatched = 0
+        self.cancelled = 0
+
+    def has_capacity(self) -> bool:
+        return self.concurrency <= 0 or self.active < self.concurrency
+
+    def resize(self, concurrency: int) -> None:
+        """Change the number of slots (e.g. when backends are ejected or re-admitted)"""
+        self.concurrency = concurrency
+        self._dispatch()
+
+    async def acquire(self, session_id: str, priority: int = 0, cost: float = 0.0) -> None:
+        """Wait for a generation slot"""
+        if self.queued == 0 and self.has_capacity():
+            self.active += 1
+            self.dispatched += 1
+            return
+        ticket = GenerationTicket(
+            session_id=session_id,
+            priority=priority,
+            future=asyncio.get_running_loop().create_future(),
+            enqueued_at=time.monotonic(),
+            jobs=current_jobs.get(),
+            cost=cost,
+        )
+        self._levels.setdefault(priority, OrderedDict()).setdefault(session_id, deque()).append(ticket)
+        self.queued += 1
+        self.queued_cost += cost
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+                # The slot was granted just before the waiter went away
+                self.release()
+            else:
+                self._remove(ticket)
+                self.cancelled += 1
+            raise
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        """Free a slot, optionally recording how long the generation took"""
+        self.active -= 1
+        if service_time is not None:
+            if self.service_ewma is None:
+                self.service_ewma = service_time
+            else:
+                self.service_ewma = 0.8 * self.service_ewma + 0.2 * service_time
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, session_id: str, priority: int = 0, cost: float = 0.0):
+        start = time.monotonic()
+        await self.acquire(session_id, priority, cost)
+        gateway_metrics.observe("queue_wait", time.monotonic() - start)
+        for job in current_jobs.get():
+            job.update("running")
+        start = time.monotonic()
+        token = object()
+        self._running[token] = (cost, start)
+        completed = False
+        try:
+            yield
+            completed = True
+        finally:
+            del self._running[token]
+            self.release(time.monotonic() - start if completed else None)
+
+    def _dispatch(self) -> None:
+        while self.queued and self.has_capacity():
+            ticket = self._pop_next()
+            if ticket.future.done():
+                # Waiter cancelled, its clean-up in `acquire` has not run yet
+                continue
+            self.active += 1
+            self.dispatched += 1
+            ticket.future.set_result(None)
+
+    def _pop_next(self) -> GenerationTicket:
+        priority = max(self._levels)
+        sessions = self._levels[priority]
+        session_id, queue = next(iter(sessions.items()))
+        ticket = queue.popleft()
+        sessions.move_to_end(session_id)
+        if not queue:
+            del sessions[session_id]
+        if not sessions:
+            del self._levels[priority]
+        self.queued -= 1
+        self.queued_cost -= ticket.cost
+        return ticket
+
+    def _remove(self, ticket: GenerationTicket) -> None:
+        sessions = self._levels.get(ticket.priority)
+        queue = sessions.get(ticket.session_id) if sessions else None
+        if not queue or ticket not in queue:
+            return
+        queue.remove(ticket)
+        self.queued -= 1
+        self.queued_cost -= ticket.cost
+        if not queue:
+            del sessions[ticket.session_id]
+        if not sessions:
+            del self._levels[ticket.priority]
+
+    def _dispatch_order(self):
+        """Yield queued tickets in the order they would be dispatched"""
+        for priority in sorted(self._levels, reverse=True):
+            queues = list(self._levels[priority].values())
+            depth = max(len(q) for q in queues)
+            for i in range(depth):
+                for queue in queues:
+                    if i < len(queue):
+                        yield queue[i]
+
+    def job_position(self, job: GenerationJob) -> Optional[int]:
+        """Queue position (0-based) of a job's generation, None when it is not queued"""
+        for position, ticket in enumerate(self._dispatch_order()):
+            if job in ticket.jobs:
+                return position
+        return None
+
+    def predicted_wait(self) -> float:
+        """
+        Predicted seconds before a request queued now starts: the predicted cost of
+        everything queued plus what is left of the running generations, spread
+        over the slots (an upper bound, as fair sharing may serve it earlier)
+        """
+        if self.queued == 0 and self.has_capacity():
+            return 0.0
+        now = time.monotonic()
+        remaining = sum(max(0.0, cost - (now - start)) for cost, start in self._running.values())
+        slots = self.concurrency if self.concurrency > 0 else max(1, self.active)
+        return max(0.0, self.queued_cost + remaining) / slots
+
+    def estimate_wait(self, position: int) -> Optional[float]:
+        """Estimated seconds until the request at `position` (0-based) starts"""
+        if self.service_ewma is None:
+            return None
+        slots = self.concurrency if self.concurrency > 0 else max(1, self.active)
+        return (position // slots + 1) * self.service_ewma
+
+    def session_status(self, session_id: str) -> dict:
+        now = time.monotonic()
+        waiting = []
+        for position, ticket in enumerate(self._dispatch_order()):
+            if ticket.session_id == session_id:
+                waiting.append({
+                    "position": position,
+                    "priority": ticket.priority,
+                    "waited_seconds": round(now - ticket.enqueued_at, 3),
+                    "estimated_wait_seconds": self.estimate_wait(position),
+                })
+        return {
+            "queued": waiting,
+            "queue_length": self.queued,
+            "active": self.active,
+            "concurrency": self.concurrency,
+            "estimated_wait_seconds": self.estimate_wait(self.queued) if self.queued or not self.has_capacity() else 0.0,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "concurrency": self.concurrency,
+            "dispatched": self.dispatched,
+            "cancelled": self.cancelled,
+            "service_ewma_seconds": self.service_ewma,
+            "predicted_wait_seconds": round(self.predicted_wait(), 3),
+        }
+
+
+app_state = AppState()
+generation_scheduler = GenerationScheduler(concurrency=Config.REMOTE_CONCURRENCY)
+generation_cost_model = GenerationCostModel(prior_seconds=Config.GENERATION_COST_PRIOR_SECONDS)
+
+
+def get_client_ip(http_request: Request) -> str:
+    if Config.TRUST_PROXY_HEADERS:
+        xff = http_request.headers.get("x-forwarded-for", "").strip()
+        if xff:
+            return xff.split(",")[0].strip()
+    return (http_request.client.host if http_request.client else "unknown")
+
+
+def get_client_fingerprint(http_request: Request) -> str:
+    client_ip = get_client_ip(http_request)
+    user_agent = http_request.headers.get("user-agent", "")
+    raw = f"{client_ip}|{user_agent}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def require_allowed_origin(http_request: Request) -> None:
+    if not Config.STRICT_ORIGIN_CHECK:
+        return
+    if not Config.ALLOWED_ORIGINS:
+        raise HTTPException(
+            status_code=500,
+            detail={"error": "Server misconfigured: ALLOWED_ORIGINS is empty", "code": "SERVER_CONFIG_ERROR"}
+        )
+    origin = (http_request.headers.get("origin") or "").strip().rstrip("/")
+    if not origin or origin not in Config.ALLOWED_ORIGINS:
+        raise HTTPException(
+            status_code=403,
+            detail={"error": "Origin not allowed", "code": "ORIGIN_FORBIDDEN"}
+        )
+
+
+def _is_valid_session_id(s: Optional[str]) -> bool:
+    """Accept only UUID-format session_id."""
+    if not s or not isinstance(s, str) or len(s) > 64:
+        return False
+    try:
+        uuid.UUID(s)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+async def get_bound_session(http_request: Request, allow_create: bool) -> UserSession:
+    session_id_raw = http_request.headers.get("X-Session-ID")
+    session_id = (session_id_raw or "").strip() or None
+    if session_id and not _is_valid_session_id(session_id):
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "Invalid X-Session-ID format", "code": "INVALID_SESSION_ID"}
+        )
+    fingerprint = get_client_fingerprint(http_request)
+    if not session_id and Config.REQUIRE_SESSION_FOR_API and not allow_create:
+        raise HTTPException(
+            status_code=401,
+            detail={"error": "Missing X-Session-ID", "code": "SESSION_REQUIRED"}
+        )
+    try:
+        if allow_create:
+            return await app_state.get_or_create_session(session_id=session_id, client_fingerprint=fingerprint)
+        if not session_id:
+            raise HTTPException(
+                status_code=401,
+                detail={"error": "Missing X-Session-ID", "code": "SESSION_REQUIRED"}
+            )
+        return await app_state.get_or_create_session(session_id=session_id, client_fingerprint=fingerprint)
+    except PermissionError:
+        raise HTTPException(
+            status_code=403,
+            detail={"error": "Session does not belong to this client", "code": "SESSION_FORBIDDEN"}
+        )
+
+
+# ==================== Background Tasks ====================
+
+async def periodic_cleanup():
+    """Periodically clean up expired sessions"""
+    while True:
+        try:
+            await asyncio.sleep(Config.CLEANUP_INTERVAL_MINUTES * 60)
+            await app_state.cleanup_expired_sessions()
+            generation_jobs.prune()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Cleanup error: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application lifespan manager"""
+    # Startup
+    logger.info("Starting Text-to-Motion API Gateway")
+    if Config.WEB_CONCURRENCY > 1:
+        logger.warning(f"WEB_CONCURRENCY={Config.WEB_CONCURRENCY}: /api/jobs and /api/batches are disabled "
+                       f"(jobs are held per worker process); run one worker to enable them")
+    app_state.store.open()
+    generation_cache.open()
+    prompt_index.open()
+    app_state.cleanup_task = asyncio.create_task(periodic_cleanup())
+    if Config.REMOTE_HEALTH_INTERVAL > 0:
+        remote_backends.probe_task = asyncio.create_task(remote_backends.probe_loop())
+    yield
+    # Shutdown
+    logger.info("Shutting down Text-to-Motion API Gateway")
+    if app_state.cleanup_task:
+        app_state.cleanup_task.cancel()
+        try:
+            await app_state.cleanup_task
+        except asyncio.CancelledError:
+            pass
+    if remote_backends.probe_task:
+        remote_backends.probe_task.cancel()
+        try:
+            await remote_backends.probe_task
+        except asyncio.CancelledError:
+            pass
+    await generation_jobs.shutdown()
+    await remote_backends.close()
+    conversion_pool.shutdown()
+    prompt_index.close()
+    app_state.store.close()
+
+
+# ==================== FastAPI App ====================
+
+app = FastAPI(
+    title="Text-to-Motion API Gateway",
+    description="Bridge service between browser frontend and remote motion generation server",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+# API Key middleware: when API_KEY is set, all non-OPTIONS requests must send Authorization: Bearer <API_KEY>
+class APIKeyMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        if not Config.API_KEY:
+            return await call_next(request)
+        if request.method == "OPTIONS":
+            return await call_next(request)
+        auth = request.headers.get("Authorization") or ""
+        if not auth.startswith("Bearer "):
+            return JSONResponse(
+                status_code=401,
+                content={"error": "Missing or invalid Authorization header", "code": "UNAUTHORIZED"},
+            )
+        token = auth[7:].strip()
+        if token != Config.API_KEY:
+            return JSONResponse(
+                status_code=401,
+                content={"error": "Invalid API key", "code": "UNAUTHORIZED"},
+            )
+        return await call_next(request)
+
+
+app.add_middleware(APIKeyMiddleware)
+
+# CORS: with allow_credentials=True, allow_origins cannot be "*"; set explicit origins.
+_origins = list(Config.ALLOWED_ORIGINS) if Config.ALLOWED_ORIGINS else []
+if "*" in _origins and len(_origins) == 1:
+    logger.warning("ALLOWED_ORIGINS=* is incompatible with credentials; CORS will allow no origins. Set explicit origins.")
+    _origins = []
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=_origins,
+    allow_credentials=True,
+    allow_methods=["GET", "POST", "DELETE", "OPTIONS"],
+    allow_headers=["Content-Type", "X-Session-ID", "Authorization"],
+    expose_headers=["X-Motion-ID", "ETag", "Retry-After", "X-Motion-Fallback", "X-Motion-Full", "Location"],
+)
+
+
+# ==================== Helper Functions ====================
+
+# Array fields of a stored motion, in the order they are laid out in binary payloads
+MOTION_ARRAY_FIELDS = ('joint_pos', 'root_pos', 'root_quat')
+
+# Binary motion transport (opt-in via `Accept` header or `?format=binary`)
+MOTION_BINARY_MEDIA_TYPE = "application/x-motion-binary"
+MOTION_BINARY_MAGIC = b"MOTN"
+MOTION_BINARY_VERSION = 1
+# Metadata fields copied into the binary header
+MOTION_BINARY_META_FIELDS = ('motion_id', 'name', 'fps', 'frame_count', 'duration', 'created_at', 'text_prompt',
+                             'start_frame', 'source_fps', 'source_frame_count')
+
+
+def convert_npz_to_motion_data(npz_bytes: bytes, motion_name: str) -> dict:
+    """
+    Convert NPZ binary data to a motion record
+    
+    The input NPZ contains (38D format):
+    - fps: (1,) int32
+    - joint_pos: (T, 29) float32 [Isaac order]
+    - root_pos: (T, 3) float32
+    - root_rot: (T, 4) float32 [w, x, y, z]
+    
+    Output format matches what TrackingHelper expects, with the arrays kept as
+    contiguous float32 numpy arrays (see `MotionJSONResponse` / `encode_motion_binary`):
+    - joint_pos: (T frames x 29 joints)
+    - root_pos: (T, 3) [x, y, z]
+    - root_quat: (T, 4) [w, x, y, z]
+    """
+    data = np.load(io.BytesIO(npz_bytes))
+    
+    fps = int(data['fps'][0]) if isinstance(data['fps'], np.ndarray) else int(data['fps'])
+    joint_pos = np.ascontiguousarray(data['joint_pos'], dtype=np.float32)
+    root_pos = np.ascontiguousarray(data['root_pos'], dtype=np.float32)
+    root_rot = np.ascontiguousarray(data['root_rot'], dtype=np.float32)  # [w, x, y, z]
+    
+    frame_count = joint_pos.shape[0]
+    duration = frame_count / fps
+    
+    motion_data = {
+        'name': motion_name,
+        'fps': float(fps),
+        'joint_pos': joint_pos,
+        'root_pos': root_pos,
+        'root_quat': root_rot,  # Already in wxyz format
+        'frame_count': frame_count,
+        'duration': duration,
+        'created_at': datetime.now().isoformat()
+    }
+    
+    return motion_data
+
+
+def convert_motion_chunk(npz_bytes: bytes) -> Optional[Tuple[bytes, int]]:
+    """
+    Binary motion payload and frame count of a streamed chunk, or None when
+    `npz_bytes` is the final (complete) result
+    
+    A streaming generator (health endpoint advertises `"streaming": true`, request
+    has `"stream": true`) sends chunks before the result: NPZ files laid out like a
+    result for frames [start_frame, start_frame + T) plus a `start_frame` entry.
+    Progressive previews resend earlier frames.
+    """
+    with np.load(io.BytesIO(npz_bytes)) as data:
+        if 'start_frame' not in data.files:
+            return None
+        start_frame = int(np.asarray(data['start_frame']).reshape(-1)[0])
+    motion = convert_npz_to_motion_data(npz_bytes, "")
+    motion['start_frame'] = start_frame
+    return encode_motion_binary(motion), motion['frame_count']
+
+
+def slerp(q0: np.ndarray, q1: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """Row-wise spherical interpolation of unit quaternions (shortest arc)"""
+    dot = np.sum(q0 * q1, axis=1)
+    q1 = np.where((dot < 0)[:, None], -q1, q1)
+    dot = np.clip(np.abs(dot), 0.0, 1.0)
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    t = t[:, None]
+    # Nearly identical rotations: linear interpolation avoids dividing by ~0
+    close = (sin_theta < 1e-6)[:, None]
+    safe = np.where(close[:, 0], 1.0, sin_theta)[:, None]
+    w0 = np.where(close, 1.0 - t, np.sin((1.0 - t) * theta[:, None]) / safe)
+    w1 = np.where(close, t, np.sin(t * theta[:, None]) / safe)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def decimate_motion(motion: dict, fps: float) -> dict:
+    """
+    Resample a motion record to about `fps` frames per second for previews
+    
+    Samples are evenly spaced from the first to the last frame, so the clip keeps
+    its duration and end pose; `fps` becomes the exact resulting rate. Positions
+    are interpolated linearly, root rotations by slerp. Records at or below
+    `fps` are returned unchanged.
+    """
+    frames = motion['frame_count']
+    source_fps = motion['fps']
+    if fps <= 0 or fps >= source_fps or frames < 3:
+        return motion
+    span = frames - 1
+    count = max(2, round(span * fps / source_fps) + 1)
+    positions = np.linspace(0.0, span, count)
+    i0 = np.minimum(positions.astype(np.int64), span - 1)
+    t = positions - i0
+    
+    def lerp(values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float32)
+        return (values[i0] * (1.0 - t)[:, None] + values[i0 + 1] * t[:, None]).astype(np.float32)
+    
+    root_quat = np.asarray(motion['root_quat'], dtype=np.float64)
+    return {
+        **motion,
+        'fps': (count - 1) * source_fps / span,
+        'frame_count': count,
+        'joint_pos': lerp(motion['joint_pos']),
+        'root_pos': lerp(motion['root_pos']),
+        'root_quat': slerp(root_quat[i0], root_quat[i0 + 1], t).astype(np.float32),
+        'source_fps': source_fps,
+        'source_frame_count': frames,
+    }
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class MotionJSONResponse(Response):
+    """
+    JSON response for payloads carrying motion arrays
+    
+    Serializes float32 numpy arrays directly (orjson when installed) instead of
+    going through Pydantic validation and nested Python float lists. Routes
+    returning it keep `response_model` for the OpenAPI schema only.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content  # Already rendered off the event loop (see `conversion_pool`)
+        return render_motion_json(content)
+
+
+def render_motion_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+
+def encode_motion_binary(motion: dict) -> bytes:
+    """
+    Encode a motion record in the binary motion transport format
+    
+    Layout (all integers little-endian):
+    - 4 bytes: magic b"MOTN"
+    - uint32: header length H
+    - H bytes: UTF-8 JSON header, space-padded so the first buffer starts on an
+      8-byte boundary. Contains version, dtype ("<f4"), the motion metadata
+      (fps, frame_count, duration, ...) and an `arrays` list of
+      {name, shape, offset, byte_length}, offsets counted from the start of the payload
+    - the float32 buffers, contiguous and in `MOTION_ARRAY_FIELDS` order
+    
+    A browser can wrap each buffer without copying:
+    `new Float32Array(buf, arr.offset, arr.byte_length / 4)`
+    """
+    arrays = [
+        np.ascontiguousarray(motion[name], dtype='<f4')
+        for name in MOTION_ARRAY_FIELDS
+    ]
+    header = {
+        'version': MOTION_BINARY_VERSION,
+        'dtype': '<f4',
+        **{k: motion[k] for k in MOTION_BINARY_META_FIELDS if k in motion},
+        'arrays': [],
+    }
+    # Offsets depend on the header length, which depends on the offsets; reserve
+    # room by encoding once with placeholder offsets and padding the result.
+    specs = [{'name': n, 'shape': list(a.shape), 'offset': 0, 'byte_length': a.nbytes}
+             for n, a in zip(MOTION_ARRAY_FIELDS, arrays)]
+    header['arrays'] = specs
+    reserve = len(json.dumps(header).encode('utf-8')) + 16 * len(specs)
+    header_len = (8 + reserve + 7) // 8 * 8 - 8
+    offset = 8 + header_len
+    for spec in specs:
+        spec['offset'] = offset
+        offset += spec['byte_length']
+    header_bytes = json.dumps(header).encode('utf-8').ljust(header_len, b' ')
+    
+    return b''.join([
+        MOTION_BINARY_MAGIC,
+        struct.pack('<I', header_len),
+        header_bytes,
+        *(a.tobytes() for a in arrays),
+    ])
+
+
+def decode_motion_binary(payload: bytes) -> Tuple[dict, dict]:
+    """
+    Decode a binary motion payload into (header, arrays)
+    
+    Arrays are read-only float32 views into `payload` (no copy).
+    """
+    if payload[:4] != MOTION_BINARY_MAGIC:
+        raise ValueError("Not a binary motion payload")
+    (header_len,) = struct.unpack_from('<I', payload, 4)
+    header = json.loads(payload[8:8 + header_len])
+    arrays = {
+        spec['name']: np.frombuffer(
+            payload, dtype='<f4', count=spec['byte_length'] // 4, offset=spec['offset']
+        ).reshape(spec['shape'])
+        for spec in header['arrays']
+    }
+    return header, arrays
+
+
+# Leading bytes of a zstd frame; stored payloads are recognised by their magic
+MOTION_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def pack_motion(motion: dict, compression: str = "none") -> bytes:
+    """Binary motion payload of `motion` for storage, optionally compressed"""
+    payload = encode_motion_binary(motion)
+    if compression == "deflate":
+        return zlib.compress(payload, 1)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return payload
+
+
+def write_motion_file(path: str, motion: dict) -> int:
+    """Write `motion` to `path` in the binary motion format; returns its size"""
+    payload = encode_motion_binary(motion)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Replace rather than truncate: readers may still have the old file mapped
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return len(payload)
+
+
+def map_motion_file(path: str) -> dict:
+    """Memory-map a file written by `write_motion_file`; returns arrays viewing the mapping"""
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return decode_motion_binary(mapped)[1]
+
+
+def unpack_motion(blob: bytes) -> Tuple[dict, dict]:
+    """Inverse of `pack_motion`; the codec is recognised from the leading bytes"""
+    if blob[:4] == MOTION_ZSTD_MAGIC:
+        blob = zstandard.ZstdDecompressor().decompress(blob)
+    elif blob[:4] != MOTION_BINARY_MAGIC:
+        blob = zlib.decompress(blob)
+    return decode_motion_binary(blob)
+
+
+def wants_binary_motion(http_request: Request, response_format: Optional[str]) -> bool:
+    """Binary transport is used for `?format=binary` or an Accept header naming it"""
+    if response_format:
+        return response_format == "binary"
+    return MOTION_BINARY_MEDIA_TYPE in (http_request.headers.get("accept") or "")
+
+
+class ConversionPool:
+    """
+    Runs CPU-bound motion conversion and serialization off the event loop
+    
+    While a large clip is decoded or encoded, the loop keeps serving /health,
+    /api/motions and other sessions. Tracks the number of submitted-but-unfinished
+    tasks (queue depth) and the submit-to-completion time of each task.
+    """
+
+    def __init__(self, kind: str, workers: int):
+        self.kind = kind
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+        self.depth = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.latency = Histogram([0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0])
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="motion-conversion"
+                )
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        start = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.depth -= 1
+            self.completed += 1
+            self.latency.observe(time.monotonic() - start)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "queue_depth": self.depth,
+            "max_queue_depth": self.max_depth,
+            "completed": self.completed,
+            "latency_seconds": self.latency.snapshot(),
+        }
+
+
+conversion_pool = ConversionPool(kind=Config.CONVERSION_EXECUTOR, workers=Config.CONVERSION_WORKERS)
+
+
+class RemoteConnectionPool:
+    """
+    Pool of long-lived WebSocket connections to the remote generation server
+
+    Idle connections are kept open (up to `size`) and reused by later requests so
+    that a generation does not pay the TCP + WebSocket handshake every time.
+    Keepalive pings are handled by the websockets client (`ping_interval`); a
+    connection whose pings go unanswered is closed by the library and evicted
+    here the next time it is picked from the idle list.
+    """
+
+    def __init__(self, uri: str, size: int):
+        self.uri = uri
+        self.size = max(0, size)
+        self._idle: Deque[Tuple[Any, float]] = deque()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.in_use = 0
+
+    @staticmethod
+    def _is_open(ws) -> bool:
+        return ws.state is State.OPEN
+
+    async def _open(self):
+        async with gateway_metrics.timed("ws_handshake"):
+            return await websockets.connect(
+                self.uri,
+                max_size=Config.WS_MAX_SIZE,
+                open_timeout=Config.WS_OPEN_TIMEOUT,
+                ping_interval=Config.REMOTE_WS_PING_INTERVAL or None,
+                ping_timeout=Config.REMOTE_WS_PING_TIMEOUT or None,
+            )
+
+    async def acquire(self) -> Tuple[Any, bool]:
+        """Return (connection, reused). Reused connections come from the idle list."""
+        now = time.monotonic()
+        while self._idle:
+            ws, idle_since = self._idle.pop()
+            if self._is_open(ws) and now - idle_since < Config.REMOTE_WS_IDLE_TIMEOUT:
+                self.hits += 1
+                self.in_use += 1
+                return ws, True
+            self.evictions += 1
+            await self._close_quietly(ws)
+        self.misses += 1
+        ws = await self._open()
+        self.in_use += 1
+        return ws, False
+
+    async def release(self, ws, discard: bool = False) -> None:
+        """Return a connection to the pool, or close it if broken / pool is full."""
+        self.in_use -= 1
+        if discard or not self._is_open(ws) or len(self._idle) >= self.size:
+            if discard or not self._is_open(ws):
+                self.evictions += 1
+            await self._close_quietly(ws)
+            return
+        self._idle.append((ws, time.monotonic()))
+
+    def abort(self, ws) -> None:
+        """Drop a connection without the closing handshake (its request was cancelled)"""
+        self.in_use -= 1
+        self.evictions += 1
+        try:
+            ws.transport.abort()
+        except Exception:
+            pass
+
+    @staticmethod
+    async def _close_quietly(ws) -> None:
+        try:
+            await ws.close()
+        except Exception:
+            pass
+
+    async def close(self) -> None:
+        """Close all idle connections (called on shutdown)"""
+        while self._idle:
+            ws, _ = self._idle.pop()
+            await self._close_quietly(ws)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "in_use": self.in_use,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+
+class RemoteBackend:
+    """
+    One remote generation server: its connection pool, load and circuit-breaker state
+    
+    The breaker opens after `REMOTE_CB_FAILURES` consecutive connection-level
+    failures (refused, reset, timeout). While open the backend gets no traffic;
+    after `REMOTE_CB_COOLDOWN` seconds it is half-open and a single trial request
+    or health probe decides whether it is re-admitted.
+    """
+
+    def __init__(self, spec: str):
+        if "://" not in spec:
+            spec = f"ws://{spec}{Config.REMOTE_WS_PATH}"
+        parts = urlsplit(spec)
+        self.name = parts.netloc
+        self.uri = spec
+        http_scheme = "https" if parts.scheme == "wss" else "http"
+        self.health_url = f"{http_scheme}://{parts.netloc}/"
+        self.pool = RemoteConnectionPool(uri=spec, size=Config.REMOTE_WS_POOL_SIZE)
+        # Advertised by the generator's health endpoint; 1 = no batched requests
+        self.max_batch_size = 1
+        self.streaming = False
+        self.outstanding = 0
+        self.latency_ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= Config.REMOTE_CB_COOLDOWN:
+            return "half_open"
+        return "open"
+
+    def available(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.trial_in_progress)
+
+    def record_success(self, latency: Optional[float] = None) -> None:
+        if latency is not None:
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        self.consecutive_failures = 0
+        if self.opened_at is not None:
+            logger.info(f"Backend {self.name} re-admitted")
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == "half_open" or (
+            self.opened_at is None and self.consecutive_failures >= Config.REMOTE_CB_FAILURES
+        ):
+            if self.opened_at is None:
+                self.ejections += 1
+                logger.warning(f"Backend {self.name} ejected after {self.consecutive_failures} failures")
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "latency_ewma_seconds": self.latency_ewma,
+            "max_batch_size": self.max_batch_size,
+            "streaming": self.streaming,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "pool": self.pool.stats(),
+        }
+
+
+class RemoteBackendSet:
+    """Routes generations across remote servers and probes their health endpoints"""
+
+    def __init__(self, specs: list, strategy: str):
+        self.backends = [RemoteBackend(spec) for spec in specs]
+        self.strategy = strategy
+        self.probe_task: Optional[asyncio.Task] = None
+        self._healthy_count = len(self.backends)
+
+    def pick(self, exclude=(), batch_size: int = 1) -> Optional[RemoteBackend]:
+        """Choose a backend by least outstanding requests or latency EWMA"""
+        candidates = [
+            b for b in self.backends
+            if b not in exclude and b.available() and b.max_batch_size >= batch_size
+        ]
+        if not candidates:
+            return None
+        if self.strategy == "ewma":
+            # Unmeasured backends score 0 so they get traffic and a latency estimate
+            key = lambda b: ((b.outstanding + 1) * (b.latency_ewma or 0.0), random.random())
+        else:
+            key = lambda b: (b.outstanding, b.latency_ewma or 0.0, random.random())
+        return min(candidates, key=key)
+
+    def max_batch_size(self) -> int:
+        """Largest batch any currently available backend accepts"""
+        return max((b.max_batch_size for b in self.backends if b.available()), default=1)
+
+    def healthy_count(self) -> int:
+        return sum(1 for b in self.backends if b.state != "open")
+
+    def on_health_change(self) -> None:
+        """Scale scheduler slots with the number of backends that can take work"""
+        healthy = max(1, self.healthy_count())
+        if healthy != self._healthy_count:
+            self._healthy_count = healthy
+            if Config.REMOTE_CONCURRENCY > 0:
+                generation_scheduler.resize(Config.REMOTE_CONCURRENCY * healthy)
+
+    async def probe(self, backend: RemoteBackend) -> None:
+        if backend.state == "open":
+            return  # Wait for the cooldown before probing an ejected backend
+        start = time.monotonic()
+        try:
+            body = await asyncio.to_thread(self._http_get, backend.health_url)
+        except Exception as e:
+            logger.warning(f"Health probe failed for {backend.name}: {e}")
+            backend.record_failure()
+        else:
+            try:
+                info = json.loads(body)
+                backend.max_batch_size = max(1, int(info.get("max_batch_size", 1)))
+                backend.streaming = info.get("streaming") is True
+            except (ValueError, TypeError, AttributeError):
+                backend.max_batch_size = 1
+                backend.streaming = False
+            # Probe latency is not generation latency; only reset the breaker
+            backend.record_success()
+            logger.debug(f"Health probe ok for {backend.name} in {time.monotonic() - start:.3f}s")
+        self.on_health_change()
+
+    @staticmethod
+    def _http_get(url: str) -> bytes:
+        with urllib.request.urlopen(url, timeout=Config.REMOTE_HEALTH_TIMEOUT) as resp:
+            return resp.read()
+
+    async def probe_loop(self) -> None:
+        while True:
+            try:
+                # Probe right away so backend capabilities are known at startup
+                await asyncio.gather(*(self.probe(b) for b in self.backends))
+                await asyncio.sleep(Config.REMOTE_HEALTH_INTERVAL)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Health probe error: {e}")
+
+    async def close(self) -> None:
+        for backend in self.backends:
+            await backend.pool.close()
+
+    def stats(self) -> list:
+        return [b.stats() for b in self.backends]
+
+
+remote_backends = RemoteBackendSet(
+    specs=Config.REMOTE_BACKENDS or [f"{Config.REMOTE_WS_HOST}:{Config.REMOTE_WS_PORT}"],
+    strategy=Config.REMOTE_LB_STRATEGY,
+)
+if Config.REMOTE_CONCURRENCY > 0:
+    generation_scheduler.resize(Config.REMOTE_CONCURRENCY * len(remote_backends.backends))
+
+
+def _raise_remote_error(response: str) -> None:
+    """Translate a JSON error frame from the remote server into an HTTPException"""
+    try:
+        error_data = json.loads(response)
+    except json.JSONDecodeError:
+        gateway_metrics.count_remote_error("INVALID_RESPONSE")
+        raise HTTPException(
+            status_code=500,
+            detail={"error": "Invalid response from server", "code": "INVALID_RESPONSE"}
+        )
+    error_msg = error_data.get('error', 'Unknown error')
+    error_code = error_data.get('code', 'SERVER_ERROR')
+    gateway_metrics.count_remote_error(error_code)
+    raise HTTPException(
+        status_code=500,
+        detail={"error": error_msg, "code": error_code}
+    )
+
+
+async def _request_backend(backend: RemoteBackend, payload: dict, frames: int = 1, on_chunk=None) -> list:
+    """
+    One request/response exchange with a backend
+    
+    Returns the `frames` raw response frames (NPZ bytes or JSON error strings).
+    With `on_chunk`, frame chunks of a streamed request (see `convert_motion_chunk`)
+    preceding the result are passed to `on_chunk(payload, frame_count)` as they arrive.
+    """
+    # A reused connection may have been closed by the server since it went idle;
+    # in that case retry once on a freshly opened connection.
+    for attempt in range(2):
+        ws, reused = await backend.pool.acquire()
+        discard = True
+        cancelled = False
+        streamed = False
+        responses = []
+        start = time.perf_counter()
+        try:
+            await ws.send(json.dumps(payload))
+            logger.info(f"Sent request to remote motion server {backend.name}")
+
+            # Receive response(s) with timeout
+            for _ in range(frames):
+                response = await asyncio.wait_for(ws.recv(), timeout=Config.WS_TIMEOUT)
+                while on_chunk is not None and isinstance(response, bytes):
+                    chunk = await conversion_pool.run(convert_motion_chunk, response)
+                    if chunk is None:
+                        break
+                    streamed = True
+                    on_chunk(*chunk)
+                    response = await asyncio.wait_for(ws.recv(), timeout=Config.WS_TIMEOUT)
+                responses.append(response)
+            gateway_metrics.observe("remote_generation", time.perf_counter() - start)
+            # A complete request/response exchange leaves the connection reusable
+            discard = False
+            return responses
+        except asyncio.CancelledError:
+            # The protocol has no cancel message: dropping the connection is how
+            # the generator learns that nobody is waiting for the result.
+            cancelled = True
+            raise
+        except websockets.exceptions.ConnectionClosed:
+            if reused and attempt == 0 and not responses and not streamed:
+                logger.info("Pooled remote connection was closed, reconnecting")
+                continue
+            raise
+        finally:
+            if cancelled:
+                backend.pool.abort(ws)
+            else:
+                await backend.pool.release(ws, discard=discard)
+
+
+async def _run_remote(payload: dict, frames: int, session_id: str, priority: int, on_chunk=None) -> list:
+    """
+    Run one remote exchange under a scheduler slot on a backend picked by
+    `remote_backends`, failing over to the next available backend on connection
+    failures. `frames` > 1 sends a batched request and needs a backend whose
+    advertised `max_batch_size` is large enough. With `on_chunk` the request asks
+    backends that advertise `streaming` for frame chunks (see `_request_backend`).
+    
+    Transport errors are translated to HTTPExceptions; returns the raw frames
+    """
+    async def _request_remote() -> list:
+        tried = []
+        while True:
+            backend = remote_backends.pick(exclude=tried, batch_size=frames)
+            if backend is None:
+                gateway_metrics.count_remote_error("SERVER_UNAVAILABLE")
+                raise HTTPException(
+                    status_code=503,
+                    detail={"error": "Motion generation server unavailable", "code": "SERVER_UNAVAILABLE"}
+                )
+            tried.append(backend)
+            trial = backend.state == "half_open"
+            backend.trial_in_progress = trial
+            backend.outstanding += 1
+            backend.requests += 1
+            start = time.monotonic()
+            try:
+                if on_chunk is not None and backend.streaming:
+                    responses = await _request_backend(backend, {**payload, "stream": True}, frames, on_chunk)
+                else:
+                    responses = await _request_backend(backend, payload, frames)
+            except asyncio.TimeoutError:
+                backend.record_failure()
+                remote_backends.on_health_change()
+                raise
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                backend.record_failure()
+                remote_backends.on_health_change()
+                if any(b.available() for b in remote_backends.backends if b not in tried):
+                    logger.warning(f"Backend {backend.name} failed ({e!r}), trying another")
+                    continue
+                raise
+            finally:
+                backend.outstanding -= 1
+                if trial:
+                    backend.trial_in_progress = False
+            # An error frame still means the backend is up and answering
+            backend.record_success(time.monotonic() - start)
+            generation_cost_model.observe(payload, time.monotonic() - start)
+            remote_backends.on_health_change()
+            return responses
+
+    started = None
+    expected = generation_cost_model.predict(payload)
+    try:
+        async with generation_scheduler.slot(session_id, priority, expected):
+            started = time.monotonic()
+            return await _request_remote()
+            
+    except asyncio.CancelledError:
+        # Every client waiting for this generation went away; the slot is already
+        # released by `slot()`, so only the accounting is left.
+        if started is None:
+            gateway_metrics.count_cancellation("queued", expected)
+        else:
+            gateway_metrics.count_cancellation("in_flight", max(0.0, expected - (time.monotonic() - started)))
+        raise
+    except asyncio.TimeoutError:
+        gateway_metrics.count_remote_error("TIMEOUT")
+        raise HTTPException(
+            status_code=504,
+            detail={"error": "Request timeout - generation took too long", "code": "TIMEOUT"}
+        )
+    except websockets.exceptions.WebSocketException as e:
+        logger.exception("WebSocket error: %s", e)
+        gateway_metrics.count_remote_error("WEBSOCKET_ERROR")
+        raise HTTPException(
+            status_code=502,
+            detail={"error": "Backend connection error", "code": "WEBSOCKET_ERROR"}
+        )
+    except OSError:
+        gateway_metrics.count_remote_error("SERVER_UNAVAILABLE")
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "Motion generation server unavailable", "code": "SERVER_UNAVAILABLE"}
+        )
+
+
+def _npz_from_frame(response) -> bytes:
+    """Return NPZ bytes from a response frame, raising for JSON error frames"""
+    if isinstance(response, str):
+        _raise_remote_error(response)
+    return response
+
+
+@dataclass
+class BatchItem:
+    """A request waiting in the micro-batcher"""
+    request_data: dict
+    session_id: str
+    priority: int
+    future: asyncio.Future
+    enqueued_at: float
+    jobs: tuple = ()
+
+
+class MicroBatcher:
+    """
+    Groups compatible generation requests into batched remote requests
+    
+    Requests with the same `num_inference_steps` and `motion_length` bucket are
+    collected for up to `BATCH_MAX_WAIT_MS`, or until `BATCH_MAX_SIZE` (capped
+    by what the backends advertise) is reached, then sent as one request
+    `{"batch": [request, ...]}`. The generator answers with one frame per item,
+    in order: NPZ bytes, or a JSON error for that item alone. A batch occupies
+    a single scheduler slot, charged to its first request's session.
+    """
+
+    def __init__(self, max_size: int, max_wait_ms: float, length_bucket: float):
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.length_bucket = length_bucket
+        self._pending: Dict[tuple, list] = {}
+        self._timers: Dict[tuple, asyncio.TimerHandle] = {}
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32])
+        self.wait_times = Histogram([0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1])
+
+    def enabled(self) -> bool:
+        return Config.REMOTE_BATCHING and self.max_size > 1 and remote_backends.max_batch_size() > 1
+
+    def _key(self, request_data: dict) -> tuple:
+        bucket = math.ceil(request_data.get("motion_length", 4.0) / self.length_bucket)
+        return (request_data.get("num_inference_steps"), bucket)
+
+    async def submit(self, request_data: dict, session_id: str, priority: int) -> bytes:
+        loop = asyncio.get_running_loop()
+        item = BatchItem(
+            request_data=request_data,
+            session_id=session_id,
+            priority=priority,
+            future=loop.create_future(),
+            enqueued_at=time.monotonic(),
+            jobs=current_jobs.get(),
+        )
+        key = self._key(request_data)
+        batch = self._pending.setdefault(key, [])
+        batch.append(item)
+        if len(batch) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        if len(batch) >= min(self.max_size, remote_backends.max_batch_size()):
+            self._flush(key)
+        return await item.future
+
+    def _flush(self, key: tuple) -> None:
+        batch = self._pending.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = [item for item in (batch or []) if not item.future.done()]
+        if not batch:
+            return
+        now = time.monotonic()
+        self.batch_sizes.observe(len(batch))
+        for item in batch:
+            self.wait_times.observe(now - item.enqueued_at)
+        task = asyncio.ensure_future(self._run(batch))
+        for item in batch:
+            item.future.add_done_callback(lambda _, batch=batch, task=task: self._abandon(batch, task))
+
+    @staticmethod
+    def _abandon(batch: list, task: asyncio.Task) -> None:
+        """Cancel a batch's remote call once all of its requests have been cancelled"""
+        if not task.done() and all(item.future.cancelled() for item in batch):
+            task.cancel()
+
+    async def _run(self, batch: list) -> None:
+        first = batch[0]
+        current_jobs.set(tuple(job for item in batch for job in item.jobs))
+        try:
+            if len(batch) == 1:
+                frames = await _run_remote(first.request_data, 1, first.session_id, first.priority)
+            else:
+                payload = {"batch": [item.request_data for item in batch]}
+                frames = await _run_remote(payload, len(batch), first.session_id, first.priority)
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        for item, frame in zip(batch, frames):
+            if item.future.done():
+                continue
+            try:
+                item.future.set_result(_npz_from_frame(frame))
+            except HTTPException as e:
+                item.future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled(),
+            "pending": sum(len(b) for b in self._pending.values()),
+            "batch_size": self.batch_sizes.snapshot(),
+            "wait_seconds": self.wait_times.snapshot(),
+        }
+
+
+micro_batcher = MicroBatcher(
+    max_size=Config.BATCH_MAX_SIZE,
+    max_wait_ms=Config.BATCH_MAX_WAIT_MS,
+    length_bucket=Config.BATCH_LENGTH_BUCKET,
+)
+
+
+async def generate_motion_from_remote(
+    request_data: dict,
+    session_id: str = "",
+    priority: int = 0,
+    on_chunk=None
+) -> bytes:
+    """
+    Generate a motion on the remote servers (through the micro-batcher when
+    enabled; streamed requests are sent on their own)
+    
+    Returns raw NPZ bytes on success
+    """
+    if on_chunk is None and micro_batcher.enabled():
+        return await micro_batcher.submit(request_data, session_id, priority)
+    frames = await _run_remote(request_data, 1, session_id, priority, on_chunk)
+    return _npz_from_frame(frames[0])
+
+
+class GenerationCache:
+    """
+    Content-addressed cache of remote generation results (raw NPZ bytes)
+    
+    Keys are a SHA-256 over the canonical JSON of the request sent to the remote
+    server. The memory tier is an LRU bounded by total payload bytes; the optional
+    disk tier (write-through, one `<key>.npz` file per entry) survives restarts
+    and is trimmed least recently used first when it exceeds its byte budget. Its
+    LRU order and byte total are kept in memory; the directory is only scanned
+    by `open()`.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = "", disk_max_bytes: int = 0):
+        self.max_bytes = max(0, max_bytes)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.bytes = 0
+        self._disk_entries: "OrderedDict[str, int]" = OrderedDict()  # key -> file size, LRU first
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def open(self) -> None:
+        """Index the disk tier, least recently used first (at startup: the only directory scan)"""
+        if not self.disk_dir:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".npz"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, entry.name[:-len(".npz")], st.st_size))
+        self._disk_entries.clear()
+        for _, key, size in sorted(entries):
+            self._disk_entries[key] = size
+        self.disk_bytes = sum(self._disk_entries.values())
+        self._remove_disk(self._trim_disk())
+
+    @staticmethod
+    def key_for(request_data: dict) -> str:
+        canonical = json.dumps(request_data, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.npz")
+
+    def __contains__(self, key: str) -> bool:
+        """Whether `key` is in the memory tier (no LRU update)"""
+        return key in self._entries
+
+    def _put_memory(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old)
+        self._entries[key] = value
+        self.bytes += len(value)
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    async def get(self, key: str, count: bool = True) -> Optional[bytes]:
+        """Cached payload of `key`; `count=False` leaves the hit/miss counters alone"""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += count
+            return value
+        if self.disk_dir:
+            value = await asyncio.to_thread(self._read_disk, key)
+            if value is not None:
+                self.disk_hits += count
+                self._put_memory(key, value)
+                self._add_disk(key, len(value))
+                return value
+            self.disk_bytes -= self._disk_entries.pop(key, 0)  # file gone
+        self.misses += count
+        return None
+
+    async def put(self, key: str, value: bytes) -> None:
+        self._put_memory(key, value)
+        if self.disk_dir and await asyncio.to_thread(self._write_disk, key, value):
+            self._add_disk(key, len(value))
+            evicted = self._trim_disk()
+            if evicted:
+                await asyncio.to_thread(self._remove_disk, evicted)
+
+    def _add_disk(self, key: str, size: int) -> None:
+        """Record `key` as the most recently used disk entry"""
+        self.disk_bytes += size - self._disk_entries.pop(key, 0)
+        self._disk_entries[key] = size
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)  # Recency for the LRU order rebuilt by `open()`
+            return value
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, value: bytes) -> bool:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+            return True
+        except OSError as e:
+            logger.warning(f"Generation cache disk write failed: {e}")
+            return False
+
+    def _trim_disk(self) -> list:
+        """Forget least recently used disk entries until within budget; returns their keys"""
+        evicted = []
+        while self.disk_bytes > self.disk_max_bytes and self._disk_entries:
+            key, size = self._disk_entries.popitem(last=False)
+            self.disk_bytes -= size
+            self.disk_evictions += 1
+            evicted.append(key)
+        return evicted
+
+    def _remove_disk(self, keys: list) -> None:
+        for key in keys:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                continue
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "disk_entries": len(self._disk_entries),
+            "disk_bytes": self.disk_bytes,
+            "disk_enabled": bool(self.disk_dir),
+        }
+
+
+generation_cache = GenerationCache(
+    max_bytes=Config.GENERATION_CACHE_MAX_BYTES,
+    disk_dir=Config.GENERATION_CACHE_DIR,
+    disk_max_bytes=Config.GENERATION_CACHE_DISK_MAX_BYTES,
+)
+# Uncacheable (time-seeded) results, kept only as nearest matches for the prompt index
+prompt_payloads = GenerationCache(max_bytes=Config.PROMPT_INDEX_PAYLOAD_MAX_BYTES)
+
+
+class PromptIndex:
+    """
+    Offline nearest-prompt index over previously generated motions
+    
+    Each distinct (normalized) prompt is a document of character trigrams and
+    words, TF-IDF weighted and compared by cosine similarity. Documents link to
+    generation cache keys (up to `MAX_VARIANTS` per prompt, e.g. different
+    lengths); a lookup whose payloads have all left the cache moves on to the
+    next-best prompt.
+    
+    Lookups go through an inverted index. Candidates are picked by the rarest
+    terms only (common ones like "a person" are left out once `MAX_POSTINGS`
+    postings have been scored, and no term scans more than that), and the best
+    `CANDIDATES` are then rescored exactly over all their terms, so a lookup
+    does no O(prompts) work. `bench.py prompts` at 50k prompts measured a mean
+    of 0.3-0.4 ms and a p99 of 0.4-0.8 ms (single core, occasional spikes to
+    ~1.7 ms from scheduling noise).
+    """
+    MAX_VARIANTS = 8
+    MAX_POSTINGS = 1000
+    CANDIDATES = 64
+
+    def __init__(self, max_prompts: int, path: str = ""):
+        self.max_prompts = max(1, max_prompts)
+        self.path = path
+        self._postings: Dict[str, Tuple[array, array]] = {}  # term -> (doc ids, tf / doc norm)
+        # Term counts by document, for exact rescoring: doc d has terms
+        # _doc_terms[_doc_starts[d]:_doc_starts[d + 1]]
+        self._term_ids: Dict[str, int] = {}
+        self._df = array("i")  # term id -> document frequency
+        self._idf_cache: Optional[np.ndarray] = None  # term id -> IDF, until the next document
+        self._doc_terms = array("i")
+        self._doc_tfs = array("f")
+        self._doc_starts = array("q", [0])
+        self._texts: list = []
+        self._variants: list = []  # doc id -> [(cache key, motion_length, steps)], newest last
+        self._alive = bytearray()
+        self._doc_of: Dict[str, int] = {}
+        self._order: Deque[int] = deque()  # doc ids, oldest first
+        self.alive = 0
+        self.lookups = 0
+        self.fallbacks = 0
+        self.previews = 0
+        self._log = None
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join("".join(c if c.isalnum() else " " for c in text.lower()).split())
+
+    @staticmethod
+    def terms(normalized: str) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        padded = f" {normalized} "
+        for i in range(len(padded) - 2):
+            gram = padded[i:i + 3]
+            counts[gram] = counts.get(gram, 0) + 1
+        for word in normalized.split():
+            key = "w:" + word
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def _idf(self, term: str, df: int = 0) -> float:
+        posting = self._postings.get(term)
+        df += len(posting[0]) if posting is not None else 0
+        return math.log((len(self._texts) + 1) / (df + 1)) + 1.0
+
+    def _index(self, doc: int, normalized: str) -> None:
+        counts = self.terms(normalized)
+        norm = math.sqrt(sum((tf * self._idf(t, 1)) ** 2 for t, tf in counts.items())) or 1.0
+        for term, tf in counts.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = (array("i"), array("f"))
+                self._term_ids[term] = len(self._df)
+                self._df.append(0)
+            term_id = self._term_ids[term]
+            posting[0].append(doc)
+            posting[1].append(tf / norm)
+            self._df[term_id] += 1
+            self._doc_terms.append(term_id)
+            self._doc_tfs.append(tf)
+        self._doc_starts.append(len(self._doc_terms))
+        self._idf_cache = None
+
+    def add(self, text: str, key: str, motion_length: float, steps: int, persist: bool = True) -> None:
+        """Link a generation (by cache key) to its prompt"""
+        normalized = self.normalize(text)
+        if not normalized:
+            return
+        doc = self._doc_of.get(normalized)
+        if doc is None:
+            doc = len(self._texts)
+            self._texts.append(text)
+            self._variants.append([])
+            self._alive.append(1)
+            self._doc_of[normalized] = doc
+            self._order.append(doc)
+            self.alive += 1
+            self._index(doc, normalized)
+        variants = self._variants[doc]
+        variants[:] = [v for v in variants if v[0] != key][-(self.MAX_VARIANTS - 1):]
+        variants.append((key, motion_length, steps))
+        if persist and self.path:
+            self._append_log({"text": text, "key": key, "motion_length": motion_length, "steps": steps})
+        while self.alive > self.max_prompts:
+            self._remove(self._order.popleft())
+        if len(self._texts) > 2 * self.max_prompts:
+            self.compact()
+
+    def _remove(self, doc: int) -> None:
+        if self._alive[doc]:
+            self._alive[doc] = 0
+            self.alive -= 1
+            self._variants[doc] = []
+            del self._doc_of[self.normalize(self._texts[doc])]
+
+    def search(self, text: str, k: int = 5) -> list:
+        """Up to `k` (doc id, cosine similarity) pairs, best first"""
+        normalized = self.normalize(text)
+        if not normalized or not self.alive:
+            return []
+        idfs = self._idf_cache
+        if idfs is None:
+            idfs = self._idf_cache = np.log((len(self._texts) + 1) / (np.frombuffer(self._df, dtype=np.int32) + 1.0)) + 1.0
+        unseen_idf = math.log(len(self._texts) + 1) + 1.0
+        weighted = []
+        for term, tf in self.terms(normalized).items():
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                weighted.append((0, tf * unseen_idf, unseen_idf, term))
+            else:
+                idf = float(idfs[term_id])
+                weighted.append((self._df[term_id], tf * idf, idf, term))
+        query_norm = math.sqrt(sum(w * w for _, w, _, _ in weighted)) or 1.0
+        
+        # Candidates: scored on the rarest terms only, with document norms as of insertion
+        weighted.sort(key=lambda t: t[0])
+        ids, weights = [], []
+        query = np.zeros(len(self._term_ids), dtype=np.float32)
+        scanned = 0
+        for df, query_weight, idf, term in weighted:
+            if not df:
+                continue
+            query[self._term_ids[term]] = query_weight / query_norm
+            weight = query_weight * idf / query_norm
+            if scanned and scanned + df > self.MAX_POSTINGS:
+                continue
+            # Even the rarest term scans at most MAX_POSTINGS postings (the newest)
+            posting = self._postings[term]
+            ids.append(np.frombuffer(posting[0], dtype=np.int32)[-self.MAX_POSTINGS:])
+            weights.append(np.frombuffer(posting[1], dtype=np.float32)[-self.MAX_POSTINGS:] * weight)
+            scanned += min(df, self.MAX_POSTINGS)
+        if not ids:
+            return []
+        # Scored over the scanned documents only: nothing here is O(prompts)
+        candidates, slots = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(slots, weights=np.concatenate(weights))
+        alive = np.frombuffer(self._alive, dtype=np.uint8)[candidates].astype(bool)
+        candidates, scores = candidates[alive], scores[alive]
+        if len(candidates) > self.CANDIDATES:
+            candidates = candidates[np.argpartition(scores, -self.CANDIDATES)[-self.CANDIDATES:]]
+        
+        # Exact cosine of the candidates over all their terms, with the current IDF
+        doc_starts = np.frombuffer(self._doc_starts, dtype=np.int64)
+        starts = doc_starts[candidates]
+        lengths = doc_starts[candidates + 1] - starts
+        owner = np.repeat(np.arange(len(candidates)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        terms = np.frombuffer(self._doc_terms, dtype=np.int32)[offsets]
+        weights = np.frombuffer(self._doc_tfs, dtype=np.float32)[offsets] * idfs[terms]
+        norms = np.sqrt(np.bincount(owner, weights=weights * weights, minlength=len(candidates)))
+        scores = np.bincount(owner, weights=weights * query[terms], minlength=len(candidates)) / np.maximum(norms, 1e-9)
+        order = np.argsort(-scores)[:k]
+        return [(int(candidates[i]), float(scores[i])) for i in order if scores[i] > 0]
+
+    async def closest(self, text: str, motion_length: float, min_similarity: float = 0.0) -> Optional[Tuple[bytes, str, float]]:
+        """(NPZ bytes, matched prompt, similarity) of the best match whose payload is still cached"""
+        self.lookups += 1
+        for doc, similarity in self.search(text):
+            if similarity < min_similarity:
+                break
+            # Prefer the variant closest in length, then the newest
+            variants = sorted(reversed(self._variants[doc]), key=lambda v: abs(v[1] - motion_length))
+            for key, _, _ in variants:
+                npz_bytes = await generation_cache.get(key, count=False)
+                if npz_bytes is None:
+                    npz_bytes = await prompt_payloads.get(key, count=False)
+                if npz_bytes is not None:
+                    return npz_bytes, self._texts[doc], min(1.0, similarity)
+                self._variants[doc] = [v for v in self._variants[doc] if v[0] != key]
+            if not self._variants[doc]:
+                self._remove(doc)
+        return None
+
+    def compact(self) -> None:
+        """Rebuild without removed prompts, refreshing document norms"""
+        docs = [(self._texts[d], self._variants[d]) for d in self._order if self._alive[d]]
+        self._postings, self._term_ids, self._df, self._idf_cache = {}, {}, array("i"), None
+        self._doc_terms, self._doc_tfs, self._doc_starts = array("i"), array("f"), array("q", [0])
+        self._texts, self._variants, self._alive = [], [], bytearray()
+        self._doc_of, self._order, self.alive = {}, deque(), 0
+        for text, variants in docs:
+            for key, motion_length, steps in variants:
+                self.add(text, key, motion_length, steps, persist=False)
+        if self.path:
+            self._rewrite_log()
+
+    def open(self) -> None:
+        """Load the persisted index (at startup, not import: pool workers import this module too)"""
+        if self.path:
+            self._load()
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.add(entry["text"], entry["key"], float(entry["motion_length"]),
+                                 int(entry["steps"]), persist=False)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Could not load prompt index {self.path}: {e}")
+            return
+        logger.info(f"Loaded {self.alive} prompts into the prompt index")
+        self._rewrite_log()
+
+    def _append_log(self, entry: dict) -> None:
+        try:
+            if self._log is None:
+                self._log = open(self.path, "a", encoding="utf-8")
+            self._log.write(json.dumps(entry) + "\n")
+            self._log.flush()
+        except OSError as e:
+            logger.warning(f"Prompt index write failed: {e}")
+
+    def _rewrite_log(self) -> None:
+        """Replace the append-only log with the live entries"""
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for doc in self._order:
+                    for key, motion_length, steps in self._variants[doc]:
+                        f.write(json.dumps({"text": self._texts[doc], "key": key,
+                                            "motion_length": motion_length, "steps": steps}) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Prompt index rewrite failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "prompts": self.alive,
+            "max_prompts": self.max_prompts,
+            "terms": len(self._postings),
+            "lookups": self.lookups,
+            "fallbacks": self.fallbacks,
+            "previews": self.previews,
+            "persistent": bool(self.path),
+            "uncacheable_payload_bytes": prompt_payloads.bytes,
+        }
+
+
+prompt_index = PromptIndex(max_prompts=Config.PROMPT_INDEX_MAX_PROMPTS, path=Config.PROMPT_INDEX_PATH)
+
+
+class SingleFlight:
+    """
+    In-flight deduplication of identical generation requests
+    
+    The first caller for a key starts the work as a task; callers arriving while
+    it runs await the same task instead of queueing their own remote call. The
+    task is shielded, so a caller that goes away does not cancel it for the
+    others; it is cancelled once the last of its callers has gone away.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.flights = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def run(self, key: str, fn) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.info(f"Coalesced generation request {key[:12]}")
+        else:
+            self.flights += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._inflight.get(key) is task and not task.done():
+                self._waiters[key] -= 1
+                if self._waiters[key] == 0:
+                    # Unregister first so a caller arriving now starts a new flight
+                    # instead of joining a cancelled one
+                    del self._inflight[key]
+                    del self._waiters[key]
+                    self.abandoned += 1
+                    task.cancel()
+            raise
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved when every waiter has gone away
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+
+
+generation_flights = SingleFlight()
+
+
+async def generate_motion_cached(
+    request_data: dict,
+    cacheable: bool,
+    session_id: str = "",
+    priority: int = 0,
+    on_chunk=None
+) -> bytes:
+    """
+    Serve a generation from the cache when possible, otherwise from the remote
+    server, sharing one remote call between concurrent identical requests
+    (except streamed ones, whose chunks go to a single caller)
+    """
+    key = GenerationCache.key_for(request_data)
+    use_cache = cacheable and bool(generation_cache.max_bytes or generation_cache.disk_dir)
+    if use_cache:
+        npz_bytes = await generation_cache.get(key)
+        if npz_bytes is not None:
+            logger.info(f"Generation cache hit {key[:12]}")
+            return npz_bytes
+
+    async def _generate() -> bytes:
+        npz_bytes = await generate_motion_from_remote(request_data, session_id, priority, on_chunk)
+        # Results nobody can request again by key stay out of the generation cache;
+        # the prompt index keeps them in its own small store as nearest matches
+        store = generation_cache if use_cache else prompt_payloads
+        if store.max_bytes or store.disk_dir:
+            await store.put(key, npz_bytes)
+            prompt_index.add(request_data["text"], key, request_data.get("motion_length", 0.0),
+                             request_data.get("num_inference_steps", 0))
+        return npz_bytes
+
+    if not Config.COALESCE_IDENTICAL_REQUESTS or on_chunk is not None:
+        return await _generate()
+    return await generation_flights.run(key, _generate)
+
+
+async def wait_for_disconnect(http_request: Request) -> None:
+    """Return once the client closes the connection (the request body must already be read)"""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(http_request: Request, work) -> Any:
+    """
+    Await `work`, cancelling it if the client disconnects first
+    
+    Cancellation propagates down to the scheduler slot and the remote connection,
+    so a generation nobody is waiting for does not keep the generator busy.
+    Raises HTTPException 499 (client closed request) in that case.
+    """
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task.done() or watcher.cancelled() or watcher.exception() is not None:
+        return await task
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    logger.info(f"Client disconnected, cancelled {http_request.url.path}")
+    raise HTTPException(
+        status_code=499,
+        detail={"error": "Client closed request", "code": "CLIENT_DISCONNECTED"}
+    )
+
+
+def build_remote_request(request: TextToMotionRequest) -> Tuple[dict, bool]:
+    """Remote request of a generation, and whether its result may be cached"""
+    # Requests without a seed are only reproducible (and so cacheable) when a
+    # deterministic default seed is configured.
+    if request.seed is not None:
+        seed = request.seed
+    elif Config.GENERATION_DEFAULT_SEED is not None:
+        seed = Config.GENERATION_DEFAULT_SEED
+    else:
+        seed = int(time.time() % 10000)
+    cacheable = request.seed is not None or Config.GENERATION_DEFAULT_SEED is not None
+    
+    request_data = {
+        "text": request.text,
+        "motion_length": request.motion_length,
+        "num_inference_steps": request.num_inference_steps,
+        "seed": seed,
+        "smooth": request.smooth,
+        "smooth_window": request.smooth_window,
+        "adaptive_smooth": request.adaptive_smooth,
+        "static_start": request.static_start,
+        "static_frames": request.static_frames,
+        "blend_frames": request.blend_frames
+    }
+    
+    # Remove None values
+    return {k: v for k, v in request_data.items() if v is not None}, cacheable
+
+
+async def check_generation_rate_limits(session: UserSession, client_ip: str) -> None:
+    if not await app_state.check_rate_limit(session):
+        gateway_metrics.count_rate_limit("RATE_LIMIT")
+        raise HTTPException(
+            status_code=429,
+            detail={"error": "Rate limit exceeded - max 10 requests per minute", "code": "RATE_LIMIT"}
+        )
+    if not await app_state.check_ip_rate_limit(client_ip):
+        gateway_metrics.count_rate_limit("IP_RATE_LIMIT")
+        raise HTTPException(
+            status_code=429,
+            detail={"error": "Rate limit exceeded for IP", "code": "IP_RATE_LIMIT"}
+        )
+
+
+def queue_overloaded() -> Optional[HTTPException]:
+    """503 + Retry-After when the predicted queue wait is over ADMISSION_MAX_QUEUE_SECONDS"""
+    wait = generation_scheduler.predicted_wait()
+    if Config.ADMISSION_MAX_QUEUE_SECONDS <= 0 or wait <= Config.ADMISSION_MAX_QUEUE_SECONDS:
+        return None
+    gateway_metrics.count_rate_limit("OVERLOADED")
+    retry_after = max(1, math.ceil(wait - Config.ADMISSION_MAX_QUEUE_SECONDS))
+    return HTTPException(
+        status_code=503,
+        detail={"error": f"Generation queue is full (about {wait:.0f}s), retry later", "code": "OVERLOADED",
+                "retry_after_seconds": retry_after},
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+async def pace_generation_quota(session: UserSession, request_data: dict, cacheable: bool) -> None:
+    """
+    Charge a batch item's predicted cost to the session's quota, waiting until
+    it is available; batches run at the quota's rate instead of being refused
+    """
+    if cacheable and GenerationCache.key_for(request_data) in generation_cache:
+        return
+    cost = generation_cost_model.predict(request_data)
+    while (wait := app_state.take_generation_seconds(session.session_id, cost)) > 0:
+        await asyncio.sleep(wait)
+
+
+def admit_generation(
+    session: UserSession,
+    request_data: dict,
+    cacheable: bool,
+    degradable: bool = False
+) -> Optional[HTTPException]:
+    """
+    Admission control before a generation is started
+    
+    Turns the request away at once with 503 + Retry-After while the predicted
+    queue wait is over ADMISSION_MAX_QUEUE_SECONDS (instead of letting it time
+    out after wasting a slot), then charges its predicted cost to the session's
+    generation-seconds quota (429 + Retry-After when exhausted). Requests that
+    will be served from the memory cache are always admitted, free of charge.
+    
+    With `degradable` the 503 is returned instead of raised, for run_generation
+    to answer with a nearest-prompt fallback.
+    """
+    if cacheable and GenerationCache.key_for(request_data) in generation_cache:
+        return None
+    overloaded = queue_overloaded()
+    if overloaded is not None:
+        if degradable:
+            return overloaded
+        raise overloaded
+    retry_after = app_state.take_generation_seconds(session.session_id, generation_cost_model.predict(request_data))
+    if retry_after > 0:
+        gateway_metrics.count_rate_limit("GENERATION_QUOTA")
+        retry_after = max(1, math.ceil(retry_after))
+        raise HTTPException(
+            status_code=429,
+            detail={"error": "Generation time quota exceeded", "code": "GENERATION_QUOTA",
+                    "retry_after_seconds": retry_after},
+            headers={"Retry-After": str(retry_after)}
+        )
+    return None
+
+
+# Generation errors answered with the closest previous motion when fallback is allowed
+FALLBACK_ERROR_CODES = frozenset({"SERVER_UNAVAILABLE", "TIMEOUT", "WEBSOCKET_ERROR", "OVERLOADED"})
+
+
+def fallback_allowed(request: TextToMotionRequest) -> bool:
+    return Config.PROMPT_FALLBACK and request.fallback
+
+
+async def publish_preview(request: TextToMotionRequest, job: GenerationJob) -> None:
+    """Push the closest previously generated motion on `job` while the real one is generated"""
+    match = await prompt_index.closest(request.text, request.motion_length, Config.PROMPT_FALLBACK_MIN_SIMILARITY)
+    if match is None or job.status in JOB_FINAL_STATES:
+        return
+    # The index is shared by all sessions: never reveal the matched prompt itself
+    npz_bytes, _, similarity = match
+    motion = await conversion_pool.run(convert_npz_to_motion_data, npz_bytes, f"[Preview] {request.text[:30]}")
+    job.preview = await conversion_pool.run(encode_motion_binary, motion)
+    job.preview_match = {"similarity": round(similarity, 3)}
+    prompt_index.previews += 1
+    job._notify()
+
+
+async def run_generation(
+    request: TextToMotionRequest,
+    request_data: dict,
+    cacheable: bool,
+    session: UserSession,
+    job: Optional[GenerationJob] = None,
+    overloaded: Optional[HTTPException] = None
+) -> Tuple[str, dict]:
+    """
+    Generate a motion, convert it and store it in the session; returns (motion_id, motion_data)
+    
+    Frame chunks of a streamed `job` are published on it while the generation runs.
+    When the generator is unavailable (or admission returned `overloaded`) and
+    fallback is allowed, the closest previously generated motion is stored
+    instead, with `motion_data["fallback"]` describing the match.
+    """
+    def on_chunk(chunk: bytes, frames: int) -> None:
+        if job.first_frame_seconds is None:
+            job.first_frame_seconds = (datetime.now() - job.created_at).total_seconds()
+            gateway_metrics.observe("time_to_first_frame", job.first_frame_seconds)
+        job.add_chunk(chunk, frames)
+    
+    if job is not None and request.preview and overloaded is None:
+        await publish_preview(request, job)
+    
+    fallback = None
+    try:
+        if overloaded is not None:
+            raise overloaded
+        # Generate motion from remote server (or the generation cache)
+        npz_bytes = await generate_motion_cached(
+            request_data,
+            cacheable,
+            session_id=session.session_id,
+            priority=min(request.priority, Config.MAX_CLIENT_PRIORITY),
+            on_chunk=on_chunk if job is not None and request.stream else None
+        )
+    except HTTPException as e:
+        code = e.detail.get("code") if isinstance(e.detail, dict) else None
+        if code not in FALLBACK_ERROR_CODES or not fallback_allowed(request):
+            raise
+        match = await prompt_index.closest(request.text, request.motion_length, Config.PROMPT_FALLBACK_MIN_SIMILARITY)
+        if match is None:
+            raise
+        npz_bytes, _, similarity = match
+        # Other sessions' prompts stay private: only the similarity is reported
+        fallback = {"reason": code, "similarity": round(similarity, 3)}
+        prompt_index.fallbacks += 1
+        logger.warning(f"Generation unavailable ({code}), serving closest prompt (similarity {similarity:.2f})")
+    
+    # Generate motion ID
+    motion_id = f"gen_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    motion_name = f"[AI] {request.text[:30]}"
+    
+    # Convert to motion data
+    async with gateway_metrics.timed("npz_decode"):
+        motion_data = await conversion_pool.run(convert_npz_to_motion_data, npz_bytes, motion_name)
+    motion_data['motion_id'] = motion_id
+    motion_data['text_prompt'] = request.text
+    motion_data['parameters'] = {
+        "motion_length": request.motion_length,
+        "num_inference_steps": request.num_inference_steps,
+        "adaptive_smooth": request.adaptive_smooth,
+        "static_start": request.static_start,
+        "transition_steps": request.transition_steps
+    }
+    if fallback is not None:
+        motion_data['fallback'] = fallback
+        if job is not None:
+            job.fallback = fallback
+    
+    # Store in session (enforce limit)
+    await app_state.store.add_motion(session, motion_id, motion_data)
+    
+    if job is not None and job.first_frame_seconds is None:
+        # Nothing was streamed: the first frames arrive with the result
+        job.first_frame_seconds = (datetime.now() - job.created_at).total_seconds()
+        gateway_metrics.observe("time_to_first_frame", job.first_frame_seconds)
+    if fallback is None:
+        logger.info(f"Generated motion {motion_id} for session {session.session_id}")
+    return motion_id, motion_data
+
+
+class GenerationJobManager:
+    """
+    Generations running as background jobs
+    
+    Every generation is a job, also the ones of POST /api/generate, which just
+    waits for its job (`retain=False`: such jobs are not listed or pollable).
+    Jobs of POST /api/jobs stay available for JOB_RETENTION_SECONDS after they
+    finish. Jobs live in this worker process, so the job and batch APIs need a
+    single uvicorn worker: `require_single_worker` answers 503 JOBS_UNAVAILABLE
+    when WEB_CONCURRENCY is above 1 (sticky routing is not supported).
+    """
+
+    def __init__(self, retention: float):
+        self.retention = retention
+        self._jobs: Dict[str, GenerationJob] = {}
+        self._batches: Dict[str, GenerationBatch] = {}
+        # Unfinished jobs, also the ones not retained
+        self._live: Dict[str, GenerationJob] = {}
+        self.submitted = 0
+        self.batches_submitted = 0
+        self.finished: Dict[str, int] = {}
+
+    def submit(self, session_id: str, text: str, fn, retain: bool = True, batch_id: Optional[str] = None) -> GenerationJob:
+        """Start `fn(job)` (returning (motion_id, motion_data)) as a job"""
+        now = datetime.now()
+        job = GenerationJob(
+            job_id=uuid.uuid4().hex,
+            session_id=session_id,
+            text=text[:100],
+            created_at=now,
+            updated_at=now,
+            batch_id=batch_id,
+        )
+        job.task = asyncio.ensure_future(self._run(job, fn))
+        job.task.add_done_callback(lambda task: self._finish(job, task))
+        if retain:
+            self._jobs[job.job_id] = job
+        self._live[job.job_id] = job
+        self.submitted += 1
+        return job
+
+    def submit_batch(self, session_id: str, items: list, parallel: int) -> GenerationBatch:
+        """
+        Start one job per (text, fn) item; at most `parallel` of them run at once,
+        the others wait in request order
+        """
+        batch = GenerationBatch(batch_id=uuid.uuid4().hex, session_id=session_id, created_at=datetime.now())
+        semaphore = asyncio.Semaphore(max(1, parallel))
+
+        async def run(job: GenerationJob, fn) -> Tuple[str, dict]:
+            async with semaphore:
+                return await fn(job)
+
+        for text, fn in items:
+            job = self.submit(session_id, text, lambda job, fn=fn: run(job, fn), batch_id=batch.batch_id)
+            job.task.add_done_callback(lambda _: batch._notify())
+            batch.jobs.append(job)
+        self._batches[batch.batch_id] = batch
+        self.batches_submitted += 1
+        return batch
+
+    async def _run(self, job: GenerationJob, fn) -> Tuple[str, dict]:
+        current_jobs.set((job,))
+        try:
+            motion_id, motion_data = await fn(job)
+        except asyncio.CancelledError:
+            if not job.cancel_requested:
+                raise
+            detail = {"error": "Generation request cancelled", "code": "CANCELLED"}
+            job.update("cancelled", error=detail)
+            raise HTTPException(status_code=409, detail=detail)
+        except HTTPException as e:
+            detail = e.detail if isinstance(e.detail, dict) else {"error": str(e.detail), "code": "UNKNOWN"}
+            job.update("cancelled" if detail.get("code") == "CANCELLED" else "failed", error=detail)
+            raise
+        except Exception as e:
+            logger.error(f"Generation error: {e}")
+            detail = {"error": "Failed to generate motion", "code": "GENERATION_FAILED"}
+            job.update("failed", error=detail)
+            raise HTTPException(status_code=500, detail=detail)
+        job.update("succeeded", motion_id=motion_id)
+        return motion_id, motion_data
+
+    def _finish(self, job: GenerationJob, task: asyncio.Task) -> None:
+        self._live.pop(job.job_id, None)
+        job.task = None
+        job.chunks = []  # Superseded by the stored motion
+        job.preview = None
+        if task.cancelled():
+            job.update("cancelled", error={"error": "Generation cancelled", "code": "CANCELLED"})
+        else:
+            task.exception()  # Reported through the job status when nobody awaits the task
+        self.finished[job.status] = self.finished.get(job.status, 0) + 1
+
+    def _expired(self, job: GenerationJob, now: datetime) -> bool:
+        return job.status in JOB_FINAL_STATES and (now - job.updated_at).total_seconds() > self.retention
+
+    def _batch_expired(self, batch: GenerationBatch, now: datetime) -> bool:
+        finished_at = batch.finished_at()
+        return finished_at is not None and (now - finished_at).total_seconds() > self.retention
+
+    def get(self, job_id: str, session_id: str) -> Optional[GenerationJob]:
+        job = self._jobs.get(job_id)
+        if job is None or job.session_id != session_id or self._expired(job, datetime.now()):
+            return None
+        return job
+
+    def get_batch(self, batch_id: str, session_id: str) -> Optional[GenerationBatch]:
+        batch = self._batches.get(batch_id)
+        if batch is None or batch.session_id != session_id or self._batch_expired(batch, datetime.now()):
+            return None
+        return batch
+
+    def session_jobs(self, session_id: str) -> list:
+        """Jobs of a session, without batch items (see its batches)"""
+        now = datetime.now()
+        return [job for job in self._jobs.values()
+                if job.session_id == session_id and job.batch_id is None and not self._expired(job, now)]
+
+    def active_count(self, session_id: str) -> int:
+        return sum(1 for job in self._jobs.values()
+                   if job.session_id == session_id and job.batch_id is None and job.status not in JOB_FINAL_STATES)
+
+    def active_batches(self, session_id: str) -> int:
+        return sum(1 for batch in self._batches.values() if batch.session_id == session_id and not batch.done)
+
+    async def cancel(self, job: GenerationJob) -> None:
+        task = job.task
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def cancel_queued(self, session_id: str) -> int:
+        """
+        Cancel a session's jobs that are still waiting for a slot
+        
+        Only the session's own jobs are detached: a remote call they share with
+        other sessions' requests (coalesced or micro-batched) goes on for those.
+        """
+        jobs = [job for job in self._live.values()
+                if job.session_id == session_id and job.status == "queued"
+                and job.task is not None and not job.task.done()]
+        tasks = [job.task for job in jobs]
+        for job in jobs:
+            job.cancel_requested = True
+            job.task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        return len(jobs)
+
+    async def cancel_batch(self, batch: GenerationBatch) -> None:
+        tasks = [job.task for job in batch.jobs if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def prune(self) -> int:
+        """Forget jobs (and batches) that finished more than `retention` seconds ago"""
+        now = datetime.now()
+        expired = [batch_id for batch_id, batch in self._batches.items() if self._batch_expired(batch, now)]
+        for batch_id in expired:
+            del self._batches[batch_id]
+        expired = [job_id for job_id, job in self._jobs.items() if self._expired(job, now)]
+        for job_id in expired:
+            del self._jobs[job_id]
+        return len(expired)
+
+    async def shutdown(self) -> None:
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def stats(self) -> dict:
+        return {
+            "jobs": len(self._jobs),
+            "active": sum(1 for job in self._jobs.values() if job.status not in JOB_FINAL_STATES),
+            "submitted": self.submitted,
+            "finished": dict(self.finished),
+            "batches": len(self._batches),
+            "batches_active": sum(1 for batch in self._batches.values() if not batch.done),
+            "batches_submitted": self.batches_submitted,
+        }
+
+
+generation_jobs = GenerationJobManager(retention=Config.JOB_RETENTION_SECONDS)
+
+
+def job_snapshot(job: GenerationJob) -> dict:
+    """Status of a job as pushed by /events and returned by GET /api/jobs/{job_id}"""
+    status = {
+        "job_id": job.job_id,
+        "status": job.status,
+        "text": job.text,
+        "created_at": job.created_at.isoformat(),
+        "updated_at": job.updated_at.isoformat(),
+        "position": None,
+        "estimated_wait_seconds": None,
+        "motion_id": job.motion_id,
+        "error": job.error,
+        "frames_streamed": job.frames_streamed,
+        "first_frame_seconds": job.first_frame_seconds,
+        "preview": job.preview_match,
+        "fallback": job.fallback,
+    }
+    if job.status == "queued":
+        position = generation_scheduler.job_position(job)
+        if position is not None:
+            status["position"] = position
+            status["estimated_wait_seconds"] = generation_scheduler.estimate_wait(position)
+    return status
+
+
+def preview_resolution(motion_id: str, preview: dict) -> Optional[dict]:
+    """`resolution` block of a response carrying `decimate_motion` output (None if not decimated)"""
+    if 'source_fps' not in preview:
+        return None
+    return {
+        "fps": preview['fps'],
+        "frame_count": preview['frame_count'],
+        "source_fps": preview['source_fps'],
+        "source_frame_count": preview['source_frame_count'],
+        "full": f"/api/motions/{motion_id}",
+    }
+
+
+def batch_snapshot(batch: GenerationBatch) -> dict:
+    """Progress of a batch, with the status of every item in request order"""
+    counts: Dict[str, int] = {}
+    for job in batch.jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return {
+        "batch_id": batch.batch_id,
+        "created_at": batch.created_at.isoformat(),
+        "total": len(batch.jobs),
+        "done": batch.done,
+        "counts": counts,
+        "items": [
+            {"index": i, "job_id": job.job_id, "status": job.status, "motion_id": job.motion_id,
+             "error": job.error, "fallback": job.fallback}
+            for i, job in enumerate(batch.jobs)
+        ],
+    }
+
+
+async def render_job(job: GenerationJob, session: UserSession, preview: bool = False, **extra) -> bytes:
+    """
+    JSON body of a job's status, with the motion itself once the job has succeeded
+    (its decimated preview and a `resolution` block with `preview`)
+    """
+    status = {**extra, **job_snapshot(job)}
+    if job.status == "succeeded":
+        motion = await app_state.store.get_motion(session, job.motion_id)
+        if motion is not None and preview:
+            motion = await conversion_pool.run(decimate_motion, motion, Config.MOTION_PREVIEW_FPS)
+            status["resolution"] = preview_resolution(job.motion_id, motion)
+        status["motion"] = {k: motion[k] for k in MotionData.model_fields} if motion is not None else None
+    return await conversion_pool.run(render_motion_json, status)
+
+
+# Content codings of stored-motion responses, in order of preference
+MOTION_CONTENT_CODINGS = ("br", "gzip", "identity")
+
+
+def encode_motion_bodies(motion: dict, fmt: str) -> Dict[str, bytes]:
+    """
+    Encode a stored motion as a GET /api/motions/{id} body, once per content coding
+    
+    Returns {coding: body}; a compressed variant is only kept when it is smaller.
+    The output is deterministic, so the bodies can carry strong ETags. Formats
+    ending in "-preview" encode the decimated preview of the motion.
+    """
+    if fmt.endswith("-preview"):
+        motion = decimate_motion(motion, Config.MOTION_PREVIEW_FPS)
+    body = encode_motion_binary(motion) if fmt.startswith("binary") else render_motion_json(motion)
+    bodies = {"identity": body}
+    if len(body) >= 1024:
+        compressed = {"gzip": gzip.compress(body, compresslevel=6, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(body, quality=5)
+        for coding, data in compressed.items():
+            if len(data) < len(body) * 0.9:
+                bodies[coding] = data
+    return bodies
+
+
+def accepted_codings(accept_encoding: str) -> set:
+    """Content codings allowed by an Accept-Encoding header (identity is always allowed)"""
+    codings = {"identity"}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        codings.add(name.strip().lower())
+    return codings
+
+
+def motion_etag(motion_id: str, fmt: str, coding: str) -> str:
+    """
+    Strong ETag of a stored-motion representation
+    
+    Stored motions never change and motion IDs are not reused, so the ID plus
+    the representation (format and content coding) identify the bytes exactly.
+    """
+    suffix = "" if coding == "identity" else f"-{coding}"
+    return f'"{motion_id}-{fmt}{suffix}"'
+
+
+def matching_etag(if_none_match: str, motion_id: str, fmt: str) -> Optional[str]:
+    """The ETag from If-None-Match naming a representation of this motion and format, if any"""
+    if not if_none_match:
+        return None
+    if if_none_match.strip() == "*":
+        return motion_etag(motion_id, fmt, "identity")
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    for coding in MOTION_CONTENT_CODINGS:
+        etag = motion_etag(motion_id, fmt, coding)
+        if etag in tags:
+            return etag
+    return None
+
+
+class EncodedMotionCache:
+    """
+    Byte-bounded LRU of encoded GET /api/motions/{id} bodies
+    
+    Keyed by (session_id, motion_id, format). Entries are dropped when their
+    motion is deleted and otherwise age out; the endpoint checks that a motion
+    still exists before serving it from here.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max(0, max_bytes)
+        self._entries: OrderedDict = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[Dict[str, bytes]]:
+        bodies = self._entries.get(key)
+        if bodies is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return bodies
+
+    def put(self, key: Tuple[str, str, str], bodies: Dict[str, bytes]) -> None:
+        size = sum(len(b) for b in bodies.values())
+        if size > self.max_bytes:
+            return
+        self.discard(key)
+        self._entries[key] = bodies
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= sum(len(b) for b in evicted.values())
+
+    def discard(self, key: Tuple[str, str, str]) -> None:
+        bodies = self._entries.pop(key, None)
+        if bodies is not None:
+            self.bytes -= sum(len(b) for b in bodies.values())
+
+    def discard_motion(self, session_id: str, motion_id: str) -> None:
+        for fmt in ("json", "binary", "json-preview", "binary-preview"):
+            self.discard((session_id, motion_id, fmt))
+
+    def discard_session(self, session_id: str) -> None:
+        for key in [k for k in self._entries if k[0] == session_id]:
+            self.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "brotli": brotli is not None,
+        }
+
+
+encoded_motion_cache = EncodedMotionCache(max_bytes=Config.MOTION_RESPONSE_CACHE_MAX_BYTES)
+
+
+# ==================== API Endpoints ====================
+
+@app.get("/")
+async def root():
+    """Health check endpoint."""
+    return {"status": "running"}
+
+
+@app.get("/health")
+async def health_check():
+    """Health check (includes backend, generation cache and scheduler statistics)"""
+    return {
+        "status": "healthy",
+        "backends": remote_backends.stats(),
+        "generation_cache": generation_cache.stats(),
+        "coalescing": generation_flights.stats(),
+        "scheduler": generation_scheduler.stats(),
+        "batching": micro_batcher.stats(),
+        "session_store": await app_state.store.stats(),
+        "motion_responses": encoded_motion_cache.stats(),
+        "ip_rate_limit": app_state.ip_rate.stats(),
+        "conversion": conversion_pool.stats(),
+        "jobs": generation_jobs.stats(),
+        "cost_model": generation_cost_model.stats(),
+        "prompt_index": prompt_index.stats(),
+        "cancellations": {
+            "by_stage": dict(gateway_metrics.cancellations),
+            "gpu_seconds_saved": round(gateway_metrics.gpu_seconds_saved, 3),
+        },
+    }
+
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics (text exposition format) for this worker process"""
+    store = await app_state.store.stats()
+    out = PrometheusWriter("motion_gateway_")
+    out.histogram(
+        "stage_duration_seconds", "Time spent in each stage of serving a generation",
+        (({"stage": stage}, hist) for stage, hist in gateway_metrics.stages.items()),
+    )
+    out.metric("active_sessions", "gauge", "Sessions held in the session store",
+               [(None, store["sessions"])])
+    out.metric("stored_motions", "gauge", "Motions held in the session store",
+               [(None, store["motions"])])
+    out.metric("stored_motion_bytes", "gauge", "Bytes of motion data held in the session store",
+               [(None, store["motion_bytes"])])
+    if "max_bytes" in store:
+        out.metric("stored_motion_budget_bytes", "gauge", "Byte budget of the in-memory motion store",
+                   [(None, store["max_bytes"])])
+        out.metric("stored_motion_evictions_total", "counter", "Motions evicted to stay within the limits",
+                   [(None, store["evictions"])])
+        out.metric("spilled_motion_bytes", "gauge", "Bytes of motion data spilled to MOTION_SPILL_DIR",
+                   [(None, store["disk_bytes"])])
+    out.metric("rate_limit_buckets", "gauge", "Per-IP rate-limit buckets held in memory",
+               [(None, app_state.ip_rate.stats()["keys"])])
+    out.metric("rate_limit_rejections_total", "counter", "Requests rejected by a rate limit",
+               (({"code": code}, n) for code, n in sorted(gateway_metrics.rate_limit_rejections.items())))
+    out.metric("remote_errors_total", "counter", "Failed remote generations by error code",
+               (({"code": code}, n) for code, n in sorted(gateway_metrics.remote_errors.items())))
+
+    backends = remote_backends.stats()
+    out.metric("backend_up", "gauge", "1 while the backend's circuit breaker is closed",
+               (({"backend": b["name"]}, int(b["state"] == "closed")) for b in backends))
+    out.metric("backend_outstanding", "gauge", "Generations in flight per backend",
+               (({"backend": b["name"]}, b["outstanding"]) for b in backends))
+    out.metric("backend_connections_reused_total", "counter", "Pooled WebSocket connections reused",
+               (({"backend": b["name"]}, b["pool"]["hits"]) for b in backends))
+    out.metric("backend_connections_opened_total", "counter", "WebSocket connections opened",
+               (({"backend": b["name"]}, b["pool"]["misses"]) for b in backends))
+
+    scheduler = generation_scheduler.stats()
+    out.metric("scheduler_active", "gauge", "Generation slots in use", [(None, scheduler["active"])])
+    out.metric("scheduler_queued", "gauge", "Generations waiting for a slot", [(None, scheduler["queued"])])
+    out.metric("scheduler_predicted_wait_seconds", "gauge", "Predicted queue wait of a new generation",
+               [(None, scheduler["predicted_wait_seconds"])])
+    out.metric("generation_cost_reference_seconds", "gauge",
+               "Cost model prediction for a 4 s, 10-step generation",
+               [(None, generation_cost_model.stats()["reference_seconds"])])
+    jobs = generation_jobs.stats()
+    out.metric("generation_jobs_active", "gauge", "Unfinished generation jobs", [(None, jobs["active"])])
+    out.metric("generation_jobs_finished_total", "counter", "Finished generation jobs by outcome",
+               (({"status": status}, n) for status, n in sorted(jobs["finished"].items())))
+    out.metric("generation_cancellations_total", "counter",
+               "Generations cancelled because their clients disconnected, by stage",
+               (({"stage": stage}, n) for stage, n in sorted(gateway_metrics.cancellations.items())))
+    out.metric("generation_gpu_seconds_saved_total", "counter",
+               "Estimated generator time not spent on cancelled generations",
+               [(None, gateway_metrics.gpu_seconds_saved)])
+
+    cache = generation_cache.stats()
+    out.metric("generation_cache_bytes", "gauge", "Bytes held by the in-memory generation cache",
+               [(None, cache["bytes"])])
+    out.metric("generation_cache_lookups_total", "counter", "Generation cache lookups by result",
+               [({"result": "hit"}, cache["hits"]), ({"result": "disk_hit"}, cache["disk_hits"]),
+                ({"result": "miss"}, cache["misses"])])
+    responses = encoded_motion_cache.stats()
+    out.metric("motion_response_cache_bytes", "gauge", "Bytes of encoded stored-motion bodies kept for reuse",
+               [(None, responses["bytes"])])
+    out.metric("motion_response_cache_lookups_total", "counter", "Encoded stored-motion body lookups by result",
+               [({"result": "hit"}, responses["hits"]), ({"result": "miss"}, responses["misses"])])
+    out.metric("coalesced_requests_total", "counter", "Requests served by another request's remote call",
+               [(None, generation_flights.coalesced)])
+    prompts = prompt_index.stats()
+    out.metric("prompt_index_prompts", "gauge", "Distinct prompts in the nearest-prompt index",
+               [(None, prompts["prompts"])])
+    out.metric("prompt_index_served_total", "counter", "Previous motions served from the prompt index, by use",
+               [({"use": "fallback"}, prompts["fallbacks"]), ({"use": "preview"}, prompts["previews"])])
+    out.metric("conversion_queue_depth", "gauge", "Conversions waiting in or running on the worker pool",
+               [(None, conversion_pool.depth)])
+    return Response(content=out.render(), media_type="text/plain; version=0.0.4")
+
+MOTION_FORMAT_QUERY = Query(
+    default=None,
+    alias="format",
+    pattern="^(json|binary)$",
+    description=f"Response encoding; `binary` is equivalent to `Accept: {MOTION_BINARY_MEDIA_TYPE}`",
+)
+MOTION_RESOLUTION_QUERY = Query(
+    default="full",
+    pattern="^(full|preview)$",
+    description="`preview`: motion decimated to about MOTION_PREVIEW_FPS (fetch the full rate by motion_id)",
+)
+MOTION_BINARY_RESPONSE_DOC = {
+    200: {"content": {MOTION_BINARY_MEDIA_TYPE: {}},
+          "description": "Motion as JSON, or in the binary motion format when requested"}
+}
+
+
+@app.post("/api/generate", response_model=GenerationResponse, responses=MOTION_BINARY_RESPONSE_DOC)
 async def generate_motion(
     request: TextToMotionRequest,
     background_tasks: BackgroundTasks,
-    http_request: Request
+    http_request: Request,
+    response_format: Optional[str] = MOTION_FORMAT_QUERY,
+    resolution: str = MOTION_RESOLUTION_QUERY
 ):
     """
     Generate motion from text description
     
     This endpoint:
     1. Receives text description and parameters
-    2. Forwards to remote WebSocket server
-    3. Converts NPZ response to JSON
-    4. Stores motion data for the session
-    5. Returns motion data to client
+    2. Runs a generation job (remote WebSocket server, NPZ -> motion, storage)
+    3. Waits for it, cancelling it if the client disconnects
+    4. Returns motion data to client (JSON, or binary when requested)
+    
+    With `resolution=preview` the response carries a decimated preview (about
+    5x smaller), and the full-rate motion is fetched by motion_id afterwards.
+    POST /api/jobs runs the same job without holding the request open.
     """
     require_allowed_origin(http_request)
     session = await get_bound_session(http_request, allow_create=False)
-    client_ip = get_client_ip(http_request)
+    await check_generation_rate_limits(session, get_client_ip(http_request))
+    request_data, cacheable = build_remote_request(request)
+    overloaded = admit_generation(session, request_data, cacheable, degradable=fallback_allowed(request))
     
-    # Check rate limit
-    if not app_state.check_rate_limit(session):
+    started = time.perf_counter()
+    try:
+        job = generation_jobs.submit(
+            session.session_id,
+            request.text,
+            lambda job: run_generation(request, request_data, cacheable, session, overloaded=overloaded),
+            retain=False
+        )
+        motion_id, motion_data = await cancel_on_disconnect(http_request, job.task)
+        fallback = motion_data.get("fallback")
+        # Degraded responses are marked, so clients can offer to retry later
+        headers = {"X-Motion-Fallback": f"{fallback['similarity']}"} if fallback else {}
+        motion = motion_data
+        if resolution == "preview":
+            motion = await conversion_pool.run(decimate_motion, motion_data, Config.MOTION_PREVIEW_FPS)
+        preview = preview_resolution(motion_id, motion)
+        if preview is not None:
+            headers["X-Motion-Full"] = preview["full"]
+        
+        if wants_binary_motion(http_request, response_format):
+            async with gateway_metrics.timed("binary_serialization"):
+                body = await conversion_pool.run(encode_motion_binary, motion)
+            return Response(
+                content=body,
+                media_type=MOTION_BINARY_MEDIA_TYPE,
+                headers={"X-Motion-ID": motion_id, "Vary": "Accept", **headers}
+            )
+        
+        # Fast path: the arrays are emitted as-is instead of being validated
+        # element by element through GenerationResponse/MotionData.
+        async with gateway_metrics.timed("json_conversion"):
+            body = await conversion_pool.run(render_motion_json, {
+                "success": True,
+                "motion_id": motion_id,
+                "motion": {k: motion[k] for k in MotionData.model_fields},
+                "message": ("Generator unavailable - closest previously generated motion" if fallback
+                            else "Motion generated successfully"),
+                "fallback": fallback,
+                "resolution": preview
+            })
+        return MotionJSONResponse(body, headers=headers)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Generation error: {e}")
         raise HTTPException(
-            status_code=429,
-            detail={"error": "Rate limit exceeded - max 10 requests per minute", "code": "RATE_LIMIT"}
+            status_code=500,
+            detail={"error": "Failed to generate motion", "code": "GENERATION_FAILED"}
         )
-    if not await app_state.check_ip_rate_limit(client_ip):
+    finally:
+        gateway_metrics.observe("generate_total", time.perf_counter() - started)
+
+
+def require_single_worker() -> None:
+    """Refuse job and batch requests when several worker processes share the port"""
+    if Config.WEB_CONCURRENCY > 1:
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "Generation jobs need a single gateway worker (WEB_CONCURRENCY=1); "
+                             "use POST /api/generate", "code": "JOBS_UNAVAILABLE"}
+        )
+
+
+@app.post("/api/jobs", status_code=202)
+async def submit_generation_job(request: TextToMotionRequest, http_request: Request):
+    """
+    Start a generation in the background and return at once
+    
+    The response carries the job id and its queue position. Status updates and
+    the final motion are pushed by GET /api/jobs/{job_id}/events (server-sent
+    events); GET /api/jobs/{job_id} returns the same data for polling.
+    """
+    require_allowed_origin(http_request)
+    require_single_worker()
+    session = await get_bound_session(http_request, allow_create=False)
+    await check_generation_rate_limits(session, get_client_ip(http_request))
+    if generation_jobs.active_count(session.session_id) >= Config.MAX_ACTIVE_JOBS_PER_SESSION:
+        gateway_metrics.count_rate_limit("TOO_MANY_JOBS")
         raise HTTPException(
             status_code=429,
-            detail={"error": "Rate limit exceeded for IP", "code": "IP_RATE_LIMIT"}
+            detail={"error": f"At most {Config.MAX_ACTIVE_JOBS_PER_SESSION} unfinished jobs per session",
+                    "code": "TOO_MANY_JOBS"}
         )
+    request_data, cacheable = build_remote_request(request)
+    overloaded = admit_generation(session, request_data, cacheable, degradable=fallback_allowed(request))
+    job = generation_jobs.submit(
+        session.session_id,
+        request.text,
+        lambda job: run_generation(request, request_data, cacheable, session, job, overloaded)
+    )
     
-    # Prepare request for remote server
-    request_data = {
-        "text": request.text,
-        "motion_length": request.motion_length,
-        "num_inference_steps": request.num_inference_steps,
-        "seed": request.seed if request.seed is not None else int(time.time() % 10000),
-        "smooth": request.smooth,
-        "smooth_window": request.smooth_window,
-        "adaptive_smooth": request.adaptive_smooth,
-        "static_start": request.static_start,
-        "static_frames": request.static_frames,
-        "blend_frames": request.blend_frames
+    status = job_snapshot(job)
+    if status["status"] == "queued" and status["position"] is None:
+        # Not at the scheduler yet: it will wait behind everything queued now
+        busy = generation_scheduler.queued or not generation_scheduler.has_capacity()
+        status["position"] = generation_scheduler.queued if busy else 0
+        status["estimated_wait_seconds"] = generation_scheduler.estimate_wait(status["position"]) if busy else 0.0
+    status["links"] = {
+        "status": f"/api/jobs/{job.job_id}",
+        "events": f"/api/jobs/{job.job_id}/events",
     }
+    return JSONResponse(status_code=202, content=status, headers={"Location": status["links"]["status"]})
+
+
+@app.get("/api/jobs")
+async def list_generation_jobs(http_request: Request):
+    """Unfinished and recently finished jobs of the current session"""
+    require_allowed_origin(http_request)
+    require_single_worker()
+    session = await get_bound_session(http_request, allow_create=False)
+    return {"jobs": [job_snapshot(job) for job in generation_jobs.session_jobs(session.session_id)]}
+
+
+async def get_session_job(http_request: Request, job_id: str) -> Tuple[UserSession, GenerationJob]:
+    require_allowed_origin(http_request)
+    require_single_worker()
+    session = await get_bound_session(http_request, allow_create=False)
+    job = generation_jobs.get(job_id, session.session_id)
+    if job is None:
+        raise HTTPException(
+            status_code=404,
+            detail={"error": "Job not found", "code": "JOB_NOT_FOUND"}
+        )
+    return session, job
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_generation_job(
+    job_id: str,
+    http_request: Request,
+    wait: float = Query(default=0, ge=0, le=30, description="Long poll: seconds to wait for a status change"),
+    resolution: str = MOTION_RESOLUTION_QUERY
+):
+    """
+    Job status (polling fallback of /events); includes the motion once succeeded
+    """
+    session, job = await get_session_job(http_request, job_id)
+    if wait and job.status not in JOB_FINAL_STATES:
+        try:
+            await asyncio.wait_for(job.changed.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+    return MotionJSONResponse(await render_job(job, session, preview=resolution == "preview"))
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def generation_job_events(job_id: str, http_request: Request, resolution: str = MOTION_RESOLUTION_QUERY):
+    """
+    Server-sent events of a job: `status` whenever its status or queue position
+    changes, then one `result` event with the body of GET /api/jobs/{job_id}
     
-    # Remove None values
-    request_data = {k: v for k, v in request_data.items() if v is not None}
+    Streamed jobs (`"stream": true`) also get `chunk` events while generating:
+    base64 of a binary motion payload whose header has `start_frame`. Frames are
+    written at that offset; a later chunk may cover frames again and replaces them.
     
-    try:
-        # Generate motion from remote server
-        npz_bytes = await generate_motion_from_remote(request_data)
-        
-        # Generate motion ID
-        motion_id = f"gen_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
-        motion_name = f"[AI] {request.text[:30]}"
-        
-        # Convert to motion data
-        motion_data = convert_npz_to_motion_data(npz_bytes, motion_name)
-        motion_data['motion_id'] = motion_id
-        motion_data['text_prompt'] = request.text
-        motion_data['parameters'] = {
-            "motion_length": request.motion_length,
-            "num_inference_steps": request.num_inference_steps,
-            "adaptive_smooth": request.adaptive_smooth,
-            "static_start": request.static_start,
-            "transition_steps": request.transition_steps
-        }
-        
-        # Store in session (enforce limit)
-        enforce_motion_limit(session)
-        session.motions[motion_id] = motion_data
-        
-        logger.info(f"Generated motion {motion_id} for session {session.session_id}")
-        
-        return GenerationResponse(
-            success=True,
-            motion_id=motion_id,
-            motion=MotionData(**{k: v for k, v in motion_data.items() 
-                                if k in ['name', 'fps', 'joint_pos', 'root_pos', 'root_quat', 
-                                        'frame_count', 'duration', 'created_at']}),
-            message="Motion generated successfully"
+    Jobs with `"preview": true` get one `preview` event first when a similar
+    prompt was generated before: base64 of that whole motion (binary format);
+    the `preview` field of the status gives its similarity (the matched prompt
+    itself is never returned, it may belong to another session).
+    
+    With `resolution=preview` the `result` carries the decimated motion and is
+    followed by a `full` event with the full-rate body, so a client can show
+    the motion before the full data has arrived.
+    """
+    session, job = await get_session_job(http_request, job_id)
+    
+    async def events():
+        last = None
+        idle = 0.0
+        sent = 0
+        preview_sent = False
+        while True:
+            if job.status in JOB_FINAL_STATES:
+                if resolution == "preview":
+                    yield b"event: result\ndata: " + await render_job(job, session, preview=True) + b"\n\n"
+                    if job.status != "succeeded":
+                        return
+                    yield b"event: full\ndata: " + await render_job(job, session) + b"\n\n"
+                    return
+                yield b"event: result\ndata: " + await render_job(job, session) + b"\n\n"
+                return
+            if job.preview is not None and not preview_sent:
+                yield b"event: preview\ndata: " + base64.b64encode(job.preview) + b"\n\n"
+                preview_sent = True
+            chunks = job.chunks[sent:]
+            for chunk in chunks:
+                yield b"event: chunk\ndata: " + base64.b64encode(chunk) + b"\n\n"
+            sent += len(chunks)
+            status = job_snapshot(job)
+            if status != last:
+                yield f"event: status\ndata: {json.dumps(status)}\n\n".encode()
+                last = status
+                idle = 0.0
+            elif idle >= Config.JOB_EVENTS_KEEPALIVE_SECONDS:
+                yield b": keepalive\n\n"
+                idle = 0.0
+            # Woken at once by status changes; queue positions are re-checked every second
+            try:
+                await asyncio.wait_for(job.changed.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                idle += 1.0
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_generation_job(job_id: str, http_request: Request):
+    """Cancel a queued or running job (finished jobs are left as they are)"""
+    _, job = await get_session_job(http_request, job_id)
+    await generation_jobs.cancel(job)
+    return job_snapshot(job)
+
+
+@app.post("/api/batches", status_code=202)
+async def submit_generation_batch(request: BatchGenerationRequest, http_request: Request):
+    """
+    Generate many motions in one call (e.g. building a motion library)
+    
+    Every item becomes a job (see /api/jobs); up to BATCH_MAX_PARALLEL run at
+    once, at BATCH_PRIORITY so interactive generations go first. The batch uses
+    one rate-limit slot; each item's predicted cost is charged to the session's
+    generation-seconds quota as it starts, so a large batch runs at the quota's
+    rate. Progress and each finished motion are pushed by
+    GET /api/batches/{batch_id}/events.
+    """
+    require_allowed_origin(http_request)
+    require_single_worker()
+    session = await get_bound_session(http_request, allow_create=False)
+    await check_generation_rate_limits(session, get_client_ip(http_request))
+    if generation_jobs.active_batches(session.session_id) >= 1:
+        gateway_metrics.count_rate_limit("TOO_MANY_BATCHES")
+        raise HTTPException(
+            status_code=429,
+            detail={"error": "A batch of this session is still running", "code": "TOO_MANY_BATCHES"}
         )
+    overloaded = queue_overloaded()
+    if overloaded is not None:
+        raise overloaded
+    
+    items = []
+    for item in request.items:
+        item = item.model_copy(update={"priority": Config.BATCH_PRIORITY})
+        request_data, cacheable = build_remote_request(item)
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Generation error: {e}")
+        async def run_item(job: GenerationJob, item=item, request_data=request_data, cacheable=cacheable):
+            await pace_generation_quota(session, request_data, cacheable)
+            return await run_generation(item, request_data, cacheable, session, job)
+        
+        items.append((item.text, run_item))
+    batch = generation_jobs.submit_batch(session.session_id, items, Config.BATCH_MAX_PARALLEL)
+    logger.info(f"Started batch {batch.batch_id} of {len(items)} generations for session {session.session_id}")
+    
+    status = batch_snapshot(batch)
+    status["links"] = {
+        "status": f"/api/batches/{batch.batch_id}",
+        "events": f"/api/batches/{batch.batch_id}/events",
+    }
+    return JSONResponse(status_code=202, content=status, headers={"Location": status["links"]["status"]})
+
+
+def get_session_batch(session: UserSession, batch_id: str) -> GenerationBatch:
+    require_single_worker()
+    batch = generation_jobs.get_batch(batch_id, session.session_id)
+    if batch is None:
         raise HTTPException(
-            status_code=500,
-            detail={"error": "Failed to generate motion", "code": "GENERATION_FAILED"}
+            status_code=404,
+            detail={"error": "Batch not found", "code": "BATCH_NOT_FOUND"}
         )
+    return batch
+
+
+@app.get("/api/batches/{batch_id}")
+async def get_generation_batch(
+    batch_id: str,
+    http_request: Request,
+    wait: float = Query(default=0, ge=0, le=30, description="Long poll: seconds to wait for an item to finish")
+):
+    """
+    Batch progress and per-item status; finished motions are fetched by motion_id
+    (the session keeps only the newest MAX_STORED_MOTIONS_PER_USER, /events carries all)
+    """
+    require_allowed_origin(http_request)
+    session = await get_bound_session(http_request, allow_create=False)
+    batch = get_session_batch(session, batch_id)
+    if wait and not batch.done:
+        try:
+            await asyncio.wait_for(batch.changed.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+    return batch_snapshot(batch)
+
+
+@app.get("/api/batches/{batch_id}/events")
+async def generation_batch_events(batch_id: str, http_request: Request):
+    """
+    Server-sent events of a batch: an `item` event as each item finishes (the
+    body of GET /api/jobs/{job_id} plus its `index`, with the motion when it
+    succeeded), `progress` with the status counts, then one final `result`
+    with the body of GET /api/batches/{batch_id}
+    """
+    require_allowed_origin(http_request)
+    session = await get_bound_session(http_request, allow_create=False)
+    batch = get_session_batch(session, batch_id)
+    
+    async def events():
+        sent = set()
+        idle = 0.0
+        while True:
+            changed = batch.changed
+            finished = [(i, job) for i, job in enumerate(batch.jobs)
+                        if i not in sent and job.status in JOB_FINAL_STATES]
+            for i, job in finished:
+                yield b"event: item\ndata: " + await render_job(job, session, index=i) + b"\n\n"
+                sent.add(i)
+            if finished:
+                yield f"event: progress\ndata: {json.dumps(batch_snapshot(batch)['counts'])}\n\n".encode()
+                idle = 0.0
+            if len(sent) == len(batch.jobs):
+                yield f"event: result\ndata: {json.dumps(batch_snapshot(batch))}\n\n".encode()
+                return
+            if idle >= Config.JOB_EVENTS_KEEPALIVE_SECONDS:
+                yield b": keepalive\n\n"
+                idle = 0.0
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                idle += 1.0
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.delete("/api/batches/{batch_id}")
+async def cancel_generation_batch(batch_id: str, http_request: Request):
+    """Cancel the unfinished items of a batch (finished ones are kept)"""
+    require_allowed_origin(http_request)
+    session = await get_bound_session(http_request, allow_create=False)
+    batch = get_session_batch(session, batch_id)
+    await generation_jobs.cancel_batch(batch)
+    return batch_snapshot(batch)
+
+
+@app.get("/api/queue")
+async def get_queue_status(http_request: Request):
+    """Queue position and estimated wait of the current session's pending generations"""
+    require_allowed_origin(http_request)
+    session = await get_bound_session(http_request, allow_create=False)
+    return generation_scheduler.session_status(session.session_id)
+
+
+@app.delete("/api/queue")
+async def cancel_queued_generations(http_request: Request):
+    """Cancel the current session's generations that are still waiting for a slot"""
+    require_allowed_origin(http_request)
+    session = await get_bound_session(http_request, allow_create=False)
+    count = await generation_jobs.cancel_queued(session.session_id)
+    logger.info(f"Cancelled {count} queued generations for session {session.session_id}")
+    return {"success": True, "cancelled": count}
 
 
 @app.get("/api/motions")
@@ -606,19 +4273,8 @@ async def list_motions(http_request: Request):
     """List all motions for the current session"""
     require_allowed_origin(http_request)
     session = await get_bound_session(http_request, allow_create=False)
-    session.last_activity = datetime.now()
-    
-    motions_list = [
-        {
-            "motion_id": mid,
-            "name": mdata.get("name", "Unknown"),
-            "frame_count": mdata.get("frame_count", 0),
-            "duration": mdata.get("duration", 0),
-            "created_at": mdata.get("created_at", ""),
-            "text_prompt": mdata.get("text_prompt", "")[:100]
-        }
-        for mid, mdata in session.motions.items()
-    ]
+    
+    motions_list = await app_state.store.list_motions(session)
     
     return {
         "motions": sorted(motions_list, key=lambda x: x["created_at"], reverse=True),
@@ -626,17 +4282,61 @@ async def list_motions(http_request: Request):
     }
 
 
-@app.get("/api/motions/{motion_id}")
-async def get_motion(motion_id: str, http_request: Request):
-    """Get specific motion data by ID"""
+@app.get("/api/motions/{motion_id}", responses=MOTION_BINARY_RESPONSE_DOC)
+async def get_motion(
+    motion_id: str,
+    http_request: Request,
+    response_format: Optional[str] = MOTION_FORMAT_QUERY,
+    resolution: str = MOTION_RESOLUTION_QUERY
+):
+    """
+    Get specific motion data by ID (JSON, or binary when requested)
+    
+    Stored motions are immutable: bodies are encoded and compressed once, carry
+    strong ETags and `Cache-Control: immutable`, and `If-None-Match` gets a 304.
+    `resolution=preview` returns the decimated preview.
+    """
     require_allowed_origin(http_request)
     session = await get_bound_session(http_request, allow_create=False)
-    session.last_activity = datetime.now()
     
-    if motion_id not in session.motions:
+    if not await app_state.store.has_motion(session, motion_id):
         raise HTTPException(status_code=404, detail="Motion not found")
     
-    return session.motions[motion_id]
+    binary = wants_binary_motion(http_request, response_format)
+    fmt = ("binary" if binary else "json") + ("-preview" if resolution == "preview" else "")
+    media_type = MOTION_BINARY_MEDIA_TYPE if binary else "application/json"
+    headers = {
+        "Cache-Control": f"private, max-age={Config.DATA_RETENTION_MINUTES * 60}, immutable",
+        "Vary": "Accept, Accept-Encoding",
+    }
+    codings = accepted_codings(http_request.headers.get("accept-encoding", ""))
+    
+    etag = matching_etag(http_request.headers.get("if-none-match", ""), motion_id, fmt)
+    if etag is not None:
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    
+    key = (session.session_id, motion_id, fmt)
+    bodies = encoded_motion_cache.get(key)
+    if bodies is None:
+        if fmt == "binary" and codings == {"identity"}:
+            path = app_state.store.motion_file(session, motion_id)
+            if path is not None:
+                # Spilled motions are already stored in the binary format
+                headers["ETag"] = motion_etag(motion_id, fmt, "identity")
+                return FileResponse(path, media_type=media_type, headers=headers)
+        
+        motion = await app_state.store.get_motion(session, motion_id)
+        if motion is None:
+            raise HTTPException(status_code=404, detail="Motion not found")
+        async with gateway_metrics.timed("binary_serialization" if binary else "json_conversion"):
+            bodies = await conversion_pool.run(encode_motion_bodies, motion, fmt)
+        encoded_motion_cache.put(key, bodies)
+    
+    coding = next(c for c in MOTION_CONTENT_CODINGS if c in bodies and c in codings)
+    headers["ETag"] = motion_etag(motion_id, fmt, coding)
+    if coding != "identity":
+        headers["Content-Encoding"] = coding
+    return Response(content=bodies[coding], media_type=media_type, headers=headers)
 
 
 @app.delete("/api/motions/{motion_id}")
@@ -645,10 +4345,10 @@ async def delete_motion(motion_id: str, http_request: Request):
     require_allowed_origin(http_request)
     session = await get_bound_session(http_request, allow_create=False)
     
-    if motion_id not in session.motions:
+    if not await app_state.store.delete_motion(session, motion_id):
         raise HTTPException(status_code=404, detail="Motion not found")
+    encoded_motion_cache.discard_motion(session.session_id, motion_id)
     
-    del session.motions[motion_id]
     logger.info(f"Deleted motion {motion_id} from session {session.session_id}")
     
     return {"success": True, "message": "Motion deleted"}
@@ -659,8 +4359,8 @@ async def clear_motions(http_request: Request):
     """Clear all generated motions for the current session"""
     require_allowed_origin(http_request)
     session = await get_bound_session(http_request, allow_create=False)
-    count = len(session.motions)
-    session.motions.clear()
+    count = await app_state.store.clear_motions(session)
+    encoded_motion_cache.discard_session(session.session_id)
     logger.info(f"Cleared {count} motions for session {session.session_id}")
     return {"success": True, "cleared": count}
 
@@ -697,13 +4397,16 @@ async def get_config(http_request: Request):
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
-    """Custom HTTP exception handler"""
+    """Custom HTTP exception handler (extra detail fields, e.g. retry_after_seconds, are passed through)"""
+    extra = {k: v for k, v in exc.detail.items() if k not in ("error", "code")} if isinstance(exc.detail, dict) else {}
     return JSONResponse(
         status_code=exc.status_code,
+        headers=getattr(exc, "headers", None),
         content={
             "success": False,
             "error": exc.detail.get("error", str(exc.detail)) if isinstance(exc.detail, dict) else str(exc.detail),
-            "code": exc.detail.get("code", "UNKNOWN") if isinstance(exc.detail, dict) else "UNKNOWN"
+            "code": exc.detail.get("code", "UNKNOWN") if isinstance(exc.detail, dict) else "UNKNOWN",
+            **extra
         }
     )
 
@@ -731,6 +4434,6 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     
     logger.info(f"Starting server on {host}:{port}")
-    logger.info(f"Remote WebSocket: {Config.REMOTE_WS_HOST}:{Config.REMOTE_WS_PORT}")
+    logger.info(f"Remote WebSocket backends: {', '.join(b.uri for b in remote_backends.backends)}")
     
     uvicorn.run(app, host=host, port=port)
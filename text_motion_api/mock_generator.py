@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the remote motion generation server (no GPU needed).
+
+Speaks the WebSocket protocol of `sim2real/CLIENT_API.md`: JSON requests on
+`/ws`, answered with a 38D NPZ payload (`fps`, `joint_pos`, `root_pos`,
+`root_rot`) or a JSON error frame; `GET /` is the health endpoint. It also
+understands the gateway's extensions: batched requests (`{"batch": [...]}`,
+enabled with --max-batch-size) and streamed frame chunks (`"stream": true`,
+enabled with --streaming).
+
+Motions are smooth and deterministic per (text, seed), so they look sane in
+the demo and exercise the gateway's generation cache.
+
+Example:
+  python3 mock_generator.py --port 8000
+  python3 mock_generator.py --latency lognormal:1.5,0.3 --error-rate 0.02 --gpu-slots 1
+  python3 mock_generator.py --latency fixed:0.2 --max-batch-size 8 --streaming
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import random
+import time
+from http import HTTPStatus
+
+import numpy as np
+import websockets
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("mock_generator")
+
+NUM_JOINTS = 29
+MAX_MOTION_LENGTH = 9.8  # seconds, as documented for the real server
+
+
+# ==================== Latency ====================
+
+class LatencyModel:
+    """
+    Generation time distribution, parsed from "<kind>:<params>"
+
+    - fixed:SECONDS
+    - uniform:LOW,HIGH
+    - normal:MEAN,STDDEV           (clamped at 0)
+    - lognormal:MEDIAN,SIGMA       (sigma of the underlying normal)
+    - exponential:MEAN
+
+    Samples are scaled by num_inference_steps / reference_steps when
+    `scale_with_steps` is set (diffusion time is roughly linear in steps).
+    """
+
+    def __init__(self, spec: str, reference_steps: int = 10, scale_with_steps: bool = True):
+        kind, _, params = spec.partition(":")
+        self.kind = kind.strip().lower()
+        self.params = [float(p) for p in params.split(",") if p.strip()]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exponential": 1}
+        if expected.get(self.kind) != len(self.params):
+            raise ValueError(f"Invalid latency spec {spec!r}")
+        self.reference_steps = reference_steps
+        self.scale_with_steps = scale_with_steps
+
+    def sample(self, rng: random.Random, steps: int) -> float:
+        p = self.params
+        if self.kind == "fixed":
+            seconds = p[0]
+        elif self.kind == "uniform":
+            seconds = rng.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            seconds = max(0.0, rng.gauss(p[0], p[1]))
+        elif self.kind == "lognormal":
+            seconds = p[0] * rng.lognormvariate(0.0, p[1])
+        else:
+            seconds = rng.expovariate(1.0 / p[0]) if p[0] > 0 else 0.0
+        if self.scale_with_steps:
+            seconds *= max(1, steps) / self.reference_steps
+        return seconds
+
+
+# ==================== Motion ====================
+
+def _motion_rng(request: dict) -> np.random.Generator:
+    key = f"{request.get('text', '')}|{request.get('seed', 0)}".encode("utf-8")
+    return np.random.default_rng(int.from_bytes(hashlib.sha256(key).digest()[:8], "little"))
+
+
+def make_motion(request: dict, fps: int, frames: int) -> dict:
+    """Smooth periodic 38D motion: swinging joints, root walking along a gentle curve"""
+    rng = _motion_rng(request)
+    t = np.arange(frames, dtype=np.float32) / fps
+    freq = rng.uniform(0.5, 1.5)
+    phase = rng.uniform(0, 2 * np.pi, size=NUM_JOINTS).astype(np.float32)
+    amplitude = rng.uniform(0.05, 0.6, size=NUM_JOINTS).astype(np.float32)
+    joint_pos = amplitude * np.sin(2 * np.pi * freq * t[:, None] + phase)
+
+    speed = rng.uniform(0.0, 1.2)
+    yaw_rate = rng.uniform(-0.3, 0.3)
+    yaw = yaw_rate * t
+    root_pos = np.stack([
+        np.cumsum(speed * np.cos(yaw)) / fps,
+        np.cumsum(speed * np.sin(yaw)) / fps,
+        0.78 + 0.02 * np.sin(4 * np.pi * freq * t),
+    ], axis=1)
+    root_rot = np.stack([np.cos(yaw / 2), np.zeros_like(yaw), np.zeros_like(yaw), np.sin(yaw / 2)], axis=1)
+
+    if request.get("static_start", False):
+        static = min(frames, int(request.get("static_frames", 2)))
+        joint_pos[:static] = joint_pos[static] if static < frames else 0.0
+
+    return {
+        "fps": np.array([fps], dtype=np.int32),
+        "joint_pos": joint_pos.astype(np.float32),
+        "root_pos": root_pos.astype(np.float32),
+        "root_rot": root_rot.astype(np.float32),
+    }
+
+
+def encode_npz(arrays: dict, compressed: bool = True) -> bytes:
+    buf = io.BytesIO()
+    (np.savez_compressed if compressed else np.savez)(buf, **arrays)
+    return buf.getvalue()
+
+
+def error_frame(message: str, code: str) -> str:
+    return json.dumps({"error": message, "code": code})
+
+
+# ==================== Server ====================
+
+class MockGenerator:
+    """WebSocket generation server with configurable latency, errors and clip lengths"""
+
+    def __init__(self, args):
+        self.args = args
+        self.latency = LatencyModel(args.latency, args.reference_steps, not args.no_step_scaling)
+        self.rng = random.Random(args.seed)
+        # Generations running at once, like slots on a GPU
+        self.gpu = asyncio.Semaphore(args.gpu_slots) if args.gpu_slots > 0 else None
+        self.requests = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.cancelled = 0
+        self.connections = 0
+
+    def health(self) -> dict:
+        return {
+            "status": "running",
+            "service": "Mock Robot Motion Generation Server",
+            "model_iteration": 0,
+            "dim_pose": 38,
+            "fps": self.args.fps,
+            "max_batch_size": self.args.max_batch_size,
+            "streaming": self.args.streaming,
+            "requests": self.requests,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+        }
+
+    def process_request(self, connection, request):
+        if request.path != "/ws":
+            return connection.respond(HTTPStatus.OK, json.dumps(self.health()) + "\n")
+        return None
+
+    def frame_count(self, request: dict) -> int:
+        if self.args.frames:
+            return self.args.frames
+        length = min(float(request.get("motion_length", 4.0)), MAX_MOTION_LENGTH)
+        return max(1, int(round(length * self.args.fps)))
+
+    @staticmethod
+    def steps(request) -> int:
+        try:
+            return int(request.get("num_inference_steps", 10))
+        except (AttributeError, TypeError, ValueError):
+            return 10
+
+    @staticmethod
+    def validate(request) -> str:
+        if not isinstance(request, dict):
+            return "Request must be a JSON object"
+        if not request.get("text"):
+            return "Missing required field: 'text'"
+        try:
+            length = float(request.get("motion_length", 4.0))
+            steps = int(request.get("num_inference_steps", 10))
+        except (TypeError, ValueError):
+            return "Invalid motion_length or num_inference_steps"
+        if not 0.1 <= length <= MAX_MOTION_LENGTH or not 1 <= steps <= 1000:
+            return "motion_length or num_inference_steps out of range"
+        return ""
+
+    async def handler(self, ws) -> None:
+        self.connections += 1
+        try:
+            async for message in ws:
+                await self.serve(ws, message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def serve(self, ws, message) -> None:
+        try:
+            request = json.loads(message)
+        except (json.JSONDecodeError, TypeError):
+            await ws.send(error_frame("Malformed JSON", "INVALID_JSON"))
+            return
+        if isinstance(request, dict) and "batch" in request:
+            items = request["batch"]
+            if not isinstance(items, list) or not 1 <= len(items) <= self.args.max_batch_size:
+                await ws.send(error_frame(f"Batch size must be 1..{self.args.max_batch_size}", "INVALID_REQUEST"))
+                return
+        else:
+            items = [request]
+        self.requests += len(items)
+
+        first = items[0] if isinstance(items[0], dict) else {}
+        stream = len(items) == 1 and self.args.streaming and bool(first.get("stream"))
+        steps = max(self.steps(item) for item in items)
+        seconds = self.latency.sample(self.rng, steps) * (1 + self.args.batch_overhead * (len(items) - 1))
+
+        if self.gpu is not None:
+            await self.gpu.acquire()
+        try:
+            if self.rng.random() < self.args.disconnect_rate:
+                # Crash mid-generation: the gateway sees the connection drop
+                self.disconnects += 1
+                await asyncio.sleep(seconds * self.rng.random())
+                ws.transport.abort()
+                return
+            if stream:
+                await self.generate_streamed(ws, items[0], seconds)
+                return
+            if not await self.busy(ws, seconds):
+                return
+        finally:
+            if self.gpu is not None:
+                self.gpu.release()
+
+        for item in items:
+            problem = self.validate(item)
+            if problem:
+                self.errors += 1
+                await ws.send(error_frame(problem, "INVALID_REQUEST"))
+            elif self.rng.random() < self.args.error_rate:
+                self.errors += 1
+                await ws.send(error_frame("Model inference failed (injected)", "GENERATION_ERROR"))
+            else:
+                arrays = make_motion(item, self.args.fps, self.frame_count(item))
+                await ws.send(encode_npz(arrays, not self.args.uncompressed))
+
+    async def busy(self, ws, seconds: float) -> bool:
+        """Simulate generation; False when the client went away meanwhile (work abandoned)"""
+        closed = asyncio.ensure_future(ws.wait_closed())
+        try:
+            await asyncio.wait_for(asyncio.shield(closed), timeout=seconds)
+        except asyncio.TimeoutError:
+            return True
+        finally:
+            closed.cancel()
+        self.cancelled += 1
+        logger.info("Client disconnected, generation abandoned")
+        return False
+
+    async def generate_streamed(self, ws, request: dict, seconds: float) -> None:
+        problem = self.validate(request)
+        if problem:
+            self.errors += 1
+            await ws.send(error_frame(problem, "INVALID_REQUEST"))
+            return
+        frames = self.frame_count(request)
+        arrays = make_motion(request, self.args.fps, frames)
+        chunk = max(1, self.args.chunk_frames)
+        for start in range(0, frames, chunk):
+            if not await self.busy(ws, seconds * min(chunk, frames - start) / frames):
+                return
+            part = {k: v if k == "fps" else v[start:start + chunk] for k, v in arrays.items()}
+            part["start_frame"] = np.array([start], dtype=np.int32)
+            await ws.send(encode_npz(part, compressed=False))
+        await ws.send(encode_npz(arrays, not self.args.uncompressed))
+
+    async def report_loop(self, interval: float) -> None:
+        last, last_at = 0, time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            rate = (self.requests - last) / (now - last_at)
+            last, last_at = self.requests, now
+            logger.info(f"requests {self.requests} ({rate:.1f}/s), errors {self.errors}, "
+                        f"disconnects {self.disconnects}, abandoned {self.cancelled}, connections {self.connections}")
+
+    async def run(self) -> None:
+        async with websockets.serve(
+            self.handler,
+            self.args.host,
+            self.args.port,
+            max_size=None,
+            process_request=self.process_request,
+        ):
+            logger.info(f"Mock generator on ws://{self.args.host}:{self.args.port}/ws "
+                        f"(latency {self.args.latency}, error rate {self.args.error_rate}, "
+                        f"gpu slots {self.args.gpu_slots or 'unlimited'})")
+            if self.args.report_interval > 0:
+                await self.report_loop(self.args.report_interval)
+            else:
+                await asyncio.Future()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="lognormal:1.0,0.25",
+                        help="Generation time distribution (see LatencyModel), default %(default)s")
+    parser.add_argument("--reference-steps", type=int, default=10,
+                        help="num_inference_steps the latency distribution refers to")
+    parser.add_argument("--no-step-scaling", action="store_true",
+                        help="Do not scale latency with num_inference_steps")
+    parser.add_argument("--gpu-slots", type=int, default=1, help="Concurrent generations (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction answered with GENERATION_ERROR")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0,
+                        help="Fraction where the connection is dropped mid-generation")
+    parser.add_argument("--fps", type=int, default=50)
+    parser.add_argument("--frames", type=int, default=0, help="Fixed clip length in frames (0 = from motion_length)")
+    parser.add_argument("--uncompressed", action="store_true", help="Send np.savez instead of np.savez_compressed")
+    parser.add_argument("--max-batch-size", type=int, default=1, help="Advertised batch size (1 = no batching)")
+    parser.add_argument("--batch-overhead", type=float, default=0.1,
+                        help="Extra latency per additional batch item, as a fraction of one generation")
+    parser.add_argument("--streaming", action="store_true", help="Advertise and serve streamed frame chunks")
+    parser.add_argument("--chunk-frames", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the latency/error sampling")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="Seconds between stats lines (0 = off)")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    try:
+        asyncio.run(MockGenerator(args).run())
+    except KeyboardInterrupt:
+        pass
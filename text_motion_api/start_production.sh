@@ -18,7 +18,17 @@ export DATA_RETENTION_MINUTES=${DATA_RETENTION_MINUTES:-30}
 export CLEANUP_INTERVAL_MINUTES=${CLEANUP_INTERVAL_MINUTES:-5}
 export MAX_STORED_MOTIONS_PER_USER=${MAX_STORED_MOTIONS_PER_USER:-10}
 export MAX_REQUESTS_PER_MINUTE=${MAX_REQUESTS_PER_MINUTE:-10}
+# Sessions persist across restarts in the SQLite store
+export SESSION_STORE=${SESSION_STORE:-sqlite}
+export SESSION_STORE_PATH=${SESSION_STORE_PATH:-./sessions.db}
 export ALLOWED_ORIGINS=${ALLOWED_ORIGINS:-*}
+# One worker process: generation jobs and batches live in the worker that runs
+# them (their APIs are refused with more workers). The gateway is async, and
+# CPU-bound motion conversion runs in a process pool instead. Several workers
+# can share sessions through the SQLite store, but then only sessions, motions
+# and POST /api/generate are served.
+export WEB_CONCURRENCY=${WEB_CONCURRENCY:-1}
+export CONVERSION_EXECUTOR=${CONVERSION_EXECUTOR:-process}
 
 echo "=========================================="
 echo "Text-to-Motion API Gateway (Production)"
@@ -30,18 +40,20 @@ echo "  Remote WS:     ws://${REMOTE_WS_HOST}:${REMOTE_WS_PORT}${REMOTE_WS_PATH}
 echo "  Data retention: ${DATA_RETENTION_MINUTES} minutes"
 echo "  Max motions:   ${MAX_STORED_MOTIONS_PER_USER} per user"
 echo "  Rate limit:    ${MAX_REQUESTS_PER_MINUTE} req/min"
+echo "  Session store: ${SESSION_STORE} (${SESSION_STORE_PATH})"
+echo "  Workers:       ${WEB_CONCURRENCY}"
 echo ""
 echo "Starting server with production settings..."
 echo ""
 
 # Run with uvicorn in production mode
-# - More workers for better concurrency
+# - WEB_CONCURRENCY workers (see above)
 # - No reload for stability
 # - Larger timeout for long generation requests
 exec uvicorn main:app \
     --host ${HOST} \
     --port ${PORT} \
-    --workers 4 \
+    --workers ${WEB_CONCURRENCY} \
     --timeout-keep-alive 120 \
     --access-log \
     --proxy-headers
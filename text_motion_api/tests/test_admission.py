@@ -0,0 +1,21 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def test_generation_quota_body_carries_retry_seconds(monkeypatch):
+    monkeypatch.setattr(main.app_state, "take_generation_seconds", lambda session_id, seconds: 12.3)
+    session = SimpleNamespace(session_id="s")
+    with pytest.raises(HTTPException) as error:
+        main.admit_generation(session, {"text": "walk", "motion_length": 4.0}, cacheable=False)
+    assert error.value.headers["Retry-After"] == "13"
+
+    response = asyncio.run(main.http_exception_handler(None, error.value))
+    body = json.loads(response.body)
+    assert response.status_code == 429 and response.headers["Retry-After"] == "13"
+    assert body["code"] == "GENERATION_QUOTA" and body["retry_after_seconds"] == 13
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    """2 generation-seconds of burst refilled at 10 per second; every request costs 1 s"""
+    bucket = main.TokenBucketLimiter(per_minute=600, capacity=2, max_keys=100)
+    monkeypatch.setattr(main.app_state, "generation_quota", bucket)
+    monkeypatch.setattr(main, "generation_cost_model", main.GenerationCostModel(prior_seconds=1.0))
+    monkeypatch.setattr(main, "generation_cache", main.GenerationCache(max_bytes=1 << 20))
+    return bucket
+
+
+def test_batch_items_are_paced_by_the_quota(quota):
+    session = SimpleNamespace(session_id="s")
+    request_data = {"text": "walk", "motion_length": 4.0, "num_inference_steps": 10}
+    started = []
+
+    async def item(job):
+        await main.pace_generation_quota(session, request_data, cacheable=False)
+        started.append(time.monotonic())
+        return "m", {}
+
+    async def scenario():
+        jobs = main.GenerationJobManager(retention=60)
+        begin = time.monotonic()
+        batch = jobs.submit_batch("s", [("walk", item)] * 4, parallel=4)
+        await asyncio.gather(*(job.task for job in batch.jobs))
+        return begin, batch
+
+    begin, batch = run(scenario())
+    assert batch.done and all(job.status == "succeeded" for job in batch.jobs)
+    delays = sorted(t - begin for t in started)
+    # Two fit the burst; each further item waits for one more second of quota (0.1 s here)
+    assert delays[1] < 0.05 and 0.08 < delays[2] < 0.5 and delays[3] > delays[2] + 0.05
+
+
+def test_cached_batch_items_are_free(quota):
+    session = SimpleNamespace(session_id="s")
+    request_data = {"text": "walk", "motion_length": 4.0, "num_inference_steps": 10, "seed": 1}
+    main.generation_cache._put_memory(main.GenerationCache.key_for(request_data), b"npz")
+
+    async def scenario():
+        for _ in range(5):
+            await asyncio.wait_for(main.pace_generation_quota(session, request_data, cacheable=True), 0.05)
+
+    run(scenario())
+    assert main.app_state.take_generation_seconds("s", 2.0) == 0  # burst untouched
+
+
+def test_batch_runs_at_most_parallel_items():
+    running, peak = 0, 0
+
+    async def item(job):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return "m", {}
+
+    async def scenario():
+        jobs = main.GenerationJobManager(retention=60)
+        batch = jobs.submit_batch("s", [("walk", item)] * 7, parallel=2)
+        await asyncio.gather(*(job.task for job in batch.jobs))
+        return jobs, batch
+
+    jobs, batch = run(scenario())
+    assert peak == 2 and batch.done
+    assert jobs.get_batch(batch.batch_id, "s") is batch and jobs.get_batch(batch.batch_id, "other") is None
@@ -0,0 +1,14 @@
+import main
+
+
+def test_batched_exchanges_do_not_skew_single_predictions():
+    model = main.GenerationCostModel(prior_seconds=2.0)
+    single = {"motion_length": 4.0, "num_inference_steps": 10}
+    batch = {"batch": [single] * 8}
+    for _ in range(200):
+        # A single request takes 4 s; a batch of 8 shares its passes: 1 s + 0.6 s per item
+        model.observe(single, 4.0)
+        model.observe(batch, 1.0 + 0.6 * 8)
+    assert abs(model.predict(single) - 4.0) < 0.2
+    assert abs(model.predict(batch) - 5.8) < 0.3
+    assert model.stats()["batch_observations"] == 200
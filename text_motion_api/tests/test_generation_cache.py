@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def caches(monkeypatch):
+    cache = main.GenerationCache(max_bytes=1000)
+    payloads = main.GenerationCache(max_bytes=1000)
+    monkeypatch.setattr(main, "generation_cache", cache)
+    monkeypatch.setattr(main, "prompt_payloads", payloads)
+    monkeypatch.setattr(main, "prompt_index", main.PromptIndex(max_prompts=100))
+    return cache, payloads
+
+
+def test_uncacheable_results_stay_out_of_the_generation_cache(caches, monkeypatch):
+    cache, payloads = caches
+    calls = []
+
+    async def remote(request_data, session_id, priority, on_chunk):
+        calls.append(request_data["seed"])
+        return b"npz-%d" % request_data["seed"]
+
+    monkeypatch.setattr(main, "generate_motion_from_remote", remote)
+    seeded = {"text": "a person walks", "seed": 1, "motion_length": 4.0}
+    timed = {"text": "a person runs", "seed": 2, "motion_length": 4.0}
+    assert run(main.generate_motion_cached(seeded, cacheable=True)) == b"npz-1"
+    assert run(main.generate_motion_cached(timed, cacheable=False)) == b"npz-2"
+    assert run(main.generate_motion_cached(seeded, cacheable=True)) == b"npz-1"
+    assert calls == [1, 2]
+
+    assert list(cache._entries) == [main.GenerationCache.key_for(seeded)]
+    assert list(payloads._entries) == [main.GenerationCache.key_for(timed)]
+    # Both remain available as nearest matches
+    assert run(main.prompt_index.closest("a person runs", 4.0))[0] == b"npz-2"
+    assert run(main.prompt_index.closest("a person walks", 4.0))[0] == b"npz-1"
+
+
+def test_memory_tier_evicts_least_recently_used_by_bytes():
+    cache = main.GenerationCache(max_bytes=10)
+    run(cache.put("a", b"aaaa"))
+    run(cache.put("b", b"bbbb"))
+    assert run(cache.get("a")) == b"aaaa"  # a is now newer than b
+    run(cache.put("c", b"cccc"))
+    assert "b" not in cache and "a" in cache and "c" in cache
+    assert cache.bytes == 8 and cache.evictions == 1
+    run(cache.put("huge", b"x" * 11))  # larger than the whole budget: not kept
+    assert "huge" not in cache and cache.bytes == 8
+
+
+def disk_cache(path, max_bytes):
+    cache = main.GenerationCache(max_bytes=0, disk_dir=str(path), disk_max_bytes=max_bytes)
+    cache.open()
+    return cache
+
+
+def test_disk_tier_trims_least_recently_used_without_rescanning(tmp_path, monkeypatch):
+    cache = disk_cache(tmp_path, max_bytes=10)
+    run(cache.put("a", b"aaaa"))
+    run(cache.put("b", b"bbbb"))
+    assert run(cache.get("a")) == b"aaaa"
+
+    def no_scan(*args):
+        raise AssertionError("directory scanned on put")
+
+    monkeypatch.setattr(main.os, "scandir", no_scan)
+    run(cache.put("c", b"cccc"))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.npz", "c.npz"]
+    assert cache.disk_bytes == 8 and cache.disk_evictions == 1
+
+
+def test_disk_tier_is_indexed_on_open(tmp_path):
+    cache = disk_cache(tmp_path, max_bytes=100)
+    for key in ("a", "b", "c"):
+        run(cache.put(key, key.encode() * 10))
+    (tmp_path / "a.npz").unlink()  # removed behind the cache's back
+
+    reopened = disk_cache(tmp_path, max_bytes=15)  # restart with a smaller budget
+    assert reopened.disk_bytes == 10 and [p.name for p in tmp_path.iterdir()] == ["c.npz"]
+    assert run(reopened.get("c")) == b"c" * 10
+    assert run(reopened.get("b")) is None and reopened.disk_bytes == 10
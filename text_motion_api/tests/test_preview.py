@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import numpy as np
+from starlette.requests import Request
+
+import main
+from test_session_store import make_motion
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def axis_angle(angles):
+    """Unit quaternions [w, x, y, z] rotating by `angles` about the z axis"""
+    return np.stack([np.cos(angles / 2), 0 * angles, 0 * angles, np.sin(angles / 2)], axis=1)
+
+
+def test_slerp_interpolates_along_the_shortest_arc():
+    q0 = axis_angle(np.array([0.0, 0.0, 0.0]))
+    q1 = axis_angle(np.array([1.0, 1.0, 1e-9]))
+    q1[1] *= -1  # same rotation, opposite hemisphere
+    q = main.slerp(q0, q1, np.array([0.5, 0.5, 0.5]))
+    np.testing.assert_allclose(np.abs(q[:2]), axis_angle(np.array([0.5, 0.5])), atol=1e-6)
+    np.testing.assert_allclose(np.linalg.norm(q, axis=1), 1.0)
+    assert np.all(np.isfinite(q))  # nearly identical rotations fall back to lerp
+
+
+def test_decimate_motion_keeps_duration_and_end_pose():
+    motion = make_motion(frames=121)  # 4 s at 30 fps
+    motion["root_quat"] = axis_angle(np.linspace(0.0, 3.0, 121)).astype(np.float32)
+    preview = main.decimate_motion(motion, 10.0)
+    assert preview["frame_count"] == 41 and preview["fps"] == 10.0
+    assert preview["source_fps"] == 30.0 and preview["source_frame_count"] == 121
+    for field in ("joint_pos", "root_pos", "root_quat"):
+        assert preview[field].dtype == np.float32 and len(preview[field]) == 41
+        np.testing.assert_allclose(preview[field][[0, -1]], motion[field][[0, -1]], atol=1e-6)
+    np.testing.assert_allclose(preview["root_quat"], axis_angle(np.linspace(0.0, 3.0, 41)), atol=1e-5)
+    assert main.decimate_motion(motion, 60.0) is motion  # nothing to drop
+
+
+def get(path_params, headers, query=""):
+    scope = {
+        "type": "http", "method": "GET", "path": "/api/motions/m1", "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": ("127.0.0.1", 1234), "path_params": path_params,
+    }
+    return Request(scope)
+
+
+def test_motion_endpoint_serves_the_preview(monkeypatch):
+    monkeypatch.setattr(main.Config, "STRICT_ORIGIN_CHECK", False)
+    monkeypatch.setattr(main.Config, "MOTION_PREVIEW_FPS", 10.0)
+    monkeypatch.setattr(main.app_state, "store", main.MemorySessionStore())
+
+    async def scenario():
+        session = await main.app_state.store.get_or_create_session(None, main.get_client_fingerprint(get({}, {})))
+        await main.app_state.store.add_motion(session, "m1", make_motion(frames=121))
+        headers = {"X-Session-ID": session.session_id}
+        full = await main.get_motion("m1", get({}, headers), "json", "full")
+        preview = await main.get_motion("m1", get({}, headers), "binary", "preview")
+        cached = await main.get_motion("m1", get({}, {**headers, "If-None-Match": preview.headers["ETag"]}),
+                                       "binary", "preview")
+        return full, preview, cached
+
+    full, preview, cached = run(scenario())
+    assert json.loads(full.body)["frame_count"] == 121
+    header, arrays = main.decode_motion_binary(preview.body)
+    assert header["frame_count"] == 41 and arrays["joint_pos"].shape[0] == 41
+    assert preview.headers["ETag"] != full.headers["ETag"] and "preview" in preview.headers["ETag"]
+    assert cached.status_code == 304
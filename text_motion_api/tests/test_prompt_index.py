@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from bench import make_npz
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def leaked_match(monkeypatch):
+    """A closest match whose prompt belongs to another session"""
+    async def closest(text, motion_length, min_similarity):
+        return make_npz(40), "my secret project prompt", 0.8
+
+    monkeypatch.setattr(main.prompt_index, "closest", closest)
+    monkeypatch.setattr(main.app_state, "store", main.MemorySessionStore())
+
+
+def test_fallback_does_not_reveal_matched_prompt(leaked_match, monkeypatch):
+    async def unavailable(*args, **kwargs):
+        raise HTTPException(status_code=503, detail={"error": "down", "code": "SERVER_UNAVAILABLE"})
+
+    monkeypatch.setattr(main, "generate_motion_cached", unavailable)
+
+    async def scenario():
+        session = await main.app_state.store.get_or_create_session(None, "fp")
+        request = main.TextToMotionRequest(text="walk forward")
+        request_data, cacheable = main.build_remote_request(request)
+        return await main.run_generation(request, request_data, cacheable, session)
+
+    _, motion = run(scenario())
+    assert motion["fallback"] == {"reason": "SERVER_UNAVAILABLE", "similarity": 0.8}
+    assert "secret" not in repr({k: v for k, v in motion.items() if k not in main.MOTION_ARRAY_FIELDS})
+
+
+def test_preview_does_not_reveal_matched_prompt(leaked_match):
+    async def scenario():
+        now = datetime.now()
+        job = main.GenerationJob(job_id="j", session_id="s", text="walk forward", created_at=now, updated_at=now)
+        await main.publish_preview(main.TextToMotionRequest(text="walk forward", preview=True), job)
+        return job
+
+    job = run(scenario())
+    assert job.preview_match == {"similarity": 0.8}
+    assert b"secret" not in job.preview
+
+
+def cache_with(monkeypatch, entries):
+    cache = main.GenerationCache(max_bytes=1 << 20)
+    for key, value in entries.items():
+        cache._put_memory(key, value)
+    monkeypatch.setattr(main, "generation_cache", cache)
+    return cache
+
+
+def test_search_ranks_the_closest_prompt_first():
+    index = main.PromptIndex(max_prompts=100)
+    for i, text in enumerate(["a person walks forward", "a man jumps high", "someone dances happily"]):
+        index.add(text, f"k{i}", 4.0, 10)
+    (doc, similarity), *_ = index.search("a persn walks forward")
+    assert index._texts[doc] == "a person walks forward" and 0.5 < similarity < 1.0
+    assert index.search("a person walks forward", k=1)[0][1] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_closest_skips_evicted_payloads_and_weak_matches(monkeypatch):
+    index = main.PromptIndex(max_prompts=100)
+    index.add("a person walks forward", "gone", 4.0, 10)
+    index.add("a person walks forward slowly", "kept", 4.0, 10)
+    cache_with(monkeypatch, {"kept": b"npz"})
+
+    npz_bytes, text, similarity = run(index.closest("a person walks forward", 4.0))
+    assert npz_bytes == b"npz" and text == "a person walks forward slowly" and similarity < 1.0
+    assert index.alive == 1  # the prompt whose payloads all left the cache is dropped
+    assert run(index.closest("a child throws a ball", 4.0, min_similarity=0.5)) is None
+
+
+def test_closest_prefers_the_variant_closest_in_length(monkeypatch):
+    index = main.PromptIndex(max_prompts=100)
+    for key, length in (("short", 2.0), ("long", 8.0), ("mid", 5.0)):
+        index.add("a person walks forward", key, length, 10)
+    cache_with(monkeypatch, {"short": b"2", "long": b"8", "mid": b"5"})
+    assert run(index.closest("a person walks forward", 7.0))[0] == b"8"
+    assert run(index.closest("a person walks forward", 4.5))[0] == b"5"
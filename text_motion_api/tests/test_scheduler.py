@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_cancel_while_queued_then_release():
+    """A release landing before a cancelled waiter's clean-up must not lose the slot"""
+    async def scenario():
+        scheduler = main.GenerationScheduler(concurrency=1)
+        await scheduler.acquire("a")
+        waiter = asyncio.ensure_future(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+
+        waiter.cancel()
+        scheduler.release()  # Before the waiter's CancelledError handler runs
+        assert scheduler.active == 0
+
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert waiter.cancelled()
+        assert scheduler.queued == 0 and scheduler.active == 0
+
+        await asyncio.wait_for(scheduler.acquire("c"), timeout=1)
+        assert scheduler.active == 1
+
+    run(scenario())
+
+
+def test_cancel_while_queued_frees_queue_position():
+    async def scenario():
+        scheduler = main.GenerationScheduler(concurrency=1)
+        await scheduler.acquire("a")
+        first = asyncio.ensure_future(scheduler.acquire("b"))
+        second = asyncio.ensure_future(scheduler.acquire("c"))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        assert scheduler.queued == 1 and scheduler.cancelled == 1
+
+        scheduler.release()
+        await asyncio.wait_for(second, timeout=1)
+        assert scheduler.active == 1
+
+    run(scenario())
+
+
+def test_cancel_queued_keeps_shared_flight_for_other_sessions():
+    """DELETE /api/queue of one session must not fail a remote call another session waits on"""
+    async def scenario():
+        scheduler = main.GenerationScheduler(concurrency=1)
+        await scheduler.acquire("busy")
+        flights = main.SingleFlight()
+
+        async def generate():
+            async with scheduler.slot("a"):
+                return b"npz"
+
+        async def fn(job):
+            return await flights.run("key", generate), {}
+
+        jobs = main.GenerationJobManager(retention=60)
+        a = jobs.submit("a", "walk", fn, retain=False)
+        b = jobs.submit("b", "walk", fn, retain=False)
+        await asyncio.sleep(0.01)
+        assert flights.coalesced == 1 and scheduler.queued == 1
+        task_a, task_b = a.task, b.task
+
+        assert await jobs.cancel_queued("a") == 1
+        assert a.status == "cancelled"
+        with pytest.raises(HTTPException) as error:
+            await task_a
+        assert error.value.status_code == 409
+
+        scheduler.release()
+        motion_id, _ = await asyncio.wait_for(task_b, timeout=1)
+        assert motion_id == b"npz" and b.status == "succeeded"
+
+    run(scenario())
+
+
+def test_job_apis_refused_with_several_workers(monkeypatch):
+    main.require_single_worker()
+    monkeypatch.setattr(main.Config, "WEB_CONCURRENCY", 4)
+    with pytest.raises(HTTPException) as error:
+        main.require_single_worker()
+    assert error.value.status_code == 503
+    assert error.value.detail["code"] == "JOBS_UNAVAILABLE"
+
+
+def test_queued_cancellation_counts_predicted_cost(monkeypatch):
+    """Generator time saved is estimated before any generation has completed"""
+    async def scenario():
+        scheduler = main.GenerationScheduler(concurrency=1)
+        monkeypatch.setattr(main, "generation_scheduler", scheduler)
+        await scheduler.acquire("busy")
+        payload = {"text": "walk", "motion_length": 4.0, "num_inference_steps": 10}
+        saved = main.gateway_metrics.gpu_seconds_saved
+        task = asyncio.ensure_future(main._run_remote(payload, 1, "a", 0))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.service_ewma is None
+        expected = main.generation_cost_model.predict(payload)
+        assert main.gateway_metrics.gpu_seconds_saved - saved == pytest.approx(expected)
+
+    run(scenario())
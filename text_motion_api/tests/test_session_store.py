@@ -0,0 +1,173 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_motion(frames=30, seed=0):
+    rng = np.random.default_rng(seed)
+    quat = rng.normal(size=(frames, 4)).astype(np.float32)
+    return {
+        "name": "walk",
+        "fps": 30.0,
+        "frame_count": frames,
+        "duration": frames / 30.0,
+        "text_prompt": "walk",
+        "joint_pos": rng.normal(size=(frames, 29)).astype(np.float32),
+        "root_pos": rng.normal(size=(frames, 3)).astype(np.float32),
+        "root_quat": quat / np.linalg.norm(quat, axis=1, keepdims=True),
+    }
+
+
+def spill_store(monkeypatch, root):
+    monkeypatch.setattr(main.Config, "MOTION_SPILL_DIR", str(root))
+    store = main.MemorySessionStore()
+    store.open()
+    return store
+
+
+def test_spill_open_leaves_foreign_files(tmp_path, monkeypatch):
+    (tmp_path / "important.txt").write_text("keep")
+    store = spill_store(monkeypatch, tmp_path)
+
+    async def scenario():
+        session = await store.get_or_create_session(None, "fp")
+        await store.add_motion(session, "m1", make_motion())
+        return store.motion_file(session, "m1")
+
+    path = run(scenario())
+    assert path.startswith(str(tmp_path / "motion-spill")) and os.path.exists(path)
+
+    spill_store(monkeypatch, tmp_path)  # restart
+    assert (tmp_path / "important.txt").read_text() == "keep"
+    assert not os.path.exists(path)
+
+
+def test_spill_round_trip_is_memory_mapped(tmp_path, monkeypatch):
+    store = spill_store(monkeypatch, tmp_path)
+    motion = make_motion()
+
+    async def scenario():
+        session = await store.get_or_create_session(None, "fp")
+        await store.add_motion(session, "m1", motion)
+        assert store.motion_bytes == 0 and store.disk_bytes == os.path.getsize(store.motion_file(session, "m1"))
+        loaded = await store.get_motion(session, "m1")
+        assert await store.delete_motion(session, "m1")
+        return loaded, session
+
+    loaded, session = run(scenario())
+    for field in main.MOTION_ARRAY_FIELDS:
+        np.testing.assert_array_equal(loaded[field], motion[field])
+    assert loaded["frame_count"] == 30 and loaded["text_prompt"] == "walk"
+    assert store.disk_bytes == 0 and not os.listdir(tmp_path / "motion-spill" / session.session_id)
+
+
+def test_sqlite_store_creates_its_schema(tmp_path):
+    store = main.SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    store.open()
+    try:
+        columns = [row[1] for row in store._conn.execute("PRAGMA table_info(sessions)")]
+        assert "rate_tokens" in columns and "request_count" not in columns
+
+        async def scenario():
+            session = await store.get_or_create_session(None, "fp")
+            await store.add_motion(session, "m1", make_motion())
+            return await store.get_motion(session, "m1")
+
+        assert run(scenario())["frame_count"] == 30
+    finally:
+        store.close()
+
+
+def test_expiry_removes_due_sessions_and_repushes_active_ones(monkeypatch):
+    monkeypatch.setattr(main.Config, "DATA_RETENTION_MINUTES", 0)  # every new session is due at once
+    store = main.MemorySessionStore()
+
+    async def scenario():
+        idle = [await store.get_or_create_session(None, "fp") for _ in range(main.CLEANUP_BATCH_SIZE + 10)]
+        active = await store.get_or_create_session(None, "fp")
+        active.last_activity = datetime.now() + timedelta(minutes=5)  # seen since its heap entry
+        removed = await store.cleanup_expired_sessions()
+        return idle, active, removed
+
+    idle, active, removed = run(scenario())
+    assert removed == len(idle)  # across several cleanup batches
+    assert list(store.sessions) == [active.session_id]
+    # The active session's stale entry was pushed back with its new deadline
+    assert store._expiry == [(active.last_activity, active.session_id)]
+    assert run(store.cleanup_expired_sessions()) == 0
+
+
+def assert_consistent(store):
+    entries = [(s, e) for s in store.sessions.values() for e in s.motions.values()]
+    assert store.motion_bytes == sum(e.nbytes for _, e in entries)
+    assert store.raw_motion_bytes == sum(e.raw_bytes for _, e in entries)
+    for session in store.sessions.values():
+        assert session.motion_bytes == sum(e.nbytes for e in session.motions.values())
+    assert set(store._lru) == {(s.session_id, mid) for s in store.sessions.values() for mid in s.motions}
+
+
+def test_concurrent_writes_keep_byte_accounting(monkeypatch):
+    monkeypatch.setattr(main.Config, "MAX_STORED_MOTIONS_PER_USER", 3)
+    store = main.MemorySessionStore()
+
+    async def scenario():
+        sessions = [await store.get_or_create_session(None, "fp") for _ in range(3)]
+        # Same motion IDs written twice concurrently: replacements must not double count
+        await asyncio.gather(*(
+            store.add_motion(session, f"m{i % 5}", make_motion(frames=10 + i, seed=i))
+            for session in sessions for i in range(10)
+        ))
+        return sessions
+
+    sessions = run(scenario())
+    assert all(len(session.motions) == 3 for session in sessions)
+    assert_consistent(store)
+
+
+def test_session_lock_does_not_block_other_sessions():
+    store = main.MemorySessionStore()
+
+    async def scenario():
+        busy = await store.get_or_create_session(None, "fp")
+        other = await store.get_or_create_session(None, "fp")
+        async with busy.lock:
+            await asyncio.wait_for(store.add_motion(other, "m1", make_motion()), timeout=1)
+            blocked = asyncio.ensure_future(store.add_motion(busy, "m1", make_motion()))
+            await asyncio.sleep(0.05)
+            assert not blocked.done()
+        await blocked
+        return busy, other
+
+    busy, other = run(scenario())
+    assert list(busy.motions) == ["m1"] and list(other.motions) == ["m1"]
+    assert_consistent(store)
+
+
+def test_byte_budgets_evict_least_recently_used():
+    store = main.MemorySessionStore()
+    size = len(main.pack_motion(make_motion(), store.compression))
+    store.session_max_bytes = 2 * size
+    store.max_bytes = 3 * size - 1
+
+    async def scenario():
+        a = await store.get_or_create_session(None, "fp")
+        b = await store.get_or_create_session(None, "fp")
+        for motion_id in ("a1", "a2"):
+            await store.add_motion(a, motion_id, make_motion())
+        await store.get_motion(a, "a1")  # a2 is now the session's oldest
+        await store.add_motion(a, "a3", make_motion())
+        await store.add_motion(b, "b1", make_motion())  # store budget: a's oldest goes
+        return a, b
+
+    a, b = run(scenario())
+    assert list(a.motions) == ["a3"] and list(b.motions) == ["b1"]
+    assert store.evictions == 2
+    assert_consistent(store)